@@ -57,7 +57,7 @@ def create_dependencies_layer(
             ## migrate to the package/function directory to export and install
             subprocess.run(
                 f"""
-                 cd ../{function_name} && poetry export --only main -o requirements.txt --without-hashes && \
+                 cd ../{function_name} && poetry export --only main --all-extras -o requirements.txt --without-hashes && \
                  poetry run python -m pip install -qq -r requirements.txt \
                  -t {output_dir}/python && \
                  cd {output_dir} && \
@@ -1,7 +1,10 @@
+import asyncio
 import logging
 import time
 import os
 import json
+from types import SimpleNamespace
+from typing import AsyncIterator
 
 import asyncpg
 from openaq_api.models.auth import User
@@ -40,12 +43,131 @@ def dbkey(m, f, query, args, timeout=None, config=None):
     j = orjson.dumps(
         args, option=orjson.OPT_OMIT_MICROSECONDS, default=default
     ).decode()
-    dbkey = f"{query}{j}"
-    h = hash(dbkey)
-    # logger.debug(f"dbkey: {dbkey} h: {h}")
+    # hashing the tuple reuses the hash cached on the (templated) query
+    # string instead of hashing a new concatenated string every time
+    h = hash((query, j))
+    # logger.debug(f"dbkey: {query}{j} h: {h}")
     return h
 
 
+# upper bound of rendered statements to keep, queries are templated
+# so this is only reached if something unexpected is rendered
+MAX_RENDERED_QUERIES = 2048
+
+rendered_queries = {}
+
+
+def render_query(query: str, kwargs: dict) -> tuple[str, list]:
+    """Renders named parameters to positional ones like `buildpg.render`.
+
+    The positional SQL and the order of the parameter names are cached per
+    query text so after the first time only the values need to be bound.
+
+    Args:
+        query: SQL with `:name` parameters
+        kwargs: parameter values by name
+
+    Returns:
+        tuple of the positional SQL and the list of values
+    """
+    try:
+        rquery, names = rendered_queries[query]
+        return rquery, [kwargs[name] for name in names]
+    except KeyError:
+        # unknown query, or a parameter is missing in which case
+        # render raises the same error as before
+        rquery, args = render(query, **kwargs)
+        _, names = render(query, **{name: name for name in kwargs})
+        if len(rendered_queries) >= MAX_RENDERED_QUERIES:
+            logger.warning("Clearing rendered queries")
+            rendered_queries.clear()
+        rendered_queries[query] = (rquery, tuple(names))
+        return rquery, args
+
+
+# estimated costs of rendered queries and their parameters, see DB.query_cost
+query_costs = {}
+
+
+def cost_key(rquery: str, args: list) -> tuple[str, bytes]:
+    """Key of the estimated cost of a rendered query with its parameters.
+
+    The cost of a query shape depends on its parameters, e.g. the length of
+    a datetime range, so estimates can not be shared between them.
+    """
+    return rquery, orjson.dumps(args, default=default)
+
+
+def plan_cost(plan) -> float:
+    """Returns the estimated total cost from `EXPLAIN (FORMAT JSON)` output."""
+    if isinstance(plan, (str, bytes)):
+        plan = orjson.loads(plan)
+    return float(plan[0]["Plan"]["Total Cost"])
+
+
+async def open_stream(rows: AsyncIterator) -> AsyncIterator:
+    """Starts a stream of rows for the body of a response.
+
+    The first row is read before the response is built so the cost guard,
+    the connection and the query have run by then. Their errors are
+    returned with their own status codes instead of as a truncated 200.
+
+    Args:
+        rows: the rows of `DB.stream`
+
+    Returns:
+        async iterator of all of the rows
+    """
+    try:
+        first = await anext(rows)
+    except StopAsyncIteration:
+        return rows
+
+    async def stream():
+        yield first
+        async for row in rows:
+            yield row
+
+    return stream()
+
+
+async def read_batches(
+    pool, rquery: str, args: list, prefetch: int, queue: asyncio.Queue, timeout
+):
+    """Reads the rows of a query into a queue, `prefetch` rows at a time.
+
+    The cursor is given up when the queue stays full for
+    `STREAM_IDLE_SECONDS`, i.e. when the rows are not read, so a slow
+    client never holds on to a connection. The last item is None, or the
+    exception that stopped the reading.
+    """
+    end = None
+    acquired = False
+    try:
+        async with pool.acquire(timeout=timeout) as con:
+            acquired = True
+            # cursors can only be used inside of a transaction
+            async with con.transaction():
+                cursor = await con.cursor(rquery, *args)
+                while rows := await cursor.fetch(prefetch):
+                    await wait_for(
+                        queue.put(rows), timeout=settings.STREAM_IDLE_SECONDS
+                    )
+    except TimeoutError as e:
+        if acquired:
+            logger.warning(f"Stream was not read, closing its cursor\n{rquery}")
+            end = e
+        else:
+            end = HTTPException(
+                status_code=503,
+                detail="Too many streams are running, try again later.",
+            )
+    except Exception as e:
+        end = e
+    # the connection is released, only the reader is waited for
+    await queue.put(end)
+
+
 cache_config = {
     "key_builder": dbkey,
     "cache": SimpleMemoryCache,
@@ -57,7 +179,7 @@ cache_config = {
 }
 
 
-async def db_pool(pool):
+async def db_pool(pool, max_size: int = 10):
     # each time we create a connect make sure it can
     # properly convert json/jsonb fields
     async def init(con):
@@ -77,17 +199,43 @@ async def db_pool(pool):
             command_timeout=MAX_CONNECTION_TIMEOUT,
             max_inactive_connection_lifetime=15,
             min_size=1,
-            max_size=10,
+            max_size=max_size,
             init=init,
         )
     return pool
 
 
+class AppTimer:
+    """Timer of an `AppRequest`, there is no request to time."""
+
+    def mark(self, key: str, return_time: str = "total") -> float:
+        return 0.0
+
+
+class AppRequest:
+    """Stands in for the request of a `DB` of the whole app."""
+
+    def __init__(self, app):
+        self.app = app
+        self.state = SimpleNamespace(timer=AppTimer())
+
+
 class DB:
     def __init__(self, request: Request):
         self.request = request
         request.state.timer.mark("db")
 
+    @classmethod
+    def for_app(cls, app) -> "DB":
+        """A `DB` that is not bound to a request, for the background tasks
+        that outlive the request starting them. It shares the pools of the
+        app."""
+        return cls(AppRequest(app))
+
+    def app_scoped(self) -> "DB":
+        """A `DB` of the app of this request, see `for_app`."""
+        return DB.for_app(self.request.app)
+
     async def acquire(self):
         pool = await self.pool()
         return pool
@@ -98,6 +246,93 @@ class DB:
         )
         return self.request.app.state.pool
 
+    async def heavy_pool(self):
+        """A small separate pool for queries the cost guard flags as heavy.
+
+        Keeps expensive queries from taking up the connections of the
+        interactive pool.
+        """
+        self.request.app.state.heavy_pool = await db_pool(
+            getattr(self.request.app.state, "heavy_pool", None),
+            max_size=settings.HEAVY_POOL_SIZE,
+        )
+        return self.request.app.state.heavy_pool
+
+    async def stream_pool(self):
+        """A small separate pool for the cursors of `stream`.
+
+        Streams are read as fast as their clients read them, they never
+        take up the connections of the interactive pool.
+        """
+        self.request.app.state.stream_pool = await db_pool(
+            getattr(self.request.app.state, "stream_pool", None),
+            max_size=settings.STREAM_POOL_SIZE,
+        )
+        return self.request.app.state.stream_pool
+
+    async def export_pool(self):
+        """A pool for export jobs, one connection per concurrent export.
+
+        Exports read whole ranges and never take up the connections of the
+        interactive or heavy pools.
+        """
+        self.request.app.state.export_pool = await db_pool(
+            getattr(self.request.app.state, "export_pool", None),
+            max_size=settings.EXPORT_CONCURRENCY,
+        )
+        return self.request.app.state.export_pool
+
+    async def query_cost(self, pool, rquery: str, args: list) -> float:
+        """Estimates the cost of a rendered query with EXPLAIN.
+
+        Estimates are cached per rendered query and parameters so the
+        planner is only asked once per query and cache period.
+
+        Returns:
+            the planner's estimated total cost, 0 if it could not be estimated
+        """
+        now = time.time()
+        key = cost_key(rquery, args)
+        cost, expires = query_costs.get(key, (None, 0))
+        if cost is not None and expires > now:
+            return cost
+        async with pool.acquire() as con:
+            try:
+                plan = await wait_for(
+                    con.fetchval(f"EXPLAIN (FORMAT JSON) {rquery}", *args),
+                    timeout=DEFAULT_CONNECTION_TIMEOUT,
+                )
+                cost = plan_cost(plan)
+            except Exception as e:
+                logger.warning(f"Could not estimate query cost: {e}\n{rquery}")
+                return 0
+        if len(query_costs) >= MAX_RENDERED_QUERIES:
+            query_costs.clear()
+        query_costs[key] = (cost, now + settings.API_CACHE_TIMEOUT)
+        self.request.state.timer.mark("explained")
+        return cost
+
+    async def guard(self, pool, rquery: str, args: list, timeout):
+        """Checks the estimated cost of a query before running it.
+
+        Queries above `QUERY_COST_LIMIT` are rejected and queries above
+        `QUERY_COST_HEAVY` are sent to the heavy pool with the maximum
+        timeout.
+
+        Returns:
+            tuple of the pool and timeout to run the query with
+        """
+        cost = await self.query_cost(pool, rquery, args)
+        logger.debug(f"Estimated query cost: {cost}")
+        if cost > settings.QUERY_COST_LIMIT:
+            raise HTTPException(
+                status_code=422,
+                detail=f"Query is too expensive to run (estimated cost {cost:.0f}). Try to provide more specific query parameters, e.g. a smaller datetime_from/datetime_to range, a smaller bounding box or radius. Whole ranges of measurements can be requested as an export with POST /v3/sensors/{{sensors_id}}/measurements/exports.",
+            )
+        if cost > settings.QUERY_COST_HEAVY:
+            return await self.heavy_pool(), MAX_CONNECTION_TIMEOUT
+        return pool, timeout
+
     @cached(settings.API_CACHE_TIMEOUT, **cache_config)
     async def fetch(
         self, query, kwargs, timeout=DEFAULT_CONNECTION_TIMEOUT, config=None
@@ -106,7 +341,9 @@ class DB:
         self.request.state.timer.mark("pooled")
         start = time.time()
         logger.debug("Start time: %s\nQuery: %s \nArgs:%s\n", start, query, kwargs)
-        rquery, args = render(query, **kwargs)
+        rquery, args = render_query(query, kwargs)
+        if settings.QUERY_COST_GUARD:
+            pool, timeout = await self.guard(pool, rquery, args, timeout)
         async with pool.acquire() as con:
             try:
                 # a transaction is required to prevent auto-commit
@@ -150,6 +387,45 @@ class DB:
         )
         return r
 
+    async def stream(self, query, kwargs, prefetch=1000, export=False):
+        """Iterates over the rows of a query with a server side cursor.
+
+        Rows are fetched from the database `prefetch` rows at a time, at
+        most `STREAM_BUFFER_BATCHES` of them ahead of the reader, so that
+        large results never have to be held in memory at once. Streams run
+        on the `stream_pool` and give up their connection when they are not
+        read for `STREAM_IDLE_SECONDS`. Results are not cached. Exports run
+        on the `export_pool` and are not checked by the cost guard, they are
+        the way to run the queries it rejects.
+
+        The guard runs on the first iteration, streams that are returned as
+        the body of a response have to be started with `open_stream`.
+
+        Yields:
+            asyncpg Record for each row of the result
+        """
+        if export:
+            pool, timeout = await self.export_pool(), None
+        else:
+            pool, timeout = await self.stream_pool(), settings.STREAM_ACQUIRE_SECONDS
+        self.request.state.timer.mark("pooled")
+        rquery, args = render_query(query, kwargs)
+        if settings.QUERY_COST_GUARD and not export:
+            pool, _ = await self.guard(pool, rquery, args, DEFAULT_CONNECTION_TIMEOUT)
+        queue = asyncio.Queue(settings.STREAM_BUFFER_BATCHES)
+        reader = asyncio.create_task(
+            read_batches(pool, rquery, args, prefetch, queue, timeout)
+        )
+        try:
+            while (rows := await queue.get()) is not None:
+                if isinstance(rows, Exception):
+                    raise rows
+                for row in rows:
+                    yield row
+        finally:
+            reader.cancel()
+        self.request.state.timer.mark("streamed", "since")
+
     async def fetchrow(self, query, kwargs):
         r = await self.fetch(query, kwargs)
         if len(r) > 0:
@@ -0,0 +1,150 @@
+import abc
+import asyncio
+import functools
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import orjson
+from starlette.responses import FileResponse, RedirectResponse, Response
+
+from openaq_api.settings import settings
+
+logger = logging.getLogger("exports")
+
+
+class ExportStore(abc.ABC):
+    """Keeps the files and the status of export jobs.
+
+    Keys are paths relative to the root of the store, e.g.
+    `{exports_id}/status.json`.
+    """
+
+    @abc.abstractmethod
+    async def put(self, key: str, path: str) -> int:
+        """Stores a finished local file, returns its size in bytes."""
+
+    @abc.abstractmethod
+    async def put_json(self, key: str, content: dict):
+        """Stores JSON, replacing what is stored at once."""
+
+    @abc.abstractmethod
+    async def get_json(self, key: str) -> dict | None:
+        """The stored JSON, None if there is none."""
+
+    @abc.abstractmethod
+    async def download(self, key: str, filename: str, media_type: str) -> Response:
+        """Response serving a stored file, including Range requests."""
+
+
+class LocalExportStore(ExportStore):
+    """Keeps the exports in a local directory, a stand-in for S3."""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        return self.root / key
+
+    async def put(self, key: str, path: str) -> int:
+        target = self.path(key)
+
+        def move():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(path, target)
+            return target.stat().st_size
+
+        return await asyncio.to_thread(move)
+
+    async def put_json(self, key: str, content: dict):
+        target = self.path(key)
+
+        def write():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # replaced at once so readers never see a partial file
+            partial = target.with_name(f"{target.name}.partial")
+            partial.write_bytes(orjson.dumps(content))
+            os.replace(partial, target)
+
+        await asyncio.to_thread(write)
+
+    async def get_json(self, key: str) -> dict | None:
+        try:
+            return orjson.loads(await asyncio.to_thread(self.path(key).read_bytes))
+        except FileNotFoundError:
+            return None
+
+    async def download(self, key: str, filename: str, media_type: str) -> Response:
+        # FileResponse answers Range requests, the identity encoding keeps the
+        # gzip middleware from compressing the file again
+        return FileResponse(
+            self.path(key),
+            media_type=media_type,
+            filename=filename,
+            headers={"Content-Encoding": "identity"},
+        )
+
+
+class S3ExportStore(ExportStore):
+    """Keeps the exports in an S3 bucket.
+
+    Downloads are redirected to presigned URLs, S3 answers the Range
+    requests itself.
+    """
+
+    def __init__(self, bucket: str, prefix: str = ""):
+        import boto3
+
+        self.client = boto3.client("s3")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    async def put(self, key: str, path: str) -> int:
+        await asyncio.to_thread(
+            self.client.upload_file, path, self.bucket, self.key(key)
+        )
+        return os.path.getsize(path)
+
+    async def put_json(self, key: str, content: dict):
+        await asyncio.to_thread(
+            self.client.put_object,
+            Bucket=self.bucket,
+            Key=self.key(key),
+            Body=orjson.dumps(content),
+            ContentType="application/json",
+        )
+
+    async def get_json(self, key: str) -> dict | None:
+        try:
+            response = await asyncio.to_thread(
+                self.client.get_object, Bucket=self.bucket, Key=self.key(key)
+            )
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return orjson.loads(await asyncio.to_thread(response["Body"].read))
+
+    async def download(self, key: str, filename: str, media_type: str) -> Response:
+        url = await asyncio.to_thread(
+            self.client.generate_presigned_url,
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self.key(key),
+                "ResponseContentDisposition": f'attachment; filename="{filename}"',
+                "ResponseContentType": media_type,
+            },
+            ExpiresIn=3600,
+        )
+        return RedirectResponse(url, status_code=307)
+
+
+@functools.cache
+def export_store() -> ExportStore:
+    """The store of `EXPORT_STORE`, `local` or `s3`."""
+    if settings.EXPORT_STORE == "s3":
+        return S3ExportStore(settings.EXPORT_BUCKET, settings.EXPORT_PATH)
+    return LocalExportStore(settings.EXPORT_PATH)
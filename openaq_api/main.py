@@ -17,7 +17,7 @@ from mangum import Mangum
 from pydantic import BaseModel, ValidationError
 from starlette.responses import JSONResponse, RedirectResponse
 
-from openaq_api.db import db_pool
+from openaq_api.db import DB, db_pool
 from openaq_api.dependencies import check_api_key
 from openaq_api.middleware import (
     CacheControlMiddleware,
@@ -30,7 +30,9 @@ from openaq_api.settings import settings
 # V3 routers
 from openaq_api.v3.routers import (
     auth,
+    changes,
     countries,
+    exports,
     instruments,
     locations,
     manufacturers,
@@ -98,12 +100,26 @@ async def lifespan(app: FastAPI):
     else:
         app.state.counter = 0
 
+    if settings.LATEST_STORE:
+        # loads in the background, the database serves the latest values
+        # until it is loaded
+        latest.reload_latest(DB.for_app(app))
+
     yield
     if hasattr(app.state, "pool") and not settings.USE_SHARED_POOL:
         logger.debug("Closing connection")
         await app.state.pool.close()
         delattr(app.state, "pool")
         logger.debug("Connection closed")
+    if hasattr(app.state, "heavy_pool") and not settings.USE_SHARED_POOL:
+        await app.state.heavy_pool.close()
+        delattr(app.state, "heavy_pool")
+    if hasattr(app.state, "stream_pool") and not settings.USE_SHARED_POOL:
+        await app.state.stream_pool.close()
+        delattr(app.state, "stream_pool")
+    if hasattr(app.state, "export_pool") and not settings.USE_SHARED_POOL:
+        await app.state.export_pool.close()
+        delattr(app.state, "export_pool")
 
 
 app = FastAPI(
@@ -205,6 +221,8 @@ app.include_router(providers.router)
 app.include_router(sensors.router)
 app.include_router(latest.router)
 app.include_router(flags.router)
+app.include_router(exports.router)
+app.include_router(changes.router)
 
 
 static_dir = Path.joinpath(Path(__file__).resolve().parent, "static")
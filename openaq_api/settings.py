@@ -27,6 +27,48 @@ class Settings(BaseSettings):
     DATABASE_PORT: int
     API_CACHE_TIMEOUT: int = 900
     USE_SHARED_POOL: bool = False
+    HEAVY_POOL_SIZE: int = 2
+    STREAM_POOL_SIZE: int = 4
+    STREAM_ACQUIRE_SECONDS: int = 6
+    STREAM_IDLE_SECONDS: int = 30
+    STREAM_BUFFER_BATCHES: int = 2
+    QUERY_COST_GUARD: bool = False
+    QUERY_COST_HEAVY: float = 1_000_000
+    QUERY_COST_LIMIT: float = 50_000_000
+    ROLLUP_PLANNER: bool = True
+    ROLLUP_LAG_SECONDS: int = 86400
+    AGGREGATION_STORE: bool = True
+    AGGREGATION_STORE_SECONDS: int = 86400
+    SERIES_CACHE: bool = True
+    SERIES_CACHE_ROWS: int = 100_000
+    SERIES_CACHE_MAX_CHUNKS: int = 36
+    SERIES_CACHE_SECONDS: int = 86400
+    TRENDS_CHUNK_DAYS: int = 365
+    TRENDS_MAX_CHUNKS: int = 4
+    TRENDS_CONCURRENCY: int = 4
+    TRENDS_SKETCH_SIZE: int = 201
+    SUMMARY_ENGINE: str = "sql"
+    FLAGS_CHECK_SECONDS: int = 60
+    SENSOR_METADATA_SECONDS: int = 3600
+    VALIDATE_RESPONSES: bool = False
+    LATEST_STORE: bool = True
+    LATEST_REFRESH_SECONDS: int = 60
+    LATEST_RELOAD_SECONDS: int = 3600
+    LATEST_OVERLAP_SECONDS: int = 7200
+    LATEST_STREAM_QUEUE_SIZE: int = 100
+    LATEST_STREAM_HEARTBEAT_SECONDS: int = 15
+    LATEST_STREAM_MAX_SUBSCRIBERS: int = 10000
+    CHANGES_OVERLAP_SECONDS: int = 7200
+    LOCATIONS_CATALOGUE: bool = False
+    LOCATIONS_CATALOGUE_SECONDS: int = 3600
+    LOCATIONS_CATALOGUE_RETRY_SECONDS: int = 60
+    EXPORT_STORE: str = "local"
+    EXPORT_PATH: str = "exports"
+    EXPORT_BUCKET: str | None = None
+    EXPORT_CONCURRENCY: int = 1
+    EXPORT_MAX_JOBS: int = 10
+    EXPORT_HEARTBEAT_SECONDS: int = 60
+    EXPORT_STALE_SECONDS: int = 600
     LOG_LEVEL: str = "INFO"
     LOG_BUCKET: str | None = None
     DOMAIN_NAME: str | None = None
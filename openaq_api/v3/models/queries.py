@@ -1,3 +1,4 @@
+import functools
 import inspect
 import itertools
 import logging
@@ -5,7 +6,7 @@ import operator
 import types
 import weakref
 from datetime import date, datetime
-from enum import StrEnum
+from enum import Enum, StrEnum
 from types import FunctionType
 from typing import Annotated, Any
 from abc import ABC
@@ -32,6 +33,10 @@ logger = logging.getLogger("queries")
 
 maxint = 2147483647
 
+# upper bound of cached SQL texts per template function, reached only if
+# something unexpected ends up in the query shape
+max_sql_templates = 1024
+
 ignore_in_docs = [
     "date_from_adj",
     "date_to_adj",
@@ -907,12 +912,143 @@ class BboxQuery(QueryBaseModel):
             string of WHERE clause if `bbox` is set.
         """
         if self.bbox:
-            return "ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326) && geom"
+            geom = self.map("geom", "geom")
+            return f"ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326) && {geom}"
 
 
 class MeasurementsQueries(Paging, ParametersQuery): ...
 
 
+class QueryPlan(object):
+    """Clause generators of a query class, compiled once per class.
+
+    Walking the MRO, filtering and sorting the bases and resolving each
+    base's `where`, `fields` and `pagination` methods only depends on the
+    class, so it is done once and reused for every request.
+
+    Each generator is stored with the names of the fields its class
+    declares. At request time a generator whose declared fields are all
+    None is skipped without being called.
+    """
+
+    __slots__ = ("bases", "where", "fields", "pagination", "sort_class")
+
+    def __init__(self, query_class: type):
+        base_classes = inspect.getmro(query_class)
+        bases = [
+            x for x in base_classes if ABC not in x.__bases__
+        ]  # remove all abstract classes
+        bases.remove(object)  # remove <class 'object'>
+        bases.remove(ABC)  # <class 'ABC'>
+        bases.remove(BaseModel)  # <class 'pydantic.main.BaseModel'>
+        self.bases = sorted(
+            bases, key=operator.attrgetter("__name__")
+        )  # sort to ensure consistent order for reliability in testing
+        self.where = self._generators("where")
+        self.fields = self._generators("fields")
+        self.pagination = self._generators("pagination")
+        sort_class = [x for x in base_classes if issubclass(x, SortingBase)]
+        if len(sort_class) > 0:
+            sort_class.remove(query_class)
+            sort_class.remove(SortingBase)
+            self.sort_class = sort_class[0]
+        else:
+            self.sort_class = None
+
+    def _generators(self, name: str) -> tuple:
+        """Collects the methods a base class defines itself.
+
+        A base which only inherits the method would return the same clause
+        as the class that defines it, so only own definitions are kept.
+        """
+        generators = []
+        for base in self.bases:
+            method = vars(base).get(name)
+            if callable(method):
+                declared = tuple(
+                    f
+                    for f in vars(base).get("__annotations__", {})
+                    if f in base.model_fields
+                )
+                generators.append((method, declared))
+        return tuple(generators)
+
+    @staticmethod
+    def run(generators: tuple, query) -> list[str]:
+        """Calls each generator once, skipping those with no parameters set.
+
+        Args:
+            generators: tuple of (method, declared fields) pairs.
+            query: the query model instance.
+
+        Returns:
+            list of the non empty clauses.
+        """
+        clauses = []
+        for method, declared in generators:
+            if declared and all(getattr(query, f) is None for f in declared):
+                continue
+            clause = method(query)
+            if clause:
+                clauses.append(clause)
+        return clauses
+
+
+_query_plans = weakref.WeakKeyDictionary()
+
+
+def query_plan(query_class: type) -> QueryPlan:
+    """Returns the cached QueryPlan of a query class, compiling it if needed."""
+    try:
+        return _query_plans[query_class]
+    except KeyError:
+        plan = _query_plans[query_class] = QueryPlan(query_class)
+        return plan
+
+
+def value_kind(value: Any) -> Any:
+    """Describes a parameter value by what it can change in the SQL text.
+
+    Clauses branch on the type of a value, e.g. a date or a naive datetime is
+    cast to the local timezone while an aware datetime is used as is. Enum
+    values are returned as is since they can be written into the SQL text,
+    e.g. the sort order.
+    """
+    if isinstance(value, Enum):
+        return value
+    if isinstance(value, datetime):
+        return "datetime" if value.tzinfo is None else "datetimetz"
+    return type(value).__name__
+
+
+def sql_template(func):
+    """Caches the SQL text built by a function per query shape.
+
+    The decorated function takes a QueryBuilder and optionally extra
+    hashable arguments that change the SQL text (e.g. the period to
+    aggregate to) and returns the SQL text. The f-string is only built the
+    first time a shape is seen, afterwards the same string is returned
+    which keeps the rendered statement cache in `db` and asyncpg's
+    prepared statement cache warm.
+    """
+    templates = {}
+
+    @functools.wraps(func)
+    def wrapper(query_builder: "QueryBuilder", *args) -> str:
+        key = (query_builder.shape(), args)
+        try:
+            return templates[key]
+        except KeyError:
+            if len(templates) >= max_sql_templates:
+                logger.warning(f"Clearing {func.__name__} SQL templates")
+                templates.clear()
+            sql = templates[key] = func(query_builder, *args)
+            return sql
+
+    wrapper.templates = templates
+    return wrapper
+
+
 class QueryBuilder(object):
     """A utility class to wrap multiple QueryBaseModel classes"""
 
@@ -924,6 +1060,7 @@ class QueryBuilder(object):
         """
         self.query = query
         self.sort_field = False
+        self.plan = query_plan(query.__class__)
 
     def _bases(self) -> list[type]:
         """inspects the object and returns base classes
@@ -934,28 +1071,11 @@ class QueryBuilder(object):
         Returns:
             a sorted list of base classes
         """
-        base_classes = inspect.getmro(self.query.__class__)
-        bases = [
-            x for x in base_classes if ABC not in x.__bases__
-        ]  # remove all abstract classes
-        bases.remove(object)  # remove <class 'object'>
-        bases.remove(ABC)  # <class 'ABC'>
-        bases.remove(BaseModel)  # <class 'pydantic.main.BaseModel'>
-        bases_sorted = sorted(
-            bases, key=operator.attrgetter("__name__")
-        )  # sort to ensure consistent order for reliability in testing
-        return bases_sorted
+        return list(self.plan.bases)
 
     @property
     def _sortable(self) -> SortingBase | None:
-        base_classes = inspect.getmro(self.query.__class__)
-        sort_class = [x for x in base_classes if issubclass(x, SortingBase)]
-        if len(sort_class) > 0:
-            sort_class.remove(self.query.__class__)
-            sort_class.remove(SortingBase)
-            return sort_class[0]
-        else:
-            return None
+        return self.plan.sort_class
 
     def set_column_map(self, m: dict):
         """
@@ -966,34 +1086,23 @@ class QueryBuilder(object):
 
     def fields(self) -> str:
         """
-        loops through all ancestor classes and calls
-        their respective fields() methods to concatenate
-        into additional fields for select
+        calls the fields() methods of all ancestor classes
+        to concatenate into additional fields for select
 
         Returns:
 
         """
-        fields = []
-        bases = self._bases()
-        for base in bases:
-            if callable(getattr(base, "fields", None)):
-                if base.fields(self.query):
-                    fields.append(base.fields(self.query))
+        fields = QueryPlan.run(self.plan.fields, self.query)
         if len(fields):
-            fields = list(set(fields))
+            fields = list(dict.fromkeys(fields))
             return "\n," + ("\n,").join(fields)
         else:
             return ""
 
     def pagination(self) -> str:
-        pagination = []
-        bases = self._bases()
-        for base in bases:
-            if callable(getattr(base, "pagination", None)):
-                if base.pagination(self.query):
-                    pagination.append(base.pagination(self.query))
+        pagination = QueryPlan.run(self.plan.pagination, self.query)
         if len(pagination):
-            pagination = list(set(pagination))
+            pagination = list(dict.fromkeys(pagination))
             return "\n" + ("\n,").join(pagination)
         else:
             return ""
@@ -1001,6 +1110,19 @@ class QueryBuilder(object):
     def params(self) -> dict:
         return self.query.model_dump(exclude_unset=True, by_alias=True)
 
+    def shape(self) -> tuple:
+        """Hashable key of everything the generated SQL text depends on.
+
+        Returns:
+            tuple of the query class, the set parameters with their value
+            kind and the column map.
+        """
+        present = tuple(
+            (name, value_kind(value)) for name, value in self.query if value is not None
+        )
+        column_map = tuple(getattr(self, "__column_map__", {}).items())
+        return (self.query.__class__, present, column_map)
+
     @staticmethod
     def total() -> str:
         """Generates the SQL for the count of total records found.
@@ -1011,24 +1133,15 @@ class QueryBuilder(object):
         return ", COUNT(1) OVER() as found"
 
     def where(self) -> str:
-        """Introspects object ancestors and calls respective where() methods.
+        """Calls the where() methods of all ancestor classes.
 
         Returns:
             SQL string of all ancestor WHERE clauses.
         """
-        where = []
-        bases = self._bases()
-        for base in bases:
-            if callable(getattr(base, "where", None)):
-                setattr(
-                    self.query, "__column_map__", getattr(self, "__column_map__", {})
-                )
-                clause = base.where(self.query)
-                if clause:
-                    where.append(clause)
+        setattr(self.query, "__column_map__", getattr(self, "__column_map__", {}))
+        where = QueryPlan.run(self.plan.where, self.query)
         if len(where):
-            where = list(set(where))
-            where.sort()  # ensure the order is consistent for testing
+            where = sorted(set(where))  # ensure the order is consistent for testing
             return "WHERE " + ("\nAND ").join(where)
         else:
             return ""
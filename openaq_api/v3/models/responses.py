@@ -58,6 +58,20 @@ class Coverage(JsonBase):
     datetime_to: DatetimeObject | None = None
 
 
+class ChangesMeta(Meta):
+    # continuation token of the position after the last result, passed as
+    # `cursor` for the next page or the next sync
+    next: str | None = None
+
+
+class SeriesMeta(Meta):
+    # interval of the returned points when the whole range is returned with
+    # `fill` or `max_points`, e.g. "06:00:00"
+    resolution: str | None = None
+    # coverage of the requested period with `fill`
+    coverage: Coverage | None = None
+
+
 class Factor(JsonBase):
     label: str
     interval: str | None = None
@@ -74,6 +88,8 @@ class Summary(JsonBase):
     max: float | None = None
     avg: float | None = None
     sd: float | None = None
+    # normalized rank error of approximate quantiles
+    rank_error: float | None = None
 
 
 class CountryBase(JsonBase):
@@ -222,6 +238,10 @@ class Latest(LatestBase):
     locations_id: int
 
 
+class Change(Latest):
+    parameter: ParameterBase
+
+
 class Location(JsonBase):
     id: int
     name: str | None = None
@@ -290,6 +310,82 @@ class AnnualData(Measurement):
     value: float | None = None  # Nullable to deal with errors
 
 
+class SensorHourlyData(HourlyData):
+    sensors_id: int
+
+
+class SensorHourlySeries(JsonBase):
+    sensors_id: int
+    found: int
+    results: list[HourlyData]
+
+
+class DatetimeColumns(JsonBase):
+    utc: list[datetime]
+    local: list[datetime]
+
+
+class SensorColumn(JsonBase):
+    sensors_id: int
+    parameter: ParameterBase
+    values: list[float | None]
+
+
+# one timestamp column and one value column per sensor
+class LocationTimeSeries(JsonBase):
+    label: str
+    interval: str
+    datetime_from: DatetimeColumns
+    sensors: list[SensorColumn]
+
+
+class SummaryColumns(JsonBase):
+    avg: list[float | None]
+    sd: list[float | None]
+    min: list[float | None]
+    q02: list[float | None]
+    q25: list[float | None]
+    median: list[float | None]
+    q75: list[float | None]
+    q98: list[float | None]
+    max: list[float | None]
+
+
+class CoverageColumns(JsonBase):
+    observed_count: list[int | None]
+    percent_complete: list[float | None]
+    percent_coverage: list[float | None]
+
+
+# the periods of a sensor as parallel columns, the metadata only once
+class SensorTimeSeries(JsonBase):
+    label: str
+    interval: str
+    parameter: ParameterBase
+    datetime_from: DatetimeColumns
+    datetime_to: DatetimeColumns
+    values: list[float | None]
+    has_flags: list[bool | None]
+    coverage: CoverageColumns
+    summary: SummaryColumns | None = None
+
+
+# status of an export job of a sensor series
+class ExportJob(JsonBase):
+    id: str
+    status: str  # queued, running, complete or failed
+    format: str
+    sensors_id: int
+    datetime_from: datetime | date | None = None
+    datetime_to: datetime | date | None = None
+    rows: int | None = None
+    size: int | None = None  # bytes of the file
+    created: datetime
+    completed: datetime | None = None
+    download: str | None = None
+    error: str | None = None
+
+
 # Similar to measurement but without timestamps
 class Trend(JsonBase):
     factor: Factor
@@ -311,14 +407,17 @@ class LocationsResponse(OpenAQResult):
 
 
 class MeasurementsResponse(OpenAQResult):
+    meta: SeriesMeta = SeriesMeta()
     results: list[Measurement]
 
 
 class HourlyDataResponse(OpenAQResult):
+    meta: SeriesMeta = SeriesMeta()
     results: list[HourlyData]
 
 
 class DailyDataResponse(OpenAQResult):
+    meta: SeriesMeta = SeriesMeta()
     results: list[DailyData]
 
 
@@ -326,6 +425,19 @@ class AnnualDataResponse(OpenAQResult):
     results: list[AnnualData]
 
 
+class SensorsHourlyDataResponse(OpenAQResult):
+    results: list[SensorHourlySeries]
+
+
+class LocationTimeSeriesResponse(OpenAQResult):
+    results: list[LocationTimeSeries]
+
+
+class SensorTimeSeriesResponse(OpenAQResult):
+    meta: SeriesMeta = SeriesMeta()
+    results: list[SensorTimeSeries]
+
+
 class TrendsResponse(OpenAQResult):
     results: list[Trend]
 
@@ -364,3 +476,14 @@ class OwnersResponse(OpenAQResult):
 
 class LatestResponse(OpenAQResult):
     results: list[Latest]
+
+
+class ChangesResponse(OpenAQResult):
+    meta: ChangesMeta = ChangesMeta()
+    results: list[Change]
+    # the locations of the changed sensors
+    locations: list[Location] = []
+
+
+class ExportsResponse(OpenAQResult):
+    results: list[ExportJob]
@@ -0,0 +1,358 @@
+import functools
+import importlib.util
+import inspect
+import types
+import typing
+from collections.abc import AsyncIterator, Callable
+from datetime import date, datetime
+from typing import Any
+
+import orjson
+from fastapi.routing import APIRoute
+from pydantic import BaseModel, TypeAdapter
+from pydantic_core import PydanticUndefined
+from starlette.responses import Response
+
+from openaq_api.settings import settings
+
+Converter = Callable[[Any], Any] | None
+
+missing = object()
+
+_datetime = TypeAdapter(datetime)
+_date = TypeAdapter(date)
+
+
+def datetime_json(value: datetime | str) -> str:
+    # equal datetimes in other timezones are equal keys of the cache
+    offset = value.utcoffset() if isinstance(value, datetime) else None
+    return offset_datetime_json(value, offset)
+
+
+@functools.lru_cache(maxsize=65_536)
+def offset_datetime_json(value: datetime | str, offset) -> str:
+    return _datetime.dump_python(_datetime.validate_python(value), mode="json")
+
+
+@functools.lru_cache(maxsize=65_536)
+def date_json(value: date | str) -> str:
+    return _date.dump_python(_date.validate_python(value), mode="json")
+
+
+def to_float(value):
+    return value if value.__class__ is float else float(value)
+
+
+def to_any(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json", by_alias=True)
+    return value
+
+
+@functools.cache
+def adapter(annotation) -> TypeAdapter:
+    return TypeAdapter(annotation)
+
+
+def validated(annotation) -> Callable[[Any], Any]:
+    """Converts through pydantic, for types the serializers do not cover."""
+    type_adapter = adapter(annotation)
+
+    def convert(value):
+        return type_adapter.dump_python(
+            type_adapter.validate_python(value, from_attributes=True),
+            mode="json",
+            by_alias=True,
+        )
+
+    return convert
+
+
+def before_validators(model: type[BaseModel]) -> list | None:
+    """The `mode="before"` model validators of a model.
+
+    None if the model has any other validators or serializers, those are
+    converted through pydantic.
+    """
+    decorators = model.__pydantic_decorators__
+    if any(
+        (
+            decorators.validators,
+            decorators.field_validators,
+            decorators.root_validators,
+            decorators.field_serializers,
+            decorators.model_serializers,
+            decorators.computed_fields,
+        )
+    ):
+        return None
+    validators = []
+    for name, decorator in decorators.model_validators.items():
+        if decorator.info.mode != "before":
+            return None
+        validators.append(getattr(model, name))
+    return validators
+
+
+def converter(annotation) -> Converter:
+    """The converter of a value of the annotated type to its JSON value.
+
+    None means the value is passed through as it is.
+    """
+    origin = typing.get_origin(annotation)
+    if origin in (typing.Union, types.UnionType):
+        args = [a for a in typing.get_args(annotation) if a is not type(None)]
+        if len(args) == 1:
+            return converter(args[0])
+        if all(a in (int, str, bool) for a in args):
+            return None
+        return validated(annotation)
+    if origin in (list, typing.List):
+        (item,) = typing.get_args(annotation) or (Any,)
+        convert = converter(item)
+        if convert is None:
+            return None
+
+        def convert_list(values):
+            return [None if v is None else convert(v) for v in values]
+
+        return convert_list
+    if annotation is Any:
+        return to_any
+    if annotation is float:
+        return to_float
+    if annotation is datetime:
+        return datetime_json
+    if annotation is date:
+        return date_json
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return serializer(annotation)
+    if annotation in (int, str, bool):
+        return None
+    return validated(annotation)
+
+
+@functools.cache
+def serializer(model: type[BaseModel]) -> Callable[[Any], dict]:
+    """The conversion of trusted rows to the JSON of a model.
+
+    The rows are dicts, records or model instances with the field names
+    or aliases as keys. The output has the serialization aliases of every
+    field of the model, the same as validating the rows and dumping the
+    model by alias, but without building the model. The aliases, defaults
+    and converters of the fields are resolved once per model, models with
+    validators other than `mode="before"` model validators are converted
+    through pydantic.
+
+    Args:
+        model: the response model
+
+    Returns:
+        function converting a row to a JSON compatible dict
+    """
+    validators = before_validators(model)
+    if validators is None:
+        return validated(model)
+    fields = []
+    for name, field in model.model_fields.items():
+        alias = field.alias or name
+        default = None if field.default is PydanticUndefined else field.default
+        fields.append(
+            (
+                name,
+                alias if alias != name else None,
+                field.serialization_alias or alias,
+                field.default_factory,
+                default,
+                converter(field.annotation),
+            )
+        )
+
+    def convert(row):
+        for validator in validators:
+            row = validator(row)
+        if row.__class__ is not dict and isinstance(row, BaseModel):
+            row = row.__dict__
+        get = row.get
+        output = {}
+        for name, alias, key, default_factory, default, convert_value in fields:
+            value = get(name, missing)
+            if value is missing and alias is not None:
+                value = get(alias, missing)
+            if value is missing:
+                value = default if default_factory is None else default_factory()
+            if value is not None and convert_value is not None:
+                value = convert_value(value)
+            output[key] = value
+        return output
+
+    return convert
+
+
+def serialize(model: type[BaseModel], content: Any) -> bytes:
+    """Encodes trusted content as the JSON of a response model."""
+    return orjson.dumps(serializer(model)(content))
+
+
+def json_response(
+    model: type[BaseModel], content: Any, status_code: int = 200
+) -> Response:
+    """Response with the content validated and encoded as the JSON of a
+    response model, for endpoints that build their own response."""
+    if isinstance(content, BaseModel):
+        # instances of the model itself are not validated again by pydantic,
+        # e.g. one made with `model_construct`
+        content = dict(content)
+    type_adapter = adapter(model)
+    body = type_adapter.dump_json(
+        type_adapter.validate_python(content, from_attributes=True), by_alias=True
+    )
+    return Response(body, status_code=status_code, media_type="application/json")
+
+
+def trusted_response(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+    """Marks the endpoint of a `TrustedRoute` to be encoded with `serialize`.
+
+    Used on every measurement series endpoint, i.e. every endpoint with a
+    response model in `routers/measurements.py`, as they return the largest
+    pages. The results of any other endpoint are validated against the
+    response model.
+    """
+    endpoint.trusted_response = True
+    return endpoint
+
+
+class TrustedRoute(APIRoute):
+    """Route that encodes the responses of `trusted_response` endpoints with
+    `serialize`.
+
+    The results come from our own queries so the response model is only
+    used to name and order the fields, it is not validated again. Setting
+    VALIDATE_RESPONSES validates every response against its model instead.
+    Other endpoints are routed as usual.
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs):
+        model = kwargs.get("response_model")
+        if (
+            getattr(endpoint, "trusted_response", False)
+            and isinstance(model, type)
+            and issubclass(model, BaseModel)
+            and inspect.iscoroutinefunction(endpoint)
+        ):
+            endpoint = trusted(endpoint, model, kwargs.get("status_code") or 200)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def trusted(endpoint, model: type[BaseModel], status_code: int):
+    @functools.wraps(endpoint)
+    async def trusted_endpoint(*args, **kwargs):
+        content = await endpoint(*args, **kwargs)
+        if settings.VALIDATE_RESPONSES or isinstance(content, Response):
+            return content
+        return Response(
+            serialize(model, content),
+            status_code=status_code,
+            media_type="application/json",
+        )
+
+    return trusted_endpoint
+
+
+arrow_media_type = "application/vnd.apache.arrow.stream"
+parquet_media_type = "application/vnd.apache.parquet"
+# file extensions of the table formats
+table_media_types = {arrow_media_type: "arrows", parquet_media_type: "parquet"}
+
+# documents the table formats of an endpoint in the OpenAPI schema
+table_responses = {
+    200: {"content": {media_type: {} for media_type in table_media_types}}
+}
+
+
+def table_media_type(accept: str | None) -> str | None:
+    """The table format an Accept header asks for, None for JSON.
+
+    The first of JSON and the table formats listed in the header wins.
+    """
+    for media_range in (accept or "").split(","):
+        media_type = media_range.split(";")[0].strip().lower()
+        if media_type in table_media_types:
+            return media_type
+        if media_type == "application/json":
+            return None
+    return None
+
+
+@functools.cache
+def pyarrow_installed() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+class ChunkSink:
+    """Write only file object collecting the bytes of a pyarrow writer."""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+async def table_stream(
+    batches: AsyncIterator[dict[str, list]],
+    columns: dict[str, str],
+    media_type: str,
+    tz: str = "UTC",
+) -> AsyncIterator[bytes]:
+    """Encodes batches of columns as an Arrow IPC stream or a Parquet file.
+
+    Every batch is written as a record batch, or a row group for Parquet,
+    and its bytes are yielded as soon as it is written.
+
+    Args:
+        batches: dicts of the column values by column name
+        columns: kind of each column, one of int, float, bool, timestamp
+            and date
+        media_type: one of the `table_media_types`
+        tz: timezone of the timestamp columns
+
+    Yields:
+        the encoded bytes
+    """
+    import pyarrow as pa
+
+    types = {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "timestamp": pa.timestamp("us", tz=tz),
+        "date": pa.date32(),
+    }
+    schema = pa.schema([(name, types[kind]) for name, kind in columns.items()])
+    sink = ChunkSink()
+    if media_type == parquet_media_type:
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    else:
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+    try:
+        async for batch in batches:
+            arrays = [pa.array(batch[field.name], type=field.type) for field in schema]
+            writer.write_batch(pa.record_batch(arrays, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
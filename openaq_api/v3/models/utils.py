@@ -1,3 +1,6 @@
+import math
+import struct
+
 from dateutil.parser import parse
 from dateutil.tz import UTC
 from datetime import date, datetime
@@ -19,3 +22,214 @@ def fix_date(
         d = d.date()
 
     return d
+
+
+def group_summaries(keys, values, fractions=(0.02, 0.25, 0.5, 0.75, 0.98)) -> dict:
+    """Summarizes values by group with NumPy, the same as the SQL aggregates.
+
+    The avg and sd are AVG and STDDEV, the percentiles PERCENTILE_CONT
+    and n counts every row like COUNT(1). Missing values are NaN and only
+    counted in n.
+
+    Args:
+        keys: int array of the group of each row
+        values: float array of the values of each row
+        fractions: the percentiles to calculate
+
+    Returns:
+        dict of arrays with one item per group in the order of the keys,
+        `first` and `last` are the indexes of the first and last rows of
+        each group.
+    """
+    import numpy as np
+
+    def runs(sorted_keys):
+        starts = np.flatnonzero(np.diff(sorted_keys, prepend=sorted_keys[:1] - 1))
+        counts = np.diff(starts, append=len(sorted_keys))
+        return sorted_keys[starts], starts, counts
+
+    order = np.argsort(keys, kind="stable")
+    key, starts, n = runs(keys[order])
+    summaries = {
+        "key": key,
+        "first": order[starts],
+        "last": order[starts + n - 1],
+        "n": n,
+    }
+    valid = ~np.isnan(values)
+    valid_keys, valid_values = keys[valid], values[valid]
+    # sorted by value and then stable by key, faster than np.lexsort
+    order = np.argsort(valid_values)
+    order = order[np.argsort(valid_keys[order], kind="stable")]
+    valid_keys, valid_values = valid_keys[order], valid_values[order]
+    groups, starts, counts = runs(valid_keys)
+    ends = starts + counts - 1
+    columns = {}
+    if len(valid_values):
+        avg = np.add.reduceat(valid_values, starts) / counts
+        deviations = valid_values - np.repeat(avg, counts)
+        squares = np.add.reduceat(deviations * deviations, starts)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sd = np.where(counts > 1, np.sqrt(squares / (counts - 1)), np.nan)
+        columns = {
+            "avg": avg,
+            "sd": sd,
+            "min": valid_values[starts],
+            "max": valid_values[ends],
+        }
+        for fraction in fractions:
+            position = fraction * (counts - 1)
+            lower = np.floor(position).astype(np.int64)
+            below = valid_values[starts + lower]
+            above = valid_values[np.minimum(starts + lower + 1, ends)]
+            columns[fraction] = below + (position - lower) * (above - below)
+    slots = np.searchsorted(key, groups)
+    for column in ("avg", "sd", "min", "max", *fractions):
+        summaries[column] = np.full(len(key), np.nan)
+        if columns:
+            summaries[column][slots] = columns[column]
+    return summaries
+
+
+def nullable(values) -> list:
+    """List of a float array with None for NaN."""
+    return [None if math.isnan(v) else v for v in values.tolist()]
+
+
+def bucket_extremes(buckets, values):
+    """Indexes of the rows with the lowest and highest value of each bucket.
+
+    Keeping both extremes of every bucket thins a series without losing its
+    peaks. Missing values are NaN and never selected, ties keep the first
+    row for the lowest value and the last row for the highest.
+
+    Args:
+        buckets: int array of the bucket of each row
+        values: float array of the values of each row
+
+    Returns:
+        sorted int array of the selected row indexes, one or two per bucket
+        with any values
+    """
+    import numpy as np
+
+    valid = np.flatnonzero(~np.isnan(values))
+    if not len(valid):
+        return valid
+    # sorted by value and then stable by bucket, see `group_summaries`
+    order = valid[np.argsort(values[valid], kind="stable")]
+    order = order[np.argsort(buckets[order], kind="stable")]
+    sorted_buckets = buckets[order]
+    starts = np.flatnonzero(np.diff(sorted_buckets, prepend=sorted_buckets[:1] - 1))
+    ends = np.append(starts[1:], len(order)) - 1
+    return np.unique(np.concatenate((order[starts], order[ends])))
+
+
+def grid_reindex(slots, values, size: int, interpolate: bool = False):
+    """Reindexes rows onto a regular grid with NumPy.
+
+    Args:
+        slots: int array of the grid slot of each row, within the grid
+        values: float array of the values of each row, missing values are NaN
+        size: number of slots of the grid
+        interpolate: fill the empty slots between the first and the last
+            value linearly, the slots outside stay NaN
+
+    Returns:
+        tuple of an int array of the row in each slot, -1 for empty slots,
+        and a float array of the value in each slot
+    """
+    import numpy as np
+
+    rows = np.full(size, -1, dtype=np.int64)
+    rows[slots] = np.arange(len(slots))
+    grid = np.full(size, np.nan)
+    grid[slots] = values
+    if interpolate:
+        known = np.flatnonzero(~np.isnan(grid))
+        if len(known):
+            empty = np.flatnonzero(rows < 0)
+            empty = empty[(empty > known[0]) & (empty < known[-1])]
+            grid[empty] = np.interp(empty, known, grid[known])
+    return rows, grid
+
+
+# WGS 84, the spheroid of PostGIS geography
+wgs84_a = 6378137.0
+wgs84_f = 1 / 298.257223563
+wgs84_b = wgs84_a * (1 - wgs84_f)
+
+
+def geodesic_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distance in meters between two points on the WGS 84 spheroid.
+
+    Vincenty's inverse formula, within a fraction of a millimeter of
+    `ST_Distance` on geography which measures on the same spheroid. A
+    sphere (haversine) is off by up to half a percent.
+    """
+    if lat1 == lat2 and lon1 == lon2:
+        return 0.0
+    f = wgs84_f
+    u1 = math.atan((1 - f) * math.tan(math.radians(lat1)))
+    u2 = math.atan((1 - f) * math.tan(math.radians(lat2)))
+    sin_u1, cos_u1 = math.sin(u1), math.cos(u1)
+    sin_u2, cos_u2 = math.sin(u2), math.cos(u2)
+    delta = math.radians(lon2 - lon1)
+    lam = delta
+    for _ in range(200):
+        sin_lam, cos_lam = math.sin(lam), math.cos(lam)
+        sin_sigma = math.hypot(
+            cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam
+        )
+        if sin_sigma == 0:
+            return 0.0
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = math.atan2(sin_sigma, cos_sigma)
+        sin_alpha = cos_u1 * cos_u2 * sin_lam / sin_sigma
+        cos2_alpha = 1 - sin_alpha**2
+        # zero on the equator
+        cos_2sm = cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha if cos2_alpha else 0.0
+        c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        previous = lam
+        lam = delta + (1 - c) * f * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sm + c * cos_sigma * (2 * cos_2sm**2 - 1))
+        )
+        if abs(lam - previous) < 1e-12:
+            break
+    u_2 = cos2_alpha * (wgs84_a**2 - wgs84_b**2) / wgs84_b**2
+    a = 1 + u_2 / 16384 * (4096 + u_2 * (-768 + u_2 * (320 - 175 * u_2)))
+    b = u_2 / 1024 * (256 + u_2 * (-128 + u_2 * (74 - 47 * u_2)))
+    term = cos_sigma * (2 * cos_2sm**2 - 1)
+    term -= b / 6 * cos_2sm * (4 * sin_sigma**2 - 3) * (4 * cos_2sm**2 - 3)
+    delta_sigma = b * sin_sigma * (cos_2sm + b / 4 * term)
+    return wgs84_b * a * (sigma - delta_sigma)
+
+
+def float4(value: float) -> float:
+    """A value rounded to single precision."""
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+def float4_next(value: float, up: bool) -> float:
+    """The single precision float next to a single precision value."""
+    if value == 0:
+        return 1.401298464324817e-45 if up else -1.401298464324817e-45
+    (bits,) = struct.unpack("I", struct.pack("f", value))
+    bits += 1 if (value > 0) == up else -1
+    return struct.unpack("f", struct.pack("I", bits))[0]
+
+
+def float4_down(value: float) -> float:
+    """The largest single precision float not above a value.
+
+    PostGIS compares boxes with `&&` in single precision, rounded outwards
+    so that a box always contains its geometry.
+    """
+    rounded = float4(value)
+    return rounded if rounded <= value else float4_next(rounded, up=False)
+
+
+def float4_up(value: float) -> float:
+    """The smallest single precision float not below a value."""
+    rounded = float4(value)
+    return rounded if rounded >= value else float4_next(rounded, up=True)
@@ -0,0 +1,218 @@
+import base64
+import binascii
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Annotated, Any
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.exceptions import RequestValidationError
+from pydantic import model_validator
+
+from openaq_api.db import DB
+from openaq_api.settings import settings
+from openaq_api.v3.models.queries import QueryBaseModel, QueryBuilder
+from openaq_api.v3.models.responses import ChangesMeta, ChangesResponse
+from openaq_api.v3.models.serializers import json_response
+from openaq_api.v3.routers.locations import locations_sql
+
+logger = logging.getLogger("changes")
+
+router = APIRouter(
+    prefix="/v3",
+    tags=["v3"],
+    include_in_schema=True,
+)
+
+
+def encode_cursor(dt: datetime, sensors_id: int) -> str:
+    """Opaque continuation token of a position in the change feed."""
+    token = orjson.dumps([dt.isoformat(), sensors_id])
+    return base64.urlsafe_b64encode(token).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """The datetime and sensors id of a continuation token.
+
+    Raises:
+        ValueError: if the token is not one of `encode_cursor`
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        dt, sensors_id = orjson.loads(base64.urlsafe_b64decode(padded))
+        dt = datetime.fromisoformat(dt)
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+    if dt.tzinfo is None or not isinstance(sensors_id, int):
+        raise ValueError("Invalid cursor")
+    return dt, sensors_id
+
+
+class ChangesQueries(QueryBaseModel):
+    """Pydantic query model for the change feed.
+
+    Inherits from QueryBaseModel
+
+    Attributes:
+        since: datetime to return the changes after, for the first sync
+        cursor: continuation token from `meta.next` of a previous response
+        limit: maximum number of changed sensors to return
+    """
+
+    since: datetime | None = Query(
+        None,
+        description="""Return the sensors updated after this datetime, for the
+        first sync. Datetimes without a timezone are UTC""",
+        examples=["2024-01-01T00:00:00Z"],
+    )
+    cursor: str | None = Query(
+        None,
+        description="""Continuation token from `meta.next` of a previous
+        response, to get the next page or the changes since the last sync.
+        The token of a sync that is caught up trails its last result, the
+        sensors updated within the overlap are returned again""",
+        max_length=200,
+    )
+    limit: int = Query(
+        1000,
+        gt=0,
+        le=10_000,
+        description="Change the number of changed sensors returned",
+        examples=["1000"],
+    )
+
+    @model_validator(mode="after")
+    @classmethod
+    def check_since_or_cursor(cls, data: Any) -> Any:
+        if (data.since is None) == (data.cursor is None):
+            raise RequestValidationError("Either since or cursor is required")
+        return data
+
+    def position(self) -> tuple[datetime, int]:
+        """The position to return the changes after.
+
+        Raises:
+            ValueError: if `cursor` is not a continuation token
+        """
+        if self.cursor is not None:
+            return decode_cursor(self.cursor)
+        since = self.since
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return since, 0
+
+
+class LocationsIdsQuery(QueryBaseModel):
+    locations_id: list[int]
+
+    def where(self) -> str:
+        return "id = ANY(:locations_id)"
+
+
+# keyset on the rollup datetime and the sensors id, sensors updated at the
+# same time are neither repeated nor skipped between pages. Between syncs the
+# keyset trails by CHANGES_OVERLAP_SECONDS, see `fetch_changes`
+changes_sql = """
+SELECT
+  s.sensors_id
+  ,n.sensor_nodes_id AS locations_id
+  ,json_build_object(
+    'id', m.measurands_id
+    , 'name', m.measurand
+    , 'units', m.units
+    , 'display_name', m.display
+  ) AS parameter
+  ,get_datetime_object(r.datetime_last, t.tzid) AS datetime
+  ,r.value_latest AS value
+  ,json_build_object(
+    'latitude', st_y(COALESCE(r.geom_latest, n.geom))
+    ,'longitude', st_x(COALESCE(r.geom_latest, n.geom))
+  ) AS coordinates
+  ,r.datetime_last
+FROM
+    sensors s
+JOIN
+    sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+JOIN
+    sensor_nodes n ON (sy.sensor_nodes_id = n.sensor_nodes_id)
+JOIN
+    timezones t ON (n.timezones_id = t.timezones_id)
+JOIN
+    measurands m ON (s.measurands_id = m.measurands_id)
+INNER JOIN
+    sensors_rollup r ON (s.sensors_id = r.sensors_id)
+WHERE (r.datetime_last, s.sensors_id) > (:after, :after_sensors_id)
+AND n.is_public AND s.is_public
+ORDER BY r.datetime_last, s.sensors_id
+LIMIT :limit
+"""
+
+
+@router.get(
+    "/changes",
+    response_model=ChangesResponse,
+    summary="Get the sensors updated since a previous sync",
+    description="Provides the latest values of the sensors updated after a \
+        datetime or a continuation token, ordered by update, with their \
+        locations. Fewer results than the limit means the feed is caught up, \
+        keep `meta.next` as the cursor of the next sync. Sensors updated \
+        shortly before the end of a sync are returned again by the next one, \
+        so that late uploads are not missed.",
+)
+async def changes_get(
+    changes: Annotated[ChangesQueries, Depends(ChangesQueries.depends())],
+    db: DB = Depends(),
+):
+    response = await fetch_changes(changes, db)
+    response = json_response(ChangesResponse, response)
+    # the last page grows until the next sync
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+async def fetch_changes(query: ChangesQueries, db: DB) -> ChangesResponse:
+    """Fetches a page of the change feed and the locations of its sensors.
+
+    Both queries are streamed, i.e. not cached, a repeated sync has to see
+    the changes made in the meantime.
+
+    Sensors of providers that upload with a lag get a datetime_last before
+    the position of a caught up sync. The cursor of a page with fewer
+    results than the limit therefore trails its last result by
+    CHANGES_OVERLAP_SECONDS, the same as the polls of the latest store, and
+    the sensors updated within the overlap are returned again. Full pages
+    continue exactly after their last result.
+    """
+    try:
+        after, after_sensors_id = query.position()
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    params = {
+        "after": after,
+        "after_sensors_id": after_sensors_id,
+        "limit": query.limit,
+    }
+    rows = [row async for row in db.stream(changes_sql, params)]
+    if len(rows) == query.limit:
+        last = rows[-1]
+        cursor = encode_cursor(last["datetime_last"], last["sensors_id"])
+    elif rows:
+        overlap = timedelta(seconds=settings.CHANGES_OVERLAP_SECONDS)
+        cursor = encode_cursor(rows[-1]["datetime_last"] - overlap, 0)
+    else:
+        cursor = encode_cursor(after, after_sensors_id)
+    locations = []
+    locations_id = sorted({row["locations_id"] for row in rows})
+    if locations_id:
+        query_builder = QueryBuilder(LocationsIdsQuery(locations_id=locations_id))
+        locations = [
+            row
+            async for row in db.stream(
+                locations_sql(query_builder), query_builder.params()
+            )
+        ]
+    return ChangesResponse.model_construct(
+        meta=ChangesMeta(limit=query.limit, found=len(rows), next=cursor),
+        results=rows,
+        locations=locations,
+    )
@@ -12,6 +12,7 @@ from openaq_api.v3.models.queries import (
     QueryBaseModel,
     QueryBuilder,
     SortingBase,
+    sql_template,
 )
 from openaq_api.v3.models.responses import CountriesResponse
 
@@ -94,9 +95,9 @@ async def countries_get(
     return response
 
 
-async def fetch_countries(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
+@sql_template
+def countries_sql(query_builder: QueryBuilder) -> str:
+    return f"""
     SELECT id
     , code
     , name
@@ -108,5 +109,9 @@ async def fetch_countries(query, db):
     {query_builder.where()}
     {query_builder.pagination()}
     """
-    response = await db.fetchPage(sql, query_builder.params())
+
+
+async def fetch_countries(query, db):
+    query_builder = QueryBuilder(query)
+    response = await db.fetchPage(countries_sql(query_builder), query_builder.params())
     return response
@@ -0,0 +1,300 @@
+import asyncio
+import gzip
+import logging
+import os
+import tempfile
+import uuid
+from datetime import datetime, timezone
+from enum import StrEnum, auto
+from typing import Annotated
+
+import orjson
+from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from starlette.responses import Response
+
+from openaq_api.db import DB
+from openaq_api.exports import export_store
+from openaq_api.settings import settings
+from openaq_api.v3.models.queries import QueryBaseModel
+from openaq_api.v3.models.responses import ExportsResponse, OpenAQResult
+from openaq_api.v3.models.serializers import (
+    json_response,
+    parquet_media_type,
+    pyarrow_installed,
+    table_stream,
+)
+from openaq_api.v3.routers.measurements import (
+    BaseDatetimeQueries,
+    measurements_sql,
+    sensor_metadata,
+    series_columns,
+    series_names,
+    series_table,
+)
+
+logger = logging.getLogger("exports")
+
+router = APIRouter(
+    prefix="/v3",
+    tags=["v3"],
+    include_in_schema=True,
+)
+
+
+class ExportFormat(StrEnum):
+    ndjson = auto()
+    parquet = auto()
+
+
+# media types and file extensions of the export formats
+export_files = {
+    ExportFormat.ndjson: ("application/gzip", "ndjson.gz"),
+    ExportFormat.parquet: (parquet_media_type, "parquet"),
+}
+
+
+class ExportFormatQuery(QueryBaseModel):
+    format: ExportFormat = Query(
+        ExportFormat.ndjson,
+        description="""Format of the export file, gzip compressed
+        newline delimited JSON or Parquet""",
+        examples=["parquet"],
+    )
+
+
+class MeasurementsExportQueries(ExportFormatQuery, BaseDatetimeQueries): ...
+
+
+class ExportPathQuery(QueryBaseModel):
+    exports_id: str = Path(
+        ..., description="The id of the export", pattern="^[0-9a-f]{32}$"
+    )
+
+
+# the running and queued exports of this instance, at most
+# EXPORT_CONCURRENCY of them run at a time. Jobs only run as long as the
+# instance does, their heartbeat in the store tells when it is gone.
+export_tasks = set()
+export_slots = asyncio.Semaphore(settings.EXPORT_CONCURRENCY)
+
+
+def status_key(exports_id: str) -> str:
+    return f"{exports_id}/status.json"
+
+
+def file_key(job: dict) -> str:
+    return f"{job['id']}/{export_filename(job)}"
+
+
+def export_filename(job: dict) -> str:
+    _, extension = export_files[job["format"]]
+    return f"sensor-{job['sensors_id']}-{series_names['measurements']}.{extension}"
+
+
+def utcnow() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def stale(job: dict) -> bool:
+    """Whether an unfinished job has missed its heartbeats for
+    `EXPORT_STALE_SECONDS`, i.e. the instance running it is gone."""
+    if job["status"] not in ("queued", "running"):
+        return False
+    heartbeat = datetime.fromisoformat(job.get("heartbeat") or job["created"])
+    age = datetime.now(timezone.utc) - heartbeat
+    return age.total_seconds() > settings.EXPORT_STALE_SECONDS
+
+
+async def export_job(exports_id: str) -> dict:
+    """The status of an export, stale jobs are marked as failed.
+
+    Raises:
+        HTTPException: if there is no such export
+    """
+    store = export_store()
+    job = await store.get_json(status_key(exports_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Export not found")
+    if stale(job):
+        job.update(status="failed", error="Export was interrupted, start it again")
+        await store.put_json(status_key(exports_id), job)
+    return job
+
+
+@router.post(
+    "/sensors/{sensors_id}/measurements/exports",
+    response_model=ExportsResponse,
+    status_code=202,
+    summary="Export measurements by sensor ID",
+    description="Starts an export of all the measurements of a sensor in the \
+        requested range to a file, for ranges too large to page through. \
+        Poll `/v3/exports/{exports_id}` until the export is complete and \
+        download the file from `/v3/exports/{exports_id}/download`, which \
+        supports Range requests.",
+)
+async def sensor_measurements_export_post(
+    sensors: Annotated[
+        MeasurementsExportQueries, Depends(MeasurementsExportQueries.depends())
+    ],
+    db: DB = Depends(),
+):
+    if sensors.format == ExportFormat.parquet and not pyarrow_installed():
+        raise HTTPException(
+            status_code=406, detail="Parquet exports are not available, use ndjson"
+        )
+    if len(export_tasks) >= settings.EXPORT_MAX_JOBS:
+        raise HTTPException(
+            status_code=429, detail="Too many exports running, try again later"
+        )
+    metadata = await sensor_metadata(sensors.sensors_id, db)
+    if metadata is None:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    job = {
+        "id": uuid.uuid4().hex,
+        "status": "queued",
+        "format": sensors.format,
+        "sensors_id": sensors.sensors_id,
+        "datetime_from": sensors.datetime_from,
+        "datetime_to": sensors.datetime_to,
+        "created": utcnow(),
+        "heartbeat": utcnow(),
+    }
+    await export_store().put_json(status_key(job["id"]), job)
+    task = asyncio.create_task(run_export(job, sensors, metadata, db))
+    export_tasks.add(task)
+    task.add_done_callback(export_tasks.discard)
+    return OpenAQResult(results=[job])
+
+
+@router.get(
+    "/exports/{exports_id}",
+    response_model=ExportsResponse,
+    summary="Get an export by ID",
+    description="Provides the status of an export",
+)
+async def export_get(
+    exports: Annotated[ExportPathQuery, Depends(ExportPathQuery.depends())],
+):
+    job = await export_job(exports.exports_id)
+    response = json_response(ExportsResponse, OpenAQResult(results=[job]))
+    # the status changes until the export is done
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+@router.get(
+    "/exports/{exports_id}/download",
+    summary="Download an export by ID",
+    description="Provides the file of a complete export, supports Range requests",
+    include_in_schema=True,
+)
+async def export_download_get(
+    exports: Annotated[ExportPathQuery, Depends(ExportPathQuery.depends())],
+) -> Response:
+    job = await export_job(exports.exports_id)
+    if job["status"] != "complete":
+        raise HTTPException(status_code=409, detail=f"Export is {job['status']}")
+    media_type, _ = export_files[job["format"]]
+    return await export_store().download(
+        file_key(job), export_filename(job), media_type
+    )
+
+
+async def run_export(job: dict, queries, metadata, db):
+    """Writes an export to a local file and moves it to the export store.
+
+    Waits for one of the `export_slots` and reads on the export pool, the
+    status in the store is updated when the export starts and ends and
+    every `EXPORT_HEARTBEAT_SECONDS` in between. Exports need an instance
+    that keeps running after the response, e.g. a container; where it is
+    frozen or stopped, as on Lambda, the jobs are failed once their
+    heartbeat is stale.
+    """
+    store = export_store()
+    lock = asyncio.Lock()
+    done = asyncio.Event()
+
+    async def save():
+        async with lock:
+            job["heartbeat"] = utcnow()
+            await store.put_json(status_key(job["id"]), job)
+
+    async def heartbeat():
+        while not done.is_set():
+            try:
+                await asyncio.wait_for(done.wait(), settings.EXPORT_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                await save()
+
+    beating = asyncio.create_task(heartbeat())
+    try:
+        async with export_slots:
+            job.update(status="running")
+            await save()
+            fd, path = tempfile.mkstemp(prefix=f"export-{job['id']}-")
+            os.close(fd)
+            try:
+                batches = await series_table(
+                    queries, "measurements", measurements_sql, metadata, db, export=True
+                )
+                job["rows"] = await write_export(
+                    batches, path, job["format"], metadata.timezone
+                )
+                job["size"] = await store.put(file_key(job), path)
+                job.update(
+                    status="complete",
+                    completed=utcnow(),
+                    download=f"/v3/exports/{job['id']}/download",
+                )
+            except Exception as e:
+                logger.error(f"Export {job['id']} failed: {e}")
+                job.update(status="failed", error=str(getattr(e, "detail", e)))
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+    finally:
+        # the last heartbeat is written before the final status
+        done.set()
+        await beating
+    await save()
+
+
+async def write_export(batches, path: str, format: str, tz: str) -> int:
+    """Writes batches of columns to a file in an `ExportFormat`.
+
+    The writes and the compression run in a thread so that exports do not
+    hold up the event loop.
+
+    Returns:
+        the number of rows written
+    """
+    rows = 0
+
+    async def counted():
+        nonlocal rows
+        async for batch in batches:
+            rows += len(batch["value"])
+            yield batch
+
+    if format == ExportFormat.parquet:
+        file = await asyncio.to_thread(open, path, "wb")
+        try:
+            columns = series_columns("measurements")
+            async for chunk in table_stream(counted(), columns, parquet_media_type, tz):
+                await asyncio.to_thread(file.write, chunk)
+        finally:
+            await asyncio.to_thread(file.close)
+        return rows
+    file = await asyncio.to_thread(gzip.open, path, "wb")
+    try:
+        async for batch in counted():
+            names = list(batch)
+            lines = b"".join(
+                orjson.dumps(dict(zip(names, values))) + b"\n"
+                for values in zip(*batch.values())
+            )
+            await asyncio.to_thread(file.write, lines)
+    finally:
+        # flushes the end of the gzip stream
+        await asyncio.to_thread(file.close)
+    return rows
@@ -12,6 +12,7 @@ from openaq_api.v3.models.queries import (
     Paging,
     QueryBaseModel,
     QueryBuilder,
+    sql_template,
 )
 
 from openaq_api.v3.models.responses import (
@@ -113,11 +114,9 @@ async def sensor_flags_get(
     return await fetch_flags(sensor_flags, db)
 
 
-async def fetch_flags(q, db):
-    query = QueryBuilder(q)
-    query.set_column_map({"timezone": "tz.tzid", "datetime": "lower(period)"})
-
-    sql = f"""
+@sql_template
+def flags_sql(query: QueryBuilder) -> str:
+    return f"""
     SELECT f.sensor_nodes_id as location_id
     , json_build_object('id', ft.flag_types_id, 'label', ft.label, 'level', ft.flag_level) as flag_type
     , sensors_ids
@@ -130,4 +129,9 @@ async def fetch_flags(q, db):
     JOIN timezones t ON (n.timezones_id = t.timezones_id)
     {query.where()}
     """
-    return await db.fetchPage(sql, query.params())
+
+
+async def fetch_flags(q, db):
+    query = QueryBuilder(q)
+    query.set_column_map({"timezone": "tz.tzid", "datetime": "lower(period)"})
+    return await db.fetchPage(flags_sql(query), query.params())
@@ -10,6 +10,7 @@ from openaq_api.v3.models.queries import (
     QueryBaseModel,
     QueryBuilder,
     SortingBase,
+    sql_template,
 )
 from openaq_api.v3.models.responses import InstrumentsResponse
 
@@ -125,9 +126,9 @@ async def get_instruments_by_manufacturer(
     return response
 
 
-async def fetch_instruments(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
+@sql_template
+def instruments_sql(query_builder: QueryBuilder) -> str:
+    return f"""
         WITH locations_summary AS (
             SELECT
                 i.instruments_id
@@ -160,5 +161,11 @@ async def fetch_instruments(query, db):
 
         """
 
-    response = await db.fetchPage(sql, query_builder.params())
+
+async def fetch_instruments(query, db):
+    query_builder = QueryBuilder(query)
+
+    response = await db.fetchPage(
+        instruments_sql(query_builder), query_builder.params()
+    )
     return response
@@ -1,14 +1,38 @@
-from datetime import date, datetime
+import asyncio
+import functools
 import logging
-from typing import Annotated
+import math
+import time as time_module
+from array import array
+from datetime import date, datetime, time, timezone
+from typing import Annotated, Any, AsyncIterator
+from zoneinfo import ZoneInfo
 
 from fastapi import APIRouter, Depends, HTTPException, Path, Query
+from fastapi.exceptions import RequestValidationError
+from pydantic import model_validator
+from starlette.responses import StreamingResponse
 
 from openaq_api.db import DB
+from openaq_api.settings import settings
 from openaq_api.v3.routers.locations import LocationPathQuery, fetch_locations
 from openaq_api.v3.routers.parameters import fetch_parameters
-from openaq_api.v3.models.queries import QueryBaseModel, QueryBuilder, Paging
-from openaq_api.v3.models.responses import LatestResponse
+from openaq_api.v3.models.queries import (
+    BboxQuery,
+    CommaSeparatedList,
+    QueryBaseModel,
+    QueryBuilder,
+    Paging,
+    sql_template,
+)
+from openaq_api.v3.models.responses import (
+    Latest,
+    LatestResponse,
+    Meta,
+    OpenAQResult,
+)
+from openaq_api.v3.models.serializers import serialize
+from openaq_api.v3.routers.measurements import datetime_object
 
 logger = logging.getLogger("latest")
 
@@ -155,9 +179,69 @@ async def location_latest_get(
     return response
 
 
-async def fetch_latest(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
+max_bulk_locations = 100
+
+
+class LocationsIdsLatestQuery(QueryBaseModel):
+    """Query to filter results by a list of locations IDs.
+
+    Inherits from QueryBaseModel.
+
+    Attributes:
+        locations_id: comma separated list of locations ID values.
+    """
+
+    locations_id: CommaSeparatedList[int] | None = Query(
+        None,
+        description=f"Comma separated list of up to {max_bulk_locations} locations ids",
+        examples=["1,2,3"],
+    )
+
+    def where(self) -> str | None:
+        """Generates SQL condition for filtering to the locations_id
+
+        Overrides the base QueryBaseModel `where` method
+
+        Returns:
+            string of WHERE clause if `locations_id` is set
+        """
+        if self.has("locations_id"):
+            return "n.sensor_nodes_id = ANY(:locations_id)"
+
+
+class LatestQueries(LocationsIdsLatestQuery, BboxQuery, DatetimeMinQuery, Paging):
+    @model_validator(mode="after")
+    @classmethod
+    def check_locations(cls, data: Any) -> Any:
+        if data.locations_id is None and data.bbox is None:
+            raise RequestValidationError("Either locations_id or bbox is required")
+        if (
+            data.locations_id is not None
+            and len(data.locations_id) > max_bulk_locations
+        ):
+            raise RequestValidationError(
+                f"A maximum of {max_bulk_locations} locations can be requested at once. User passed {len(data.locations_id)}"
+            )
+        return data
+
+
+@router.get(
+    "/latest",
+    response_model=LatestResponse,
+    summary="Get the latest measurements of many locations",
+    description="Provides the latest measurement values of a list of locations \
+        or of the locations in a bounding box in one request",
+)
+async def latest_get(
+    latest: Annotated[LatestQueries, Depends(LatestQueries.depends())],
+    db: DB = Depends(),
+):
+    return await fetch_latest(latest, db)
+
+
+@sql_template
+def latest_sql(query_builder: QueryBuilder) -> str:
+    return f"""
     SELECT
       n.sensor_nodes_id AS locations_id
       ,s.sensors_id AS sensors_id
@@ -183,5 +267,565 @@ async def fetch_latest(query, db):
     {query_builder.where()}
     {query_builder.pagination()}
     """
-    response = await db.fetchPage(sql, query_builder.params())
-    return response
+
+
+@functools.cache
+def latest_store_sql(incremental: bool) -> str:
+    """The latest value of every sensor for the `LatestStore`, or with
+    `incremental` of the sensors updated after `:watermark`."""
+    where = "WHERE r.datetime_last > :watermark" if incremental else ""
+    return f"""
+    SELECT
+      s.sensors_id
+      ,n.sensor_nodes_id AS locations_id
+      ,s.measurands_id
+      ,t.tzid
+      ,r.datetime_last
+      ,r.value_latest AS value
+      ,st_y(COALESCE(r.geom_latest, n.geom)) AS latitude
+      ,st_x(COALESCE(r.geom_latest, n.geom)) AS longitude
+    FROM
+        sensors s
+    JOIN
+        sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+    JOIN
+        sensor_nodes n ON (sy.sensor_nodes_id = n.sensor_nodes_id)
+    JOIN
+        timezones t ON (n.timezones_id = t.timezones_id)
+    INNER JOIN
+        sensors_rollup r ON (s.sensors_id = r.sensors_id)
+    {where}
+    ORDER BY s.sensors_id
+    """
+
+
+def nan_to_none(value: float) -> float | None:
+    return None if math.isnan(value) else value
+
+
+class LatestStore:
+    """The latest value of every sensor in parallel arrays.
+
+    Rows are positions in the arrays, indexed by sensor, location and
+    parameter. New sensors are appended so the positions in the indexes
+    stay in load order, i.e. by sensors id. Missing datetimes and values
+    are NaN.
+    """
+
+    def __init__(self):
+        self.sensors_id = array("q")
+        self.locations_id = array("q")
+        self.measurands_id = array("q")
+        self.timezone = array("H")
+        self.datetime = array("d")
+        self.value = array("d")
+        self.latitude = array("d")
+        self.longitude = array("d")
+        self.tzids = []
+        self.tz_index = {}
+        self.positions = {}
+        self.by_location = {}
+        self.by_measurand = {}
+        # the latest datetime loaded, in epoch seconds
+        self.watermark = None
+        self.loaded = 0.0
+        self.checked = 0.0
+        # when loading a store to replace this one last failed
+        self.failed = None
+
+    def __len__(self) -> int:
+        return len(self.sensors_id)
+
+    def upsert(self, row) -> int | None:
+        """Stores a row of `latest_store_sql`.
+
+        Returns:
+            its position when the row is new or changed, else None
+        """
+        dt = row["datetime_last"]
+        epoch = math.nan if dt is None else dt.timestamp()
+        value = math.nan if row["value"] is None else row["value"]
+        latitude = math.nan if row["latitude"] is None else row["latitude"]
+        longitude = math.nan if row["longitude"] is None else row["longitude"]
+        i = self.positions.get(row["sensors_id"])
+        if i is None:
+            i = len(self)
+            tzid = row["tzid"]
+            if tzid not in self.tz_index:
+                self.tz_index[tzid] = len(self.tzids)
+                self.tzids.append(tzid)
+            self.positions[row["sensors_id"]] = i
+            self.sensors_id.append(row["sensors_id"])
+            self.locations_id.append(row["locations_id"])
+            self.measurands_id.append(row["measurands_id"])
+            self.timezone.append(self.tz_index[tzid])
+            self.datetime.append(epoch)
+            self.value.append(value)
+            self.latitude.append(latitude)
+            self.longitude.append(longitude)
+            self.by_location.setdefault(row["locations_id"], array("q")).append(i)
+            self.by_measurand.setdefault(row["measurands_id"], array("q")).append(i)
+        elif self.unchanged(i, (epoch, value, latitude, longitude)):
+            return None
+        else:
+            self.datetime[i] = epoch
+            self.value[i] = value
+            self.latitude[i] = latitude
+            self.longitude[i] = longitude
+        if dt is not None and (self.watermark is None or epoch > self.watermark):
+            self.watermark = epoch
+        return i
+
+    def state(self, i: int) -> tuple[float, float, float, float]:
+        return self.datetime[i], self.value[i], self.latitude[i], self.longitude[i]
+
+    def unchanged(self, i: int, state: tuple) -> bool:
+        return all(
+            a == b or (math.isnan(a) and math.isnan(b))
+            for a, b in zip(self.state(i), state)
+        )
+
+    def changed(self, other: "LatestStore") -> list[int]:
+        """The positions of the rows that are not in `other` or differ."""
+        positions = other.positions
+        return [
+            i
+            for i, sensors_id in enumerate(self.sensors_id)
+            if sensors_id not in positions
+            or not other.unchanged(positions[sensors_id], self.state(i))
+        ]
+
+    def select(
+        self,
+        locations_id: int | list[int] | None = None,
+        measurands_id: int | None = None,
+        datetime_min: date | datetime | None = None,
+        bbox: tuple[float, float, float, float] | None = None,
+    ) -> list[int]:
+        """The positions of the rows matching the filters of `fetch_latest`."""
+        if isinstance(locations_id, list):
+            by_location = self.by_location
+            positions = sorted(
+                i for id in set(locations_id) for i in by_location.get(id, ())
+            )
+        elif locations_id is not None:
+            positions = self.by_location.get(locations_id, ())
+        if locations_id is not None:
+            if measurands_id is not None:
+                measurands = self.measurands_id
+                positions = [i for i in positions if measurands[i] == measurands_id]
+        elif measurands_id is not None:
+            positions = self.by_measurand.get(measurands_id, ())
+        else:
+            positions = range(len(self))
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            latitudes, longitudes = self.latitude, self.longitude
+            positions = [
+                i
+                for i in positions
+                if minx <= longitudes[i] <= maxx and miny <= latitudes[i] <= maxy
+            ]
+        if datetime_min is None:
+            return list(positions)
+        datetimes = self.datetime
+        if isinstance(datetime_min, datetime) and datetime_min.tzinfo is not None:
+            threshold = datetime_min.timestamp()
+            return [i for i in positions if datetimes[i] > threshold]
+        # dates and naive datetimes are local to each location, as in SQL
+        if not isinstance(datetime_min, datetime):
+            datetime_min = datetime.combine(datetime_min, time())
+        thresholds = [
+            datetime_min.replace(tzinfo=ZoneInfo(tzid)).timestamp()
+            for tzid in self.tzids
+        ]
+        timezones = self.timezone
+        return [i for i in positions if datetimes[i] > thresholds[timezones[i]]]
+
+    def row(self, i: int) -> dict:
+        """The `latest_sql` row of a position."""
+        epoch = self.datetime[i]
+        return {
+            "locations_id": self.locations_id[i],
+            "sensors_id": self.sensors_id[i],
+            "datetime": (
+                None
+                if math.isnan(epoch)
+                else datetime_object(
+                    datetime.fromtimestamp(epoch, timezone.utc),
+                    self.tzids[self.timezone[i]],
+                )
+            ),
+            "value": nan_to_none(self.value[i]),
+            "coordinates": {
+                "latitude": nan_to_none(self.latitude[i]),
+                "longitude": nan_to_none(self.longitude[i]),
+            },
+        }
+
+
+latest_store = LatestStore()
+latest_lock = asyncio.Lock()
+latest_tasks = set()
+
+
+async def load_latest(db: DB):
+    """Loads a new `latest_store` and publishes its changes, the previous
+    store is kept when the load fails."""
+    global latest_store
+    store = LatestStore()
+    try:
+        async for row in db.stream(latest_store_sql(False), {}):
+            store.upsert(row)
+    except Exception as e:
+        logger.warning(f"Could not load the latest values: {e}")
+        latest_store.failed = time_module.monotonic()
+        return
+    async with latest_lock:
+        store.loaded = store.checked = time_module.monotonic()
+        changed = store.changed(latest_store) if latest_store.loaded else []
+        latest_store = store
+    latest_hub.publish(store, changed)
+
+
+def reload_latest(db: DB) -> asyncio.Task | None:
+    """Starts loading the `latest_store` in the background unless a load
+    is running, or failed less than `LATEST_REFRESH_SECONDS` ago.
+
+    The load runs on a `DB` of the app, it outlives the request starting it.
+
+    Returns:
+        the running load, if any
+    """
+    failed = latest_store.failed
+    if not latest_tasks and (
+        failed is None
+        or time_module.monotonic() - failed >= settings.LATEST_REFRESH_SECONDS
+    ):
+        task = asyncio.create_task(load_latest(db.app_scoped()))
+        latest_tasks.add(task)
+        task.add_done_callback(latest_tasks.discard)
+    return next(iter(latest_tasks), None)
+
+
+async def refresh_latest(db: DB, wait: bool = False) -> list[int]:
+    """Keeps the `latest_store` up to date.
+
+    The store is first loaded at startup, see `lifespan`, or on first use
+    when that load failed, and reloaded every `LATEST_RELOAD_SECONDS`, in
+    the background while the previous store is served. In between, at
+    most every `LATEST_REFRESH_SECONDS`, the sensors updated after the
+    watermark are polled. The watermark trails by `LATEST_OVERLAP_SECONDS`
+    so that late rollups of other sensors are not missed, and never runs
+    ahead of the clock.
+
+    The changes are published to the subscribers of the `latest_hub`.
+
+    Args:
+        db: the database
+        wait: wait for the first load instead of returning without a store
+
+    Returns:
+        the positions of the rows that changed by polling
+    """
+    store = latest_store
+    now = time_module.monotonic()
+    if not store.loaded or now - store.loaded >= settings.LATEST_RELOAD_SECONDS:
+        task = reload_latest(db)
+        if not store.loaded:
+            if wait and task is not None:
+                # the load outlives a cancelled request
+                await asyncio.shield(task)
+            return []
+    async with latest_lock:
+        store = latest_store
+        if now - store.checked < settings.LATEST_REFRESH_SECONDS:
+            return []
+        store.checked = now
+        watermark = min(store.watermark or 0.0, time_module.time())
+        watermark -= settings.LATEST_OVERLAP_SECONDS
+        params = {"watermark": datetime.fromtimestamp(watermark, timezone.utc)}
+        changed = []
+        try:
+            async for row in db.stream(latest_store_sql(True), params):
+                # the overlap polls rows again, only changes are kept
+                i = store.upsert(row)
+                if i is not None:
+                    changed.append(i)
+        except Exception as e:
+            # the store is still served, the next poll catches up
+            logger.warning(f"Could not poll the latest values: {e}")
+        latest_hub.publish(store, changed)
+        return changed
+
+
+# latest rows by location for `LATEST_STORE` off, see `latest_location_rows`
+latest_cache = {}
+max_latest_locations = 10_000
+
+
+async def latest_location_rows(locations_ids: list[int], db: DB) -> list[dict]:
+    """Gets the latest rows of locations from the `latest_cache`, the
+    missing or expired locations are loaded with one query.
+
+    Rows are kept for `LATEST_REFRESH_SECONDS`, as long as the store
+    would keep them before polling again.
+
+    Returns:
+        the rows of the locations ordered by sensors id
+    """
+    now = time_module.monotonic()
+    ids = set(locations_ids)
+    missing = [
+        i
+        for i in ids
+        if i not in latest_cache
+        or now - latest_cache[i][0] >= settings.LATEST_REFRESH_SECONDS
+    ]
+    if missing:
+        query_builder = QueryBuilder(LocationsIdsLatestQuery(locations_id=missing))
+        # expired rows are reloaded from the database, not the query cache
+        rows = await db.fetch(
+            latest_sql(query_builder), query_builder.params(), cache_read=False
+        )
+        by_location = {i: [] for i in missing}
+        for row in rows:
+            row = dict(row)
+            row.pop("found", None)
+            by_location[row["locations_id"]].append(row)
+        if len(latest_cache) + len(missing) > max_latest_locations:
+            latest_cache.clear()
+        for i in missing:
+            latest_cache[i] = (now, by_location[i])
+    rows = [row for i in ids for row in latest_cache[i][1]]
+    return sorted(rows, key=lambda row: row["sensors_id"])
+
+
+def latest_page(query, rows: list) -> OpenAQResult:
+    offset = (query.page - 1) * query.limit
+    return OpenAQResult(
+        meta=Meta(page=query.page, limit=query.limit, found=len(rows)),
+        results=rows[offset : offset + query.limit],
+    )
+
+
+async def fetch_latest(query, db):
+    """Fetches the latest values from the `latest_store`, or from the
+    database with `LATEST_STORE` off or until the store is first loaded.
+
+    Without the store, the unfiltered latest values of locations are
+    cached per location so that the bulk and the single location
+    endpoints share them.
+    """
+    locations_id = getattr(query, "locations_id", None)
+    bbox = getattr(query, "bbox", None)
+    if settings.LATEST_STORE:
+        await refresh_latest(db)
+    if not settings.LATEST_STORE or not latest_store.loaded:
+        if (
+            locations_id is not None
+            and bbox is None
+            and query.datetime_min is None
+            and getattr(query, "parameters_id", None) is None
+        ):
+            ids = locations_id if isinstance(locations_id, list) else [locations_id]
+            return latest_page(query, await latest_location_rows(ids, db))
+        query_builder = QueryBuilder(query)
+        # filters on the coordinates the results have
+        query_builder.set_column_map({"geom": "COALESCE(r.geom_latest, n.geom)"})
+        response = await db.fetchPage(latest_sql(query_builder), query_builder.params())
+        return response
+    positions = latest_store.select(
+        locations_id=locations_id,
+        measurands_id=getattr(query, "parameters_id", None),
+        datetime_min=query.datetime_min,
+        bbox=bbox and (query.minx, query.miny, query.maxx, query.maxy),
+    )
+    offset = (query.page - 1) * query.limit
+    return OpenAQResult(
+        meta=Meta(page=query.page, limit=query.limit, found=len(positions)),
+        results=[latest_store.row(i) for i in positions[offset : offset + query.limit]],
+    )
+
+
+class LatestHub:
+    """Fans the changes of the `latest_store` out to the latest streams.
+
+    Every stream subscribes with a bounded queue to a location or a
+    parameter. One shared poller refreshes the store while there are
+    subscribers, so the database is polled once per
+    `LATEST_REFRESH_SECONDS` however many streams are open. A queue that
+    is full drops its oldest update, slow clients skip values rather than
+    holding up the others.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.subscribers = 0
+        self.poller = None
+
+    def check(self):
+        """Raises when no more streams can be opened."""
+        if self.subscribers >= settings.LATEST_STREAM_MAX_SUBSCRIBERS:
+            raise HTTPException(
+                status_code=503, detail="Too many streams open, try again later"
+            )
+
+    def subscribe(self, key: tuple[str, int]) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=settings.LATEST_STREAM_QUEUE_SIZE)
+        self.queues.setdefault(key, set()).add(queue)
+        self.subscribers += 1
+        return queue
+
+    def unsubscribe(self, key: tuple[str, int], queue: asyncio.Queue):
+        queues = self.queues.get(key, set())
+        if queue in queues:
+            queues.discard(queue)
+            self.subscribers -= 1
+        if not queues:
+            self.queues.pop(key, None)
+
+    def publish(self, store: LatestStore, positions: list[int]):
+        if not self.queues:
+            return
+        for i in positions:
+            row = None
+            for key in (
+                ("locations", store.locations_id[i]),
+                ("parameters", store.measurands_id[i]),
+            ):
+                for queue in self.queues.get(key, ()):
+                    if row is None:
+                        row = store.row(i)
+                    if queue.full():
+                        queue.get_nowait()
+                    queue.put_nowait(row)
+
+    def start(self, db: DB):
+        """Starts the poller unless it is running, on a `DB` of the app as it
+        outlives the stream starting it."""
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.create_task(self.poll(db.app_scoped()))
+
+    async def poll(self, db: DB):
+        while self.subscribers:
+            try:
+                await refresh_latest(db)
+            except Exception as e:
+                logger.warning(f"Could not refresh the latest values: {e}")
+            await asyncio.sleep(max(settings.LATEST_REFRESH_SECONDS, 1))
+
+
+latest_hub = LatestHub()
+
+
+def latest_event(row: dict) -> bytes:
+    return b"event: latest\ndata: " + serialize(Latest, row) + b"\n\n"
+
+
+async def latest_events(key: tuple[str, int], db: DB) -> AsyncIterator[bytes]:
+    """Server-Sent Events of the latest values of a location or parameter.
+
+    Starts with the current values, then sends every change the poller
+    finds and a comment every `LATEST_STREAM_HEARTBEAT_SECONDS` to keep
+    idle connections open.
+    """
+    queue = latest_hub.subscribe(key)
+    try:
+        latest_hub.start(db)
+        yield f"retry: {settings.LATEST_REFRESH_SECONDS * 1000}\n\n".encode()
+        kind, id = key
+        if kind == "locations":
+            positions = latest_store.select(locations_id=id)
+        else:
+            positions = latest_store.select(measurands_id=id)
+        for i in positions:
+            yield latest_event(latest_store.row(i))
+        while True:
+            try:
+                row = await asyncio.wait_for(
+                    queue.get(), settings.LATEST_STREAM_HEARTBEAT_SECONDS
+                )
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            yield latest_event(row)
+    finally:
+        latest_hub.unsubscribe(key, queue)
+
+
+async def check_latest_store(db: DB):
+    """Raises when the latest values cannot be streamed, the streams are
+    only served from the `latest_store`.
+
+    Waits for the first load of the store, a load that failed is reported
+    instead of opening a stream without values.
+    """
+    if not settings.LATEST_STORE:
+        raise HTTPException(
+            status_code=503, detail="Latest measurement streams are not available"
+        )
+    await refresh_latest(db, wait=True)
+    if not latest_store.loaded:
+        raise HTTPException(
+            status_code=503,
+            detail="The latest measurements could not be loaded, try again later",
+            headers={"Retry-After": str(max(settings.LATEST_REFRESH_SECONDS, 1))},
+        )
+
+
+def event_stream(events: AsyncIterator[bytes]) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/locations/{locations_id}/latest/stream",
+    summary="Stream a location's latest measurements",
+    description="Server-Sent Events of a location's latest measurement values, \
+        the current values first and then each new value as it arrives",
+    response_class=StreamingResponse,
+)
+async def location_latest_stream_get(
+    locations: Annotated[
+        LocationLatestPathQuery, Depends(LocationLatestPathQuery.depends())
+    ],
+    db: DB = Depends(),
+):
+    latest_hub.check()
+    await check_latest_store(db)
+    if not latest_store.select(locations_id=locations.locations_id):
+        locations_response = await fetch_locations(
+            LocationPathQuery(locations_id=locations.locations_id), db
+        )
+        if len(locations_response.results) == 0:
+            raise HTTPException(status_code=404, detail="Location not found")
+    return event_stream(latest_events(("locations", locations.locations_id), db))
+
+
+@router.get(
+    "/parameters/{parameters_id}/latest/stream",
+    summary="Stream latest measurements by parameters ID",
+    description="Server-Sent Events of the latest measurements of the indicated \
+        parameters ID, the current values first and then each new value as it \
+        arrives",
+    response_class=StreamingResponse,
+)
+async def parameters_latest_stream_get(
+    parameters: Annotated[
+        ParameterLatestPathQuery, Depends(ParameterLatestPathQuery.depends())
+    ],
+    db: DB = Depends(),
+):
+    latest_hub.check()
+    await check_latest_store(db)
+    if not latest_store.select(measurands_id=parameters.parameters_id):
+        parameters_response = await fetch_parameters(
+            ParametersLatestQueries(parameters_id=parameters.parameters_id), db
+        )
+        if len(parameters_response.results) == 0:
+            raise HTTPException(status_code=404, detail="Parameter not found")
+    return event_stream(latest_events(("parameters", parameters.parameters_id), db))
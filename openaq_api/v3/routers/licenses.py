@@ -10,6 +10,7 @@ from openaq_api.v3.models.queries import (
     QueryBaseModel,
     QueryBuilder,
     SortingBase,
+    sql_template,
 )
 from openaq_api.v3.models.responses import LicensesResponse
 
@@ -91,9 +92,9 @@ async def instruments_get(
     return response
 
 
-async def fetch_licenses(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
+@sql_template
+def licenses_sql(query_builder: QueryBuilder) -> str:
+    return f"""
         SELECT
             licenses_id AS id
             , name
@@ -110,5 +111,9 @@ async def fetch_licenses(query, db):
         {query_builder.pagination()};
         """
 
-    response = await db.fetchPage(sql, query_builder.params())
+
+async def fetch_licenses(query, db):
+    query_builder = QueryBuilder(query)
+
+    response = await db.fetchPage(licenses_sql(query_builder), query_builder.params())
     return response
@@ -1,9 +1,14 @@
+import asyncio
 import logging
+import math
+import time as time_module
+from array import array
 from typing import Annotated
 from enum import StrEnum, auto
 from fastapi import APIRouter, Depends, HTTPException, Path, Query, Request
 
 from openaq_api.db import DB
+from openaq_api.settings import settings
 from openaq_api.v3.models.queries import (
     BboxQuery,
     CountryIdQuery,
@@ -21,8 +26,11 @@ from openaq_api.v3.models.queries import (
     QueryBuilder,
     RadiusQuery,
     SortingBase,
+    SortOrder,
+    sql_template,
 )
-from openaq_api.v3.models.responses import LocationsResponse
+from openaq_api.v3.models.responses import LocationsResponse, Meta, OpenAQResult
+from openaq_api.v3.models.utils import float4_down, float4_up, geodesic_distance
 
 logger = logging.getLogger("locations")
 
@@ -114,14 +122,15 @@ async def locations_get(
     locations: Annotated[LocationsQueries, Depends(LocationsQueries.depends())],
     db: DB = Depends(),
 ):
+    if settings.LOCATIONS_CATALOGUE:
+        catalogue = await locations_catalogue_for(db)
+        if catalogue is not None:
+            return catalogue.page(locations)
     response = await fetch_locations(locations, db)
     return response
 
 
-async def fetch_locations(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
-    SELECT id
+location_columns = """id
     , name
     , ismobile as is_mobile
     , ismonitor as is_monitor
@@ -136,13 +145,281 @@ async def fetch_locations(query, db):
     , bbox(geom) as bounds
     , datetime_first
     , datetime_last
-    , licenses
+    , licenses"""
+
+
+@sql_template
+def locations_sql(query_builder: QueryBuilder) -> str:
+    return f"""
+    SELECT {location_columns}
     {query_builder.fields() or ''}
     FROM locations_view_cached
     {query_builder.where()}
     {query_builder.order_by()}
     {query_builder.pagination()}
     """
-    print("SQL", sql)
-    response = await db.fetchPage(sql, query_builder.params())
+
+
+async def fetch_locations(query, db):
+    query_builder = QueryBuilder(query)
+    response = await db.fetchPage(locations_sql(query_builder), query_builder.params())
     return response
+
+
+catalogue_sql = f"""
+SELECT {location_columns}
+, st_x(geom) AS lon
+, st_y(geom) AS lat
+, parameter_ids
+, manufacturer_ids
+, license_ids
+, instrument_ids
+FROM locations_view_cached
+ORDER BY id
+"""
+
+# the columns of `catalogue_sql` only used to filter
+catalogue_filters = (
+    "parameter_ids",
+    "manufacturer_ids",
+    "license_ids",
+    "instrument_ids",
+)
+
+
+def entity_id(value: dict | None) -> int | None:
+    return None if value is None else value.get("id")
+
+
+def overlaps(ids: frozenset | None, values: set) -> bool:
+    """`ids && :values`, false for NULL."""
+    return ids is not None and not ids.isdisjoint(values)
+
+
+class LocationsCatalogue:
+    """The rows of `locations_view_cached` for `/v3/locations` in memory.
+
+    Rows are kept by id with their coordinates in parallel arrays and a
+    grid of one degree cells for the bounding box and radius filters, the
+    other filters of `LocationsQueries` are checked on the candidates of
+    the grid. Each filter follows its SQL condition so that the pages are
+    the same as `locations_sql`.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.lon = array("d")
+        self.lat = array("d")
+        self.filters = {name: [] for name in catalogue_filters}
+        self.grid = {}
+        self.loaded = 0.0
+        # when loading a catalogue to replace this one last failed
+        self.failed = None
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, row):
+        i = len(self.rows)
+        row = dict(row)
+        lon, lat = row.pop("lon"), row.pop("lat")
+        for name in catalogue_filters:
+            ids = row.pop(name)
+            self.filters[name].append(None if ids is None else frozenset(ids))
+        self.rows.append(row)
+        self.lon.append(math.nan if lon is None else lon)
+        self.lat.append(math.nan if lat is None else lat)
+        if lon is not None and lat is not None:
+            cell = (math.floor(lon), math.floor(lat))
+            self.grid.setdefault(cell, array("q")).append(i)
+
+    def cells(self, xs, ys) -> list[int]:
+        """The positions in the cells of the grid, in load order."""
+        grid = self.grid
+        return sorted(i for x in xs for y in ys for i in grid.get((x, y), ()))
+
+    def bbox_candidates(self, query) -> list[int]:
+        # one more cell on each side for the single precision rounding
+        xs = range(math.floor(query.minx) - 1, math.floor(query.maxx) + 2)
+        ys = range(math.floor(query.miny) - 1, math.floor(query.maxy) + 2)
+        return self.cells(xs, ys)
+
+    def radius_candidates(self, query) -> list[int]:
+        # a degree of latitude is at least 110.5km, the margin is widened
+        # for the longitudes towards the poles and wraps at the antimeridian
+        margin = query.radius / 110_000 + 0.01
+        south, north = query.lat - margin, query.lat + margin
+        ys = range(math.floor(max(south, -90)), math.floor(min(north, 90)) + 1)
+        if max(abs(south), abs(north)) >= 89:
+            xs = range(-180, 181)
+        else:
+            widest = math.cos(math.radians(max(abs(south), abs(north))))
+            west, east = query.lon - margin / widest, query.lon + margin / widest
+            xs = {
+                (x + 180) % 360 - 180
+                for x in range(math.floor(west), math.floor(east) + 1)
+            }
+            # points on the antimeridian are in the cells of 180 and -180
+            if 179 in xs or -180 in xs:
+                xs |= {-180, 179, 180}
+        return self.cells(xs, ys)
+
+    def checks(self, query) -> list:
+        """Checks of a position for the attribute filters of a query."""
+        rows, filters = self.rows, self.filters
+        checks = []
+        if query.countries_id is not None:
+            countries = set(query.countries_id)
+            checks.append(lambda i: entity_id(rows[i]["country"]) in countries)
+        if query.iso is not None:
+            iso = query.iso
+            checks.append(
+                lambda i: rows[i]["country"] is not None
+                and rows[i]["country"].get("code") == iso
+            )
+        if query.providers_id is not None:
+            providers = set(query.providers_id)
+            checks.append(lambda i: entity_id(rows[i]["provider"]) in providers)
+        if query.owner_contacts_id is not None:
+            owners = set(query.owner_contacts_id)
+            checks.append(lambda i: entity_id(rows[i]["owner"]) in owners)
+        if query.mobile is not None:
+            mobile = query.mobile
+            checks.append(lambda i: rows[i]["is_mobile"] == mobile)
+        if query.monitor is not None:
+            monitor = query.monitor
+            checks.append(lambda i: rows[i]["is_monitor"] == monitor)
+        for name, ids in (
+            ("parameter_ids", query.parameters_id),
+            ("manufacturer_ids", query.manufacturers_id),
+            ("license_ids", query.licenses_id),
+            ("instrument_ids", query.instruments_id),
+        ):
+            if ids is not None:
+                checks.append(
+                    lambda i, column=filters[name], ids=set(ids): overlaps(
+                        column[i], ids
+                    )
+                )
+        return checks
+
+    def select(self, query) -> tuple[list[int], dict[int, float]]:
+        """The positions matching the filters of a `LocationsQueries`.
+
+        Returns:
+            the positions in the order of the query and the distances of
+            the positions with the radius filter
+        """
+        distances = {}
+        if query.bbox:
+            # `ST_MakeEnvelope(...) && geom` compares single precision boxes
+            minx, miny = float4_down(query.minx), float4_down(query.miny)
+            maxx, maxy = float4_up(query.maxx), float4_up(query.maxy)
+            lon, lat = self.lon, self.lat
+            positions = [
+                i
+                for i in self.bbox_candidates(query)
+                if float4_down(lon[i]) <= maxx
+                and float4_up(lon[i]) >= minx
+                and float4_down(lat[i]) <= maxy
+                and float4_up(lat[i]) >= miny
+            ]
+        elif query.radius and query.coordinates:
+            positions = []
+            for i in self.radius_candidates(query):
+                distance = geodesic_distance(
+                    query.lat, query.lon, self.lat[i], self.lon[i]
+                )
+                if distance <= query.radius:
+                    positions.append(i)
+                    distances[i] = distance
+        else:
+            positions = range(len(self))
+        checks = self.checks(query)
+        if checks:
+            positions = [i for i in positions if all(check(i) for check in checks)]
+        positions = list(positions)
+        if query.sort_order == SortOrder.DESC:
+            positions.reverse()
+        return positions, distances
+
+    def page(self, query) -> OpenAQResult:
+        """The response of `fetch_locations` for a `LocationsQueries`."""
+        positions, distances = self.select(query)
+        offset = (query.page - 1) * query.limit
+        results = []
+        for i in positions[offset : offset + query.limit]:
+            row = self.rows[i]
+            if distances:
+                row = {**row, "distance": distances[i]}
+            results.append(row)
+        # counted as `fetchPage` counts pages without a found column
+        if len(results) == query.limit:
+            found = f">{query.limit}"
+        else:
+            found = len(results)
+        return OpenAQResult(
+            meta=Meta(page=query.page, limit=query.limit, found=found),
+            results=results,
+        )
+
+
+locations_catalogue = LocationsCatalogue()
+catalogue_lock = asyncio.Lock()
+catalogue_tasks = set()
+
+
+async def load_catalogue(db: DB) -> LocationsCatalogue | None:
+    """Loads the `locations_catalogue`, None if it could not be loaded."""
+    global locations_catalogue
+    catalogue = LocationsCatalogue()
+    try:
+        async for row in db.stream(catalogue_sql, {}):
+            catalogue.add(row)
+    except Exception as e:
+        logger.warning(f"Could not load the locations catalogue: {e}")
+        locations_catalogue.failed = time_module.monotonic()
+        return None
+    catalogue.loaded = time_module.monotonic()
+    locations_catalogue = catalogue
+    return catalogue
+
+
+def retry_catalogue(catalogue: LocationsCatalogue) -> bool:
+    """Whether a load may run, loads are not retried for
+    `LOCATIONS_CATALOGUE_RETRY_SECONDS` after a failure."""
+    return (
+        catalogue.failed is None
+        or time_module.monotonic() - catalogue.failed
+        >= settings.LOCATIONS_CATALOGUE_RETRY_SECONDS
+    )
+
+
+async def locations_catalogue_for(db: DB) -> LocationsCatalogue | None:
+    """The `locations_catalogue`, loaded on first use.
+
+    After `LOCATIONS_CATALOGUE_SECONDS` the catalogue is reloaded in the
+    background and the previous one is served in the meantime. None when
+    the first load failed, the query then runs in the database until the
+    load is retried.
+    """
+    catalogue = locations_catalogue
+    if not catalogue.loaded:
+        if not retry_catalogue(catalogue):
+            return None
+        async with catalogue_lock:
+            if locations_catalogue.loaded:
+                return locations_catalogue
+            if not retry_catalogue(locations_catalogue):
+                return None
+            return await load_catalogue(db)
+    if (
+        time_module.monotonic() - catalogue.loaded
+        >= settings.LOCATIONS_CATALOGUE_SECONDS
+        and not catalogue_tasks
+        and retry_catalogue(catalogue)
+    ):
+        task = asyncio.create_task(load_catalogue(db))
+        catalogue_tasks.add(task)
+        task.add_done_callback(catalogue_tasks.discard)
+    return catalogue
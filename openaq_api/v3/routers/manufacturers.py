@@ -10,6 +10,7 @@ from openaq_api.v3.models.queries import (
     QueryBaseModel,
     QueryBuilder,
     SortingBase,
+    sql_template,
 )
 from openaq_api.v3.models.responses import ManufacturersResponse
 
@@ -95,9 +96,9 @@ async def manufacturers_get(
     return response
 
 
-async def fetch_manufacturers(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
+@sql_template
+def manufacturers_sql(query_builder: QueryBuilder) -> str:
+    return f"""
         SELECT
             e.entities_id AS id
             , e.full_name AS name
@@ -117,5 +118,11 @@ async def fetch_manufacturers(query, db):
 
         """
 
-    response = await db.fetchPage(sql, query_builder.params())
+
+async def fetch_manufacturers(query, db):
+    query_builder = QueryBuilder(query)
+
+    response = await db.fetchPage(
+        manufacturers_sql(query_builder), query_builder.params()
+    )
     return response
@@ -1,13 +1,25 @@
+import asyncio
+import bisect
+import functools
+import importlib.util
 import logging
+import math
+import time as time_module
+from collections import OrderedDict
+from enum import StrEnum, auto
 from typing import Annotated, Any
 
-from fastapi import APIRouter, Depends, Path
+from fastapi import APIRouter, Depends, Header, HTTPException, Path, Query
 from fastapi.exceptions import RequestValidationError
+from fastapi.responses import StreamingResponse
 from pydantic import model_validator
-from datetime import date, timedelta
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
 
-from openaq_api.db import DB
+from openaq_api.db import DB, open_stream
+from openaq_api.settings import settings
 from openaq_api.v3.models.queries import (
+    CommaSeparatedList,
     DateFromQuery,
     DateToQuery,
     DatetimeFromQuery,
@@ -15,6 +27,7 @@ from openaq_api.v3.models.queries import (
     Paging,
     QueryBaseModel,
     QueryBuilder,
+    sql_template,
 )
 
 from openaq_api.v3.models.responses import (
@@ -22,14 +35,40 @@ from openaq_api.v3.models.responses import (
     HourlyDataResponse,
     DailyDataResponse,
     AnnualDataResponse,
+    LocationTimeSeriesResponse,
+    Meta,
+    OpenAQResult,
+    SensorHourlyData,
+    SensorsHourlyDataResponse,
+    SensorTimeSeriesResponse,
+    SeriesMeta,
+)
+from openaq_api.v3.models.serializers import (
+    TrustedRoute,
+    json_response,
+    pyarrow_installed,
+    table_media_type,
+    table_media_types,
+    table_responses,
+    table_stream,
+    trusted_response,
+)
+from openaq_api.v3.models.utils import (
+    bucket_extremes,
+    grid_reindex,
+    group_summaries,
+    nullable,
 )
 
 logger = logging.getLogger("measurements")
 
+max_batch_sensors = 100
+
 router = APIRouter(
     prefix="/v3",
     tags=["v3"],
     include_in_schema=True,
+    route_class=TrustedRoute,
 )
 
 
@@ -39,16 +78,72 @@ class SensorQuery(QueryBaseModel):
     )
 
     def where(self):
-        return "s.sensors_id = :sensors_id"
+        sensors_id = self.map("sensors_id", "s.sensors_id")
+        return f"{sensors_id} = :sensors_id"
+
+
+class SensorsQuery(QueryBaseModel):
+    sensors_id: CommaSeparatedList[int] = Query(
+        ...,
+        description=f"Comma separated list of up to {max_batch_sensors} sensors ids",
+        examples=["1,2,3"],
+    )
+
+    @model_validator(mode="after")
+    @classmethod
+    def check_number_of_sensors(cls, data: Any) -> Any:
+        sensors_id = getattr(data, "sensors_id")
+        if len(sensors_id) > max_batch_sensors:
+            raise RequestValidationError(
+                f"A maximum of {max_batch_sensors} sensors can be requested at once. User passed {len(sensors_id)}"
+            )
+        return data
+
+    def where(self):
+        return "h.sensors_id = ANY(:sensors_id)"
 
 
 class LocationSensorQuery(QueryBaseModel):
     locations_id: int = Path(
-        ..., description="Limit the results to a specific sensors id", ge=1
+        ..., description="Limit the results to a specific location id", ge=1
     )
 
     def where(self):
-        return "n.sensor_nodes_id = :locations_id"
+        return "sy.sensor_nodes_id = :locations_id"
+
+
+class TimestampPaging(QueryBaseModel):
+    """Paging for wide tables, where a row is a timestamp and not a sensor value.
+
+    The limit and offset are applied by `location_series_sql` to the
+    distinct timestamps so that a page never splits the values of one
+    timestamp, the rows are then only built for the timestamps of the page.
+    """
+
+    limit: int = Query(
+        100,
+        gt=0,
+        le=1000,
+        description="""Change the number of timestamps returned.
+        e.g. limit=100 will return up to 100 timestamps""",
+        examples=["100"],
+    )
+    page: int = Query(
+        1,
+        gt=0,
+        description="Paginate through timestamps. e.g. page=1 will return first page of results",
+        examples=["1"],
+    )
+
+    def fields(self) -> str:
+        return (
+            "h.sensors_id\n, DENSE_RANK() OVER (ORDER BY h.datetime) as timestamp_rank"
+        )
+
+    def where(self) -> str | None:
+        page = self.map("timestamps_page")
+        if page is not None:
+            return f"h.datetime IN (SELECT datetime FROM {page})"
 
 
 class BaseDatetimeQueries(
@@ -73,6 +168,42 @@ class PagedDatetimeQueries(
 ): ...
 
 
+class PagedSensorsDatetimeQueries(
+    Paging,
+    SensorsQuery,
+    DatetimeFromQuery,
+    DatetimeToQuery,
+):
+    @model_validator(mode="after")
+    @classmethod
+    def check_dates_are_in_order(cls, data: Any) -> Any:
+        dt = getattr(data, "datetime_to")
+        df = getattr(data, "datetime_from")
+        if dt and df and dt <= df:
+            raise RequestValidationError(
+                f"Date/time from must be older than the date/time to. User passed {df} - {dt}"
+            )
+        return data
+
+
+class LocationDatetimeQueries(
+    TimestampPaging,
+    LocationSensorQuery,
+    DatetimeFromQuery,
+    DatetimeToQuery,
+):
+    @model_validator(mode="after")
+    @classmethod
+    def check_dates_are_in_order(cls, data: Any) -> Any:
+        dt = getattr(data, "datetime_to")
+        df = getattr(data, "datetime_from")
+        if dt and df and dt <= df:
+            raise RequestValidationError(
+                f"Date/time from must be older than the date/time to. User passed {df} - {dt}"
+            )
+        return data
+
+
 class BaseDateQueries(
     SensorQuery,
     DateFromQuery,
@@ -95,19 +226,115 @@ class PagedDateQueries(
 ): ...
 
 
+class SeriesFormat(StrEnum):
+    rows = auto()
+    columnar = auto()
+
+
+class SeriesFormatQuery(QueryBaseModel):
+    format: SeriesFormat = Query(
+        SeriesFormat.rows,
+        description="""Format of the results. `rows` returns one object per
+        period, `columnar` returns the series as one object with the
+        parameter and interval once and parallel columns of the datetimes,
+        values, flags, coverage and, for aggregates, the summaries""",
+        examples=["columnar"],
+    )
+
+
+class SeriesDatetimeQueries(SeriesFormatQuery, PagedDatetimeQueries): ...
+
+
+class SeriesDateQueries(SeriesFormatQuery, PagedDateQueries): ...
+
+
+class MaxPointsQuery(QueryBaseModel):
+    max_points: int | None = Query(
+        None,
+        ge=2,
+        le=10_000,
+        description="""Thin the series to at most this many points for
+        charting. The requested range is split into equal buckets of time and
+        the lowest and highest values of each bucket are returned, `limit`
+        and `page` do not apply. The bucket width is returned as the
+        resolution in the meta. Needs the start of the range, which is
+        limited to 36 days of measurements, 36 months of hours or 36 years of
+        days""",
+        examples=["1000"],
+    )
+
+
+class SampledDatetimeQueries(MaxPointsQuery, SeriesDatetimeQueries): ...
+
+
+class SampledDateQueries(MaxPointsQuery, SeriesDateQueries): ...
+
+
+class GapFill(StrEnum):
+    null = auto()
+    linear = auto()
+
+
+class GapFillQuery(QueryBaseModel):
+    fill: GapFill | None = Query(
+        None,
+        description="""Return one result for every hour of the requested
+        period. Hours without data are added with a null value, or with
+        `linear` a value interpolated between the nearest hours with values,
+        and an empty summary and coverage. The meta includes the coverage of
+        the whole period. Needs the start of the period, which is limited to
+        36 months""",
+        examples=["null"],
+    )
+
+
+class HoursSeriesQueries(GapFillQuery, SampledDatetimeQueries): ...
+
+
+class LocationDateQueries(
+    TimestampPaging,
+    LocationSensorQuery,
+    DateFromQuery,
+    DateToQuery,
+):
+    @model_validator(mode="after")
+    @classmethod
+    def check_dates_are_in_order(cls, data: Any) -> Any:
+        dt = getattr(data, "date_to")
+        df = getattr(data, "date_from")
+        if dt and df and dt <= df:
+            raise RequestValidationError(
+                f"Date from must be older than the date to. User passed {df} - {dt}"
+            )
+        return data
+
+
 @router.get(
     "/sensors/{sensors_id}/measurements",
     response_model=MeasurementsResponse,
     summary="Get measurements by sensor ID",
-    description="Provides a list of measurements by sensor ID",
+    description="Provides a list of measurements by sensor ID \
+        Send `Accept: application/vnd.apache.arrow.stream` or \
+        `Accept: application/vnd.apache.parquet` to download the whole \
+        requested range as a table instead, paging does not apply.",
+    responses=table_responses,
 )
+@trusted_response
 async def sensor_measurements_get(
-    sensors: Annotated[PagedDatetimeQueries, Depends(PagedDatetimeQueries.depends())],
+    sensors: Annotated[
+        SampledDatetimeQueries, Depends(SampledDatetimeQueries.depends())
+    ],
     db: DB = Depends(),
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
 ):
+    media_type = table_media_type(accept)
+    if media_type:
+        return await fetch_series_table(
+            sensors, "measurements", measurements_sql, media_type, db
+        )
     query = QueryBuilder(sensors)
     response = await fetch_measurements(query, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
@@ -118,14 +345,15 @@ async def sensor_measurements_get(
         on the fly by sensor ID. For better performance but similar functionality, \
         `/sensors/{sensors_id}/hours` is the recommended endpoint.",
 )
+@trusted_response
 async def sensor_measurements_aggregated_get_hourly(
-    sensors: Annotated[PagedDatetimeQueries, Depends(PagedDatetimeQueries.depends())],
+    sensors: Annotated[SeriesDatetimeQueries, Depends(SeriesDatetimeQueries.depends())],
     db: DB = Depends(),
 ):
     aggregate_to = "hour"
     query = QueryBuilder(sensors)
     response = await fetch_measurements_aggregated(query, aggregate_to, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
@@ -134,13 +362,108 @@ async def sensor_measurements_aggregated_get_hourly(
     summary="Get measurements aggregated to days by sensor ID",
     description="Provides a list of measurements by sensor ID",
 )
+@trusted_response
 async def sensor_measurements_aggregated_get_daily(
-    sensors: Annotated[PagedDatetimeQueries, Depends(PagedDatetimeQueries.depends())],
+    sensors: Annotated[SeriesDatetimeQueries, Depends(SeriesDatetimeQueries.depends())],
     db: DB = Depends(),
 ):
     aggregate_to = "day"
     query = QueryBuilder(sensors)
     response = await fetch_measurements_aggregated(query, aggregate_to, db)
+    return series_response(sensors, response)
+
+
+@router.get(
+    "/sensors/hours",
+    response_model=SensorsHourlyDataResponse,
+    summary="Get precomputed hourly measurements for multiple sensors",
+    description="Provides hourly measurements for a list of sensors in one \
+        request. Results are grouped by sensor and `limit` and `page` apply to \
+        each sensor separately.",
+)
+@trusted_response
+async def sensors_hourly_measurements_get(
+    sensors: Annotated[
+        PagedSensorsDatetimeQueries, Depends(PagedSensorsDatetimeQueries.depends())
+    ],
+    db: DB = Depends(),
+):
+    query = QueryBuilder(sensors)
+    response = await fetch_sensors_hours(query, db)
+    return response
+
+
+@router.get(
+    "/sensors/hours/stream",
+    summary="Stream precomputed hourly measurements for multiple sensors",
+    description="Streams hourly measurements for a list of sensors as newline \
+        delimited JSON, one hourly measurement per line ordered by sensor and \
+        datetime. `limit` and `page` apply to each sensor separately.",
+    response_class=StreamingResponse,
+)
+async def sensors_hourly_measurements_stream(
+    sensors: Annotated[
+        PagedSensorsDatetimeQueries, Depends(PagedSensorsDatetimeQueries.depends())
+    ],
+    db: DB = Depends(),
+):
+    query = QueryBuilder(sensors)
+    return StreamingResponse(
+        await stream_sensors_hours(query, db), media_type="application/x-ndjson"
+    )
+
+
+@router.get(
+    "/locations/{locations_id}/hours",
+    response_model=LocationTimeSeriesResponse,
+    summary="Get precomputed hourly measurements of all sensors at a location",
+    description="Provides the hourly values of every sensor at a location as a \
+        time aligned table, with one timestamp column and one value column per \
+        sensor. `limit` and `page` count timestamps. \
+        Send `Accept: application/vnd.apache.arrow.stream` or \
+        `Accept: application/vnd.apache.parquet` to download the whole \
+        requested range as a table instead, paging does not apply.",
+    responses=table_responses,
+)
+@trusted_response
+async def location_hourly_measurements_get(
+    locations: Annotated[
+        LocationDatetimeQueries, Depends(LocationDatetimeQueries.depends())
+    ],
+    db: DB = Depends(),
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
+):
+    media_type = table_media_type(accept)
+    if media_type:
+        return await fetch_location_table(locations, "hourly_data", media_type, db)
+    query = QueryBuilder(locations)
+    response = await fetch_location_series(query, "hourly_data", hours_sql, db)
+    return response
+
+
+@router.get(
+    "/locations/{locations_id}/days",
+    response_model=LocationTimeSeriesResponse,
+    summary="Get daily measurements of all sensors at a location",
+    description="Provides the daily values of every sensor at a location as a \
+        time aligned table, with one timestamp column and one value column per \
+        sensor. `limit` and `page` count timestamps. \
+        Send `Accept: application/vnd.apache.arrow.stream` or \
+        `Accept: application/vnd.apache.parquet` to download the whole \
+        requested range as a table instead, paging does not apply.",
+    responses=table_responses,
+)
+@trusted_response
+async def location_daily_get(
+    locations: Annotated[LocationDateQueries, Depends(LocationDateQueries.depends())],
+    db: DB = Depends(),
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
+):
+    media_type = table_media_type(accept)
+    if media_type:
+        return await fetch_location_table(locations, "daily_data", media_type, db)
+    query = QueryBuilder(locations)
+    response = await fetch_location_series(query, "daily_data", days_sql, db)
     return response
 
 
@@ -151,15 +474,26 @@ async def sensor_measurements_aggregated_get_daily(
     description="Provides a list of hourly measurements by sensor ID. If a sensor \
         is reporting at a higher frequency than hourly (e.g. one measurement \
         every 10 minutes), this endpoint returns the precomputed average \
-        measurement value by the hour.",
+        measurement value by the hour. \
+        Send `Accept: application/vnd.apache.arrow.stream` or \
+        `Accept: application/vnd.apache.parquet` to download the whole \
+        requested range as a table instead, paging does not apply.",
+    responses=table_responses,
 )
+@trusted_response
 async def sensor_hourly_measurements_get(
-    sensors: Annotated[PagedDatetimeQueries, Depends(PagedDatetimeQueries.depends())],
+    sensors: Annotated[HoursSeriesQueries, Depends(HoursSeriesQueries.depends())],
     db: DB = Depends(),
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
 ):
+    media_type = table_media_type(accept)
+    if media_type:
+        return await fetch_series_table(
+            sensors, "hourly_data", hours_sql, media_type, db
+        )
     query = QueryBuilder(sensors)
     response = await fetch_hours(query, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
@@ -168,14 +502,15 @@ async def sensor_hourly_measurements_get(
     summary="Get measurements aggregated from hour to day by sensor ID",
     description="Provides a list of daily summaries of hourly data by sensor ID",
 )
+@trusted_response
 async def sensor_hourly_measurements_aggregate_to_day_get(
-    sensors: Annotated[PagedDatetimeQueries, Depends(PagedDatetimeQueries.depends())],
+    sensors: Annotated[SeriesDatetimeQueries, Depends(SeriesDatetimeQueries.depends())],
     db: DB = Depends(),
 ):
     aggregate_to = "day"
     query = QueryBuilder(sensors)
     response = await fetch_hours_aggregated(query, aggregate_to, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
@@ -184,14 +519,15 @@ async def sensor_hourly_measurements_aggregate_to_day_get(
     summary="Get measurements aggregated from hour to month by sensor ID",
     description="Provides a list of monthly summaries of hourly data by sensor ID",
 )
+@trusted_response
 async def sensor_hourly_measurements_aggregate_to_month_get(
-    sensors: Annotated[PagedDatetimeQueries, Depends(PagedDatetimeQueries.depends())],
+    sensors: Annotated[SeriesDatetimeQueries, Depends(SeriesDatetimeQueries.depends())],
     db: DB = Depends(),
 ):
     aggregate_to = "month"
     query = QueryBuilder(sensors)
     response = await fetch_hours_aggregated(query, aggregate_to, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
@@ -200,14 +536,15 @@ async def sensor_hourly_measurements_aggregate_to_month_get(
     summary="Get measurements aggregated from hour to year by sensor ID",
     description="Provides a list of yearly summaries of hourly data by sensor ID",
 )
+@trusted_response
 async def sensor_hourly_measurements_aggregate_to_year_get(
-    sensors: Annotated[PagedDatetimeQueries, Depends(PagedDatetimeQueries.depends())],
+    sensors: Annotated[SeriesDatetimeQueries, Depends(SeriesDatetimeQueries.depends())],
     db: DB = Depends(),
 ):
     aggregate_to = "year"
     query = QueryBuilder(sensors)
     response = await fetch_hours_aggregated(query, aggregate_to, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
@@ -216,6 +553,7 @@ async def sensor_hourly_measurements_aggregate_to_year_get(
     summary="Get measurements aggregated from hour to hour of day by sensor ID",
     description="Provides a list of summaries of hourly data by hour of day value by sensor ID",
 )
+@trusted_response
 async def sensor_hourly_measurements_aggregate_to_hod_get(
     sensors: Annotated[BaseDatetimeQueries, Depends(BaseDatetimeQueries.depends())],
     db: DB = Depends(),
@@ -233,6 +571,7 @@ async def sensor_hourly_measurements_aggregate_to_hod_get(
     summary="Get measurements aggregated from hour to day of week by sensor ID",
     description="Provides a list of summaries of hourly data by day of week by sensor ID",
 )
+@trusted_response
 async def sensor_hourly_measurements_aggregate_to_dow_get(
     sensors: Annotated[BaseDatetimeQueries, Depends(BaseDatetimeQueries.depends())],
     db: DB = Depends(),
@@ -249,6 +588,7 @@ async def sensor_hourly_measurements_aggregate_to_dow_get(
     summary="Get measurements aggregated from hour to month of year by sensor ID",
     description="Provides a list of summaries of hourly data by month of year by sensor ID",
 )
+@trusted_response
 async def sensor_hourly_measurements_aggregate_to_moy_get(
     sensors: Annotated[BaseDatetimeQueries, Depends(BaseDatetimeQueries.depends())],
     db: DB = Depends(),
@@ -265,6 +605,7 @@ async def sensor_hourly_measurements_aggregate_to_moy_get(
     summary="Get measurements aggregated from day to day of week by sensor ID",
     description="Provides a list of summaries of daily data by day of week by sensor ID",
 )
+@trusted_response
 async def sensor_daily_measurements_aggregate_to_dow_get(
     sensors: Annotated[BaseDateQueries, Depends(BaseDateQueries.depends())],
     db: DB = Depends(),
@@ -281,6 +622,7 @@ async def sensor_daily_measurements_aggregate_to_dow_get(
     summary="Get measurements aggregated from day to month of year by sensor ID",
     description="Provides a list of summaries of daily data by month of year by sensor ID",
 )
+@trusted_response
 async def sensor_daily_measurements_aggregate_to_moy_get(
     sensors: Annotated[BaseDateQueries, Depends(BaseDateQueries.depends())],
     db: DB = Depends(),
@@ -295,15 +637,24 @@ async def sensor_daily_measurements_aggregate_to_moy_get(
     "/sensors/{sensors_id}/days",
     response_model=DailyDataResponse,
     summary="Get measurements aggregated to day by sensor ID",
-    description="Provides a list of daily data by sensor ID",
+    description="Provides a list of daily data by sensor ID \
+        Send `Accept: application/vnd.apache.arrow.stream` or \
+        `Accept: application/vnd.apache.parquet` to download the whole \
+        requested range as a table instead, paging does not apply.",
+    responses=table_responses,
 )
+@trusted_response
 async def sensor_daily_get(
-    sensors: Annotated[PagedDateQueries, Depends(PagedDateQueries.depends())],
+    sensors: Annotated[SampledDateQueries, Depends(SampledDateQueries.depends())],
     db: DB = Depends(),
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
 ):
+    media_type = table_media_type(accept)
+    if media_type:
+        return await fetch_series_table(sensors, "daily_data", days_sql, media_type, db)
     query = QueryBuilder(sensors)
     response = await fetch_days(query, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
@@ -312,14 +663,15 @@ async def sensor_daily_get(
     summary="Get measurements aggregated from day to month by sensor ID",
     description="Provides a list of monthly summaries of daily data by sensor ID",
 )
+@trusted_response
 async def sensor_daily_aggregate_to_month_get(
-    sensors: Annotated[PagedDateQueries, Depends(PagedDateQueries.depends())],
+    sensors: Annotated[SeriesDateQueries, Depends(SeriesDateQueries.depends())],
     db: DB = Depends(),
 ):
     aggregate_to = "month"
     query = QueryBuilder(sensors)
     response = await fetch_days_aggregated(query, aggregate_to, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
@@ -328,36 +680,1225 @@ async def sensor_daily_aggregate_to_month_get(
     summary="Get measurements aggregated from day to year by sensor ID",
     description="Provides a list of yearly summaries of daily data by sensor ID",
 )
+@trusted_response
 async def sensor_daily_aggregate_to_year_get(
-    sensors: Annotated[PagedDateQueries, Depends(PagedDateQueries.depends())],
+    sensors: Annotated[SeriesDateQueries, Depends(SeriesDateQueries.depends())],
     db: DB = Depends(),
 ):
     aggregate_to = "year"
     query = QueryBuilder(sensors)
     response = await fetch_days_aggregated(query, aggregate_to, db)
-    return response
+    return series_response(sensors, response)
 
 
 @router.get(
     "/sensors/{sensors_id}/years",
     response_model=AnnualDataResponse,
     summary="Get measurements aggregated to year by sensor ID",
-    description="Provides a list of annual data by sensor ID",
+    description="Provides a list of annual data by sensor ID \
+        Send `Accept: application/vnd.apache.arrow.stream` or \
+        `Accept: application/vnd.apache.parquet` to download the whole \
+        requested range as a table instead, paging does not apply.",
+    responses=table_responses,
 )
+@trusted_response
 async def sensor_yearly_get(
-    sensors: Annotated[PagedDateQueries, Depends(PagedDateQueries.depends())],
+    sensors: Annotated[SeriesDateQueries, Depends(SeriesDateQueries.depends())],
     db: DB = Depends(),
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
 ):
+    media_type = table_media_type(accept)
+    if media_type:
+        return await fetch_series_table(
+            sensors, "annual_data", years_sql, media_type, db
+        )
     query = QueryBuilder(sensors)
     response = await fetch_years(query, db)
-    return response
+    return series_response(sensors, response)
+
+
+# Precomputed rollups keyed by the source table and the period aggregated to.
+# A rollup is only a substitute when it holds the same statistics over the
+# same values, e.g. daily_data is built from hourly_data and so can not
+# replace measurements aggregated to days, and percentiles can not be merged
+# from finer rollups.
+rollups = {
+    ("measurements", "hour"): "hourly_data",
+    ("hourly_data", "day"): "daily_data",
+    ("hourly_data", "year"): "annual_data",
+}
+
+# aggregates of whole, closed periods keyed by sensor, source table, period
+# and the local period start, with the time they were stored. A row of None
+# marks a period without values. Entries are recomputed once older than
+# AGGREGATION_STORE_SECONDS so that late values are picked up.
+aggregated_periods = {}
+max_aggregated_periods = 20_000
+
+
+def period_start(value: datetime, period: str) -> datetime:
+    """Truncates a local datetime to the start of its period."""
+    value = value.replace(minute=0, second=0, microsecond=0)
+    if period in ("day", "month", "year"):
+        value = value.replace(hour=0)
+    if period in ("month", "year"):
+        value = value.replace(day=1)
+    if period == "year":
+        value = value.replace(month=1)
+    return value
+
+
+def next_period(value: datetime, period: str) -> datetime:
+    if period == "year":
+        return value.replace(year=value.year + 1)
+    elif period == "month":
+        if value.month == 12:
+            return value.replace(year=value.year + 1, month=1)
+        return value.replace(month=value.month + 1)
+    elif period == "day":
+        return value + timedelta(days=1)
+    return value + timedelta(hours=1)
+
+
+def local_datetime(value: datetime | date, tz: ZoneInfo) -> datetime:
+    """Naive local datetime for a query datetime.
+
+    Dates and naive datetimes are already local, see `DatetimeFromQuery`.
+    """
+    if not isinstance(value, datetime):
+        return datetime.combine(value, time())
+    if value.tzinfo is not None:
+        return value.astimezone(tz).replace(tzinfo=None)
+    return value
+
+
+def whole_periods(
+    datetime_from: datetime | date | None,
+    datetime_to: datetime | date | None,
+    period: str,
+    tz: ZoneInfo,
+    now: datetime,
+) -> tuple[datetime | None, datetime] | None:
+    """Finds the whole, closed periods within a datetime range.
+
+    Values are time ending so a period is covered by the values with a
+    datetime after its start up to and including its end.
+
+    Returns:
+        tuple of the local start of the first and end of the last whole
+        period, the start is None for an open range, or None if there are no
+        whole periods in the range.
+    """
+    end = local_datetime(now - timedelta(seconds=settings.ROLLUP_LAG_SECONDS), tz)
+    if datetime_to is not None:
+        end = min(end, local_datetime(datetime_to, tz))
+    end = period_start(end, period)
+    start = None
+    if datetime_from is not None:
+        start = local_datetime(datetime_from, tz)
+        if period_start(start, period) != start:
+            start = next_period(period_start(start, period), period)
+        if start >= end:
+            return None
+    return (
+        start and start.replace(tzinfo=tz),
+        end.replace(tzinfo=tz),
+    )
 
 
-async def fetch_measurements(query, db):
+def period_starts(start: datetime, end: datetime, period: str) -> list[datetime]:
+    starts = []
+    while start < end:
+        starts.append(start)
+        start = next_period(start, period)
+    return starts
+
+
+def plan_rollup(
+    source: str, aggregate_to: str, start: datetime | None, end: datetime
+) -> str | None:
+    """Picks the precomputed rollup to read whole periods from.
+
+    Returns:
+        name of the rollup table or None if the source table has to be used
+    """
+    rollup = rollups.get((source, aggregate_to))
+    if not settings.ROLLUP_PLANNER or rollup is None:
+        return None
+    if aggregate_to == "hour":
+        # local hours only line up with hourly_data for whole hour offsets
+        for value in (start, end):
+            if value is not None and value.utcoffset().total_seconds() % 3600:
+                return None
+    return rollup
+
+
+class SensorMetadata:
+    """The attributes of a sensor the time series are presented with."""
+
+    __slots__ = (
+        "sensors_id",
+        "locations_id",
+        "measurands_id",
+        "measurand",
+        "units",
+        "timezone",
+        "averaging_seconds",
+        "logging_seconds",
+        "parameter",
+        "loaded",
+    )
+
+    def __init__(self, row, loaded: float):
+        for name in self.__slots__[:-2]:
+            setattr(self, name, row[name])
+        self.parameter = {
+            "id": self.measurands_id,
+            "units": self.units,
+            "name": self.measurand,
+        }
+        self.loaded = loaded
+
+    def params(self) -> dict:
+        """Parameters of the time series templates without sensor joins."""
+        return {
+            "locations_id": self.locations_id,
+            "timezone": self.timezone,
+            "averaging_seconds": self.averaging_seconds,
+            "logging_seconds": self.logging_seconds,
+        }
+
+
+# metadata by sensors id, entries are reloaded once older than
+# SENSOR_METADATA_SECONDS
+sensors_metadata = {}
+max_sensors_metadata = 50_000
+
+
+async def sensor_metadata(sensors_id: int, db: DB) -> SensorMetadata | None:
+    """The metadata of a sensor from `sensors_metadata`.
+
+    Entries are loaded when missing and reloaded once they are older than
+    SENSOR_METADATA_SECONDS. Reloads do not read the query cache, which
+    can hold a row older than the entry.
+    """
+    now = time_module.monotonic()
+    metadata = sensors_metadata.get(sensors_id)
+    if (
+        metadata is not None
+        and now - metadata.loaded < settings.SENSOR_METADATA_SECONDS
+    ):
+        return metadata
+    rows = await db.fetch(
+        """
+        SELECT s.sensors_id
+        , sy.sensor_nodes_id as locations_id
+        , s.measurands_id
+        , m.measurand
+        , m.units
+        , tz.tzid as timezone
+        , s.data_averaging_period_seconds as averaging_seconds
+        , s.data_logging_period_seconds as logging_seconds
+        FROM sensors s
+        JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+        JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
+        JOIN timezones tz ON (sn.timezones_id = tz.timezones_id)
+        JOIN measurands m ON (s.measurands_id = m.measurands_id)
+        WHERE s.sensors_id = :sensors_id
+        """,
+        {"sensors_id": sensors_id},
+        cache_read=metadata is None,
+    )
+    if not rows:
+        sensors_metadata.pop(sensors_id, None)
+        return None
+    if len(sensors_metadata) >= max_sensors_metadata:
+        sensors_metadata.clear()
+    metadata = sensors_metadata[sensors_id] = SensorMetadata(rows[0], now)
+    return metadata
+
+
+def metadata_columns(table: str) -> dict:
+    """Column map of a time series query without the sensor joins."""
+    alias = "m" if table == "measurements" else "h"
+    return {"sensors_id": f"{alias}.sensors_id", "timezone": ":timezone::text"}
+
+
+async def sensor_timezone(sensors_id: int, db: DB) -> ZoneInfo | None:
+    metadata = await sensor_metadata(sensors_id, db)
+    return metadata and ZoneInfo(metadata.timezone)
+
+
+def excluded_where(excluded: int) -> str:
+    """Excludes time ending source values within whole periods.
+
+    The periods are passed as the `excluded_from_{n}` and `excluded_to_{n}`
+    parameters, an excluded_from of None is an open start.
+    """
+    return "".join(f"""
+        AND NOT (
+          (:excluded_from_{n}::timestamptz IS NULL OR m.datetime > :excluded_from_{n})
+          AND m.datetime <= :excluded_to_{n}
+        )""" for n in range(excluded))
+
+
+def excluded_dates_where(excluded: int) -> str:
+    """Excludes time beginning daily values within whole periods."""
+    return "".join(f"""
+        AND NOT (
+          m.datetime >= :excluded_from_{n}::date AND m.datetime < :excluded_to_{n}::date
+        )""" for n in range(excluded))
+
+
+async def fetch_aggregated(
+    query, source, aggregate_to, aggregated_sql, db, engine: bool = False
+):
+    """Aggregates the values of a source table to periods.
+
+    Whole, closed periods in the requested range are served from
+    `aggregated_periods` once they have been computed. Only the partial
+    periods at the edges of the range, the open period and whole periods
+    that have not been seen before are aggregated by the database, the
+    latter from a precomputed rollup when there is one, see `plan_rollup`.
+    The database is asked for no more rows than the end of the page, whole
+    periods after them are aggregated when a later page reaches them.
+
+    Args:
+        query: QueryBuilder of a single sensor query
+        source: table the values are aggregated from
+        aggregate_to: period to aggregate to
+        aggregated_sql: template of the aggregation, called with the query,
+            the period, the rollup and the number of excluded periods.
+        db: database connection
+        engine: summarize the source values with NumPy, see `numpy_engine`,
+            the template is then also called with an `engine` of True
+    """
+
+    async def aggregated(rollup, excluded):
+        if not engine:
+            return aggregated_sql(query, aggregate_to, rollup, excluded)
+        arrays = await fetch_values(query, source, params, excluded, db)
+        params.update(summarize_periods(arrays, source, aggregate_to))
+        return aggregated_sql(query, aggregate_to, rollup, excluded, True)
+
+    async def aggregated_page(rollup, excluded):
+        result = await db.fetchPage(await aggregated(rollup, excluded), params)
+        for row in result.results:
+            row.pop("period_start", None)
+        return await flagged_page(result, db)
+
+    params = query.params()
+    params["aggregate_to"] = aggregate_to
+    if source == "daily_data":
+        # days are time beginning and the date_to is included
+        datetime_from = params.get("date_from")
+        datetime_to = params.get("date_to") and params["date_to"] + timedelta(days=1)
+    else:
+        datetime_from = params.get("datetime_from")
+        datetime_to = params.get("datetime_to")
+    tz = await sensor_timezone(params["sensors_id"], db)
+    periods = tz and whole_periods(
+        datetime_from, datetime_to, aggregate_to, tz, datetime.now(timezone.utc)
+    )
+    if periods is None:
+        return await aggregated_page(None, 0)
+    start, end = periods
+    rollup = plan_rollup(source, aggregate_to, start, end)
+    if not settings.AGGREGATION_STORE or start is None:
+        excluded = []
+        if rollup is not None:
+            params["rollup_from"], params["rollup_to"] = start, end
+            params["rollup_stored"] = []
+            excluded = [(start, end)]
+        set_excluded(params, excluded, source)
+        return await aggregated_page(rollup, len(excluded))
+
+    # periods are matched on the local start the aggregation groups by,
+    # see the `period_start` of the aggregation templates
+    sensor = (params["sensors_id"], source, aggregate_to)
+    now = time_module.monotonic()
+    starts = period_starts(start, end, aggregate_to)
+    stored = {}
+    for s in starts:
+        entry = aggregated_periods.get((*sensor, s.replace(tzinfo=None)))
+        if entry and now - entry[1] < settings.AGGREGATION_STORE_SECONDS:
+            stored[s] = entry[0]
+    missing = [s for s in starts if s not in stored]
+    excluded = [(start, end)]
+    if missing and rollup is not None:
+        params["rollup_from"] = missing[0]
+        params["rollup_to"] = next_period(missing[-1], aggregate_to)
+        # stored periods between the missing ones are not read again
+        params["rollup_stored"] = [s for s in stored if missing[0] < s < missing[-1]]
+    elif missing:
+        excluded = stored_runs(starts, stored, aggregate_to)
+        rollup = None
+    else:
+        rollup = None
+    set_excluded(params, excluded, source)
+    page = params.get("page", 1)
+    limit = params.get("limit", 100)
+    # stored periods are not counted by the database, so no more than the
+    # rows up to the end of the page can be on the page
+    params["limit"], params["offset"] = page * limit, 0
+
+    rows = await db.fetch(await aggregated(rollup, len(excluded)), params)
+    found = rows[0]["found"] if rows else 0
+    results = []
+    computed = {}
+    for row in rows:
+        row = dict(row)
+        row.pop("found", None)
+        key = row.pop("period_start")
+        computed[key] = row
+        results.append((key, row))
+    if len(rows) == params["limit"]:
+        # the periods after the last row are aggregated for a later page
+        missing = [s for s in missing if s.replace(tzinfo=None) <= key]
+    if len(aggregated_periods) + len(missing) > max_aggregated_periods:
+        logger.warning("Clearing the aggregated periods")
+        aggregated_periods.clear()
+    for s in missing:
+        key = s.replace(tzinfo=None)
+        aggregated_periods[(*sensor, key)] = (computed.get(key), now)
+    for s, row in stored.items():
+        if row is not None:
+            results.append((s.replace(tzinfo=None), row))
+            found += 1
+    results.sort(key=lambda result: result[0])
+    results = [row for _, row in results[(page - 1) * limit : page * limit]]
+    return OpenAQResult(
+        meta=Meta(page=page, limit=limit, found=found),
+        results=await annotate_flags(results, db),
+    )
+
+
+def stored_runs(starts: list, stored: dict, period: str) -> list[tuple]:
+    """The ranges of consecutive stored periods, excluded from the source."""
+    runs = []
+    for s in starts:
+        if s not in stored:
+            continue
+        if runs and runs[-1][1] == s:
+            runs[-1] = (runs[-1][0], next_period(s, period))
+        else:
+            runs.append((s, next_period(s, period)))
+    return runs
+
+
+def set_excluded(params: dict, excluded: list, source: str):
+    for n, (excluded_from, excluded_to) in enumerate(excluded):
+        if source == "daily_data":
+            excluded_from, excluded_to = excluded_from.date(), excluded_to.date()
+        params[f"excluded_from_{n}"] = excluded_from
+        params[f"excluded_to_{n}"] = excluded_to
+
+
+def rollup_sql(rollup: str | None, aggregate_to: str) -> str:
+    """Selects the whole periods of a rollup as rows of the aggregate.
+
+    Returns the same columns as the source aggregation in
+    `measurements_aggregated_sql` and `hours_aggregated_sql`.
+    """
+    if rollup is None:
+        return ""
+    if rollup == "hourly_data":
+        # hourly_data is time ending and stored as a timestamp
+        period_from = "r.datetime - '1hour'::interval"
+        period_to = "r.datetime"
+    else:
+        # daily and annual data are stored as the local date they begin
+        period_from = "timezone(tz.tzid, r.datetime::timestamp)"
+        period_to = (
+            f"timezone(tz.tzid, (r.datetime + '1{aggregate_to}'::interval)::timestamp)"
+        )
+    return f"""
+        UNION ALL
+        SELECT
+        s.sensors_id
+        , s.measurands_id
+        , tz.tzid as timezone
+        , {period_from} as datetime
+        , s.data_averaging_period_seconds as avg_seconds
+        , s.data_logging_period_seconds as log_seconds
+        , {period_to} as last_period
+        , timezone(tz.tzid, r.datetime_first) as datetime_first
+        , timezone(tz.tzid, r.datetime_last) as datetime_last
+        , r.value_count
+        , r.value_avg
+        , r.value_sd
+        , r.value_min
+        , r.value_max
+        , r.value_p02
+        , r.value_p25
+        , r.value_p50
+        , r.value_p75
+        , r.value_p98
+        , current_timestamp as calculated_on
+        FROM {rollup} r
+        JOIN sensors s ON (r.sensors_id = s.sensors_id)
+        JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+        JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
+        JOIN timezones tz ON (sn.timezones_id = tz.timezones_id)
+        WHERE s.sensors_id = :sensors_id
+        AND (:rollup_from::timestamptz IS NULL OR {period_from} >= :rollup_from)
+        AND {period_to} <= :rollup_to
+        AND NOT {period_from} = ANY(:rollup_stored::timestamptz[])
+        """
+
+
+class SeriesCache:
+    """Rows of sensor time series in aligned, closed chunks.
+
+    Chunks are keyed by sensor, table and chunk start and the least recently
+    used chunks are dropped once more than `max_rows` rows are held. Chunks
+    older than SERIES_CACHE_SECONDS are dropped when they are read, so late
+    uploads and corrections of closed chunks are seen after a while.
+    """
+
+    def __init__(self, max_rows: int):
+        self.max_rows = max_rows
+        self.chunks = OrderedDict()
+        self.rows = 0
+
+    def get(self, key: tuple) -> list | None:
+        entry = self.chunks.get(key)
+        if entry is None:
+            return None
+        loaded, rows = entry
+        if time_module.monotonic() - loaded >= settings.SERIES_CACHE_SECONDS:
+            self.rows -= len(self.chunks.pop(key)[1])
+            return None
+        self.chunks.move_to_end(key)
+        return rows
+
+    def add(self, key: tuple, rows: list):
+        if key in self.chunks:
+            self.rows -= len(self.chunks.pop(key)[1])
+        self.chunks[key] = (time_module.monotonic(), rows)
+        self.rows += len(rows)
+        while self.rows > self.max_rows and len(self.chunks) > 1:
+            _, (_, dropped) = self.chunks.popitem(last=False)
+            self.rows -= len(dropped)
+
+    def clear(self):
+        self.chunks.clear()
+        self.rows = 0
+
+
+series_cache = SeriesCache(settings.SERIES_CACHE_ROWS)
+
+# chunk length of the cached time series tables
+series_chunks = {
+    "measurements": "day",
+    "hourly_data": "month",
+    "daily_data": "year",
+}
+
+
+class SensorFlags:
+    """The flag periods of a sensor, merged and sorted for overlap lookups.
+
+    Periods are closed, exclusive bounds are moved in by a microsecond, the
+    resolution of a timestamptz, and open bounds are the datetime limits.
+    """
+
+    def __init__(self, periods: list[tuple[datetime, datetime]]):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(periods):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def overlaps(self, start: datetime, end: datetime) -> bool:
+        i = bisect.bisect_right(self.starts, end) - 1
+        return i >= 0 and self.ends[i] >= start
+
+
+# flags by sensor, cleared when the flags table changes, see `check_flags`
+flags_cache = {}
+max_flags_sensors = 10_000
+flags_version = {"checked": 0.0, "version": None}
+
+
+async def check_flags(db: DB):
+    """Clears the `flags_cache` when the flags table has changed.
+
+    The table is small and compared by a digest of its rows at most every
+    `FLAGS_CHECK_SECONDS`, which also works on a read replica. The digest
+    is never read from the query cache, it would be as old as the cache.
+    """
+    now = time_module.monotonic()
+    if now - flags_version["checked"] < settings.FLAGS_CHECK_SECONDS:
+        return
+    flags_version["checked"] = now
+    rows = await db.fetch(
+        """
+        SELECT COUNT(1)::text || md5(COALESCE(string_agg(f::text, ',' ORDER BY f::text), ''))
+        FROM flags f
+        """,
+        {},
+        cache_read=False,
+    )
+    version = rows[0][0] if rows else None
+    if version != flags_version["version"]:
+        flags_cache.clear()
+        flags_version["version"] = version
 
-    query.set_column_map({"timezone": "tz.tzid"})
 
-    sql = f"""
+async def sensor_flags(sensors_ids: set[int], db: DB) -> dict[int, SensorFlags]:
+    """Gets the flags of sensors from the `flags_cache`, the missing
+    sensors are loaded with one query.
+
+    The query cache is not read so that the flags are loaded as they are
+    after a change found by `check_flags`.
+    """
+    await check_flags(db)
+    missing = [i for i in sensors_ids if i not in flags_cache]
+    if missing:
+        rows = await db.fetch(
+            """
+            SELECT s.sensors_id
+            , lower(f.period) as datetime_from
+            , upper(f.period) as datetime_to
+            , lower_inc(f.period) as from_inc
+            , upper_inc(f.period) as to_inc
+            FROM sensors s
+            JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+            JOIN flags f ON (f.sensor_nodes_id = sy.sensor_nodes_id)
+            WHERE s.sensors_id = ANY(:sensors_ids)
+            AND (f.sensors_ids IS NULL OR ARRAY[s.sensors_id] @> f.sensors_ids)
+            """,
+            {"sensors_ids": missing},
+            cache_read=False,
+        )
+        periods = {i: [] for i in missing}
+        for row in rows:
+            start, end = row["datetime_from"], row["datetime_to"]
+            if start is None:
+                start = datetime.min.replace(tzinfo=timezone.utc)
+            elif not row["from_inc"]:
+                start += timedelta.resolution
+            if end is None:
+                end = datetime.max.replace(tzinfo=timezone.utc)
+            elif not row["to_inc"]:
+                end -= timedelta.resolution
+            periods[row["sensors_id"]].append((start, end))
+        if len(flags_cache) + len(missing) > max_flags_sensors:
+            flags_cache.clear()
+        for i in missing:
+            flags_cache[i] = SensorFlags(periods[i])
+    return {i: flags_cache[i] for i in sensors_ids}
+
+
+def flag_window(sensors_id: str, dt: str, window: str) -> str:
+    """Columns of the window `annotate_flags` looks for flags in, the same
+    as `sensor_flags_exist(sensors_id, dt, window)` in the database."""
+    return f"""{sensors_id} as flags_sensors_id
+        , LEAST({dt}::timestamptz, {dt}::timestamptz + {window}) as flags_from
+        , GREATEST({dt}::timestamptz, {dt}::timestamptz + {window}) as flags_to"""
+
+
+async def annotate_flags(rows: list[dict], db: DB) -> list[dict]:
+    """Adds the flag_info to rows with a `flag_window`.
+
+    Returns new rows so that cached rows keep their window.
+    """
+    windows = [row for row in rows if "flags_sensors_id" in row]
+    if not windows:
+        return rows
+    flags = await sensor_flags({row["flags_sensors_id"] for row in windows}, db)
+    return [flagged_row(row, flags) for row in rows]
+
+
+def flagged_row(row, flags: dict[int, SensorFlags]) -> dict:
+    """A copy of a row with the flag_info of its `flag_window`, rows
+    without a window are returned as they are."""
+    if "flags_sensors_id" not in row:
+        return row
+    row = dict(row)
+    sensor = flags[row.pop("flags_sensors_id")]
+    row["flag_info"] = {
+        "has_flags": sensor.overlaps(row.pop("flags_from"), row.pop("flags_to"))
+    }
+    return row
+
+
+async def flagged_page(result: OpenAQResult, db: DB) -> OpenAQResult:
+    result.results = await annotate_flags(result.results, db)
+    return result
+
+
+def series_time(table: str, row: dict) -> datetime:
+    """The time ending datetime of a row of a time series template, before
+    it is assembled.
+
+    Days are compared as naive local datetimes at the end of the day, all
+    other rows as the timestamptz of the row.
+    """
+    if table == "daily_data":
+        day = row["datetime"]
+        if not isinstance(day, datetime):
+            day = datetime.combine(day, time())
+        return day + timedelta(days=1)
+    return row["datetime"]
+
+
+def series_range(
+    table: str, params: dict, tz: ZoneInfo, now: datetime
+) -> tuple[datetime, datetime] | None:
+    """The requested range as time ending bounds, see `series_time`."""
+    if table == "daily_data":
+        if params.get("date_from") is None:
+            return None
+        date_to = params.get("date_to") or now.astimezone(tz).date()
+        return (
+            datetime.combine(params["date_from"], time()),
+            datetime.combine(date_to, time()) + timedelta(days=1),
+        )
+    if params.get("datetime_from") is None:
+        return None
+    bounds = []
+    for value in (params["datetime_from"], params.get("datetime_to") or now):
+        bounds.append(
+            local_datetime(value, tz).replace(tzinfo=tz).astimezone(timezone.utc)
+        )
+    return tuple(bounds)
+
+
+def chunk_query(table: str, sensors_id: int, start: datetime, end: datetime):
+    """Query of all the rows of a sensor within a range of chunks."""
+    if table == "daily_data":
+        return QueryBuilder(
+            PagedDateQueries(
+                sensors_id=sensors_id,
+                date_from=start.date(),
+                date_to=(end - timedelta(days=1)).date(),
+            )
+        )
+    return QueryBuilder(
+        PagedDatetimeQueries(
+            sensors_id=sensors_id, datetime_from=start, datetime_to=end
+        )
+    )
+
+
+# native interval of the time series tables in seconds, measurements use
+# the logging interval of the sensor
+series_steps = {"hourly_data": 3600, "daily_data": 86400}
+
+
+def epoch_seconds(value: datetime) -> int:
+    """Epoch seconds of a `series_time`, naive datetimes are read as UTC."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def downsample(
+    table: str,
+    rows: list[dict],
+    max_points: int,
+    step: int,
+    bounds: tuple[datetime, datetime] | None = None,
+) -> tuple[list[dict], int]:
+    """Thins time series rows to at most `max_points` rows for charting.
+
+    The range is split into `max_points // 2` buckets of a whole number of
+    steps and the rows with the lowest and the highest value of each bucket
+    are kept, see `bucket_extremes`. Rows are time ending and belong to the
+    bucket ending at or after their time.
+
+    Args:
+        table: the time series table of the rows
+        rows: the template rows in time order
+        max_points: the most rows to keep
+        step: native interval of the rows in seconds
+        bounds: the requested range, see `series_range`, defaults to the
+            range of the rows
+
+    Returns:
+        the kept rows and the bucket width in seconds, the step if the rows
+        already fit
+    """
+    if len(rows) <= max_points:
+        return rows, step
+    epochs = [epoch_seconds(series_time(table, row)) for row in rows]
+    if bounds:
+        start, end = (epoch_seconds(bound) for bound in bounds)
+    else:
+        start, end = epochs[0] - step, epochs[-1]
+    width = max(step, math.ceil((end - start) / (max_points // 2) / step) * step)
+    buckets = [(epoch - start - 1) // width for epoch in epochs]
+    values = [math.nan if row["value"] is None else row["value"] for row in rows]
+    if numpy_installed():
+        import numpy as np
+
+        indexes = bucket_extremes(
+            np.array(buckets, dtype=np.int64), np.array(values, dtype=np.float64)
+        ).tolist()
+    else:
+        extremes = {}
+        for i, (bucket, value) in enumerate(zip(buckets, values)):
+            if math.isnan(value):
+                continue
+            extreme = extremes.setdefault(bucket, [i, i])
+            if value < values[extreme[0]]:
+                extreme[0] = i
+            if value >= values[extreme[1]]:
+                extreme[1] = i
+        indexes = sorted({i for extreme in extremes.values() for i in extreme})
+    return [rows[i] for i in indexes], width
+
+
+stats_columns = dict.fromkeys(
+    (
+        "value_avg",
+        "value_sd",
+        "value_min",
+        "value_p02",
+        "value_p25",
+        "value_p50",
+        "value_p75",
+        "value_p98",
+        "value_max",
+    )
+)
+
+
+def gap_hour(end: datetime, value: float | None, sensors_id: int) -> dict:
+    """The row of an hour without data, as a row of `hours_sql`."""
+    return {
+        "datetime": end,
+        "datetime_first": None,
+        "datetime_last": None,
+        **stats_columns,
+        "value": value,
+        "value_count": 0,
+        "flags_sensors_id": sensors_id,
+        "flags_from": end - timedelta(hours=1),
+        "flags_to": end,
+    }
+
+
+def fill_hours(
+    rows: list[dict],
+    fill: "GapFill",
+    bounds: tuple[datetime, datetime] | None,
+    metadata: "SensorMetadata",
+) -> tuple[list[dict], dict | None]:
+    """Puts hourly rows on the regular grid of the hours of a period.
+
+    The rows are reindexed by `grid_reindex` and the hours without a row are
+    added by `gap_hour`, with a null value or with a value interpolated
+    between the nearest hours with values. The coverage of the period is
+    counted in the same pass.
+
+    Args:
+        rows: the template rows in time order, within the bounds
+        fill: how the hours without a row are filled
+        bounds: the requested period, see `series_range`, defaults to the
+            range of the rows
+        metadata: the attributes of the sensor
+
+    Returns:
+        the rows of every hour of the period and the coverage of the period,
+        None if the period has no whole hour
+    """
+    epochs = [epoch_seconds(series_time("hourly_data", row)) for row in rows]
+    if bounds:
+        start, end = (epoch_seconds(bound) for bound in bounds)
+    elif rows:
+        start, end = epochs[0] - 3600, epochs[-1]
+    else:
+        return rows, None
+    # the end of the first and the last hour within the period
+    first = (start // 3600 + 1) * 3600
+    size = (end // 3600 * 3600 - first) // 3600 + 1
+    if size <= 0:
+        return rows, None
+    slots = [(epoch - first) // 3600 for epoch in epochs]
+    values = [math.nan if row["value"] is None else row["value"] for row in rows]
+    interpolate = fill == GapFill.linear
+    if numpy_installed():
+        import numpy as np
+
+        grid_rows, grid_values = (
+            column.tolist()
+            for column in grid_reindex(
+                np.array(slots, dtype=np.int64),
+                np.array(values, dtype=np.float64),
+                size,
+                interpolate,
+            )
+        )
+    else:
+        grid_rows, grid_values = [-1] * size, [math.nan] * size
+        for i, slot in enumerate(slots):
+            grid_rows[slot], grid_values[slot] = i, values[i]
+        if interpolate:
+            known = [slot for slot, value in enumerate(grid_values) if value == value]
+            for a, b in zip(known, known[1:]):
+                slope = (grid_values[b] - grid_values[a]) / (b - a)
+                for slot in range(a + 1, b):
+                    if grid_rows[slot] < 0:
+                        grid_values[slot] = slope * (slot - a) + grid_values[a]
+    filled = []
+    for slot, (row, value) in enumerate(zip(grid_rows, grid_values)):
+        if row >= 0:
+            filled.append(rows[row])
+        else:
+            end_of_hour = datetime.fromtimestamp(first + slot * 3600, timezone.utc)
+            value = None if math.isnan(value) else value
+            filled.append(gap_hour(end_of_hour, value, metadata.sensors_id))
+    tzid = metadata.timezone
+    coverage = calculate_coverage(len(rows), 3600, 3600, size * 3600)
+    coverage["datetime_from"] = datetime_object(
+        datetime.fromtimestamp(first - 3600, timezone.utc), tzid
+    )
+    coverage["datetime_to"] = datetime_object(
+        datetime.fromtimestamp(first + (size - 1) * 3600, timezone.utc), tzid
+    )
+    return filled, coverage
+
+
+@functools.lru_cache(maxsize=16_384)
+def datetime_strings(value: date | datetime, tzid: str) -> tuple[str, str]:
+    """The utc and local strings of `get_datetime_object(value, tzid)`.
+
+    Dates and naive datetimes are local times, the consecutive rows of a
+    series share their bounds so the conversions are cached.
+    """
+    tz = ZoneInfo(tzid)
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=tz)
+    return (
+        value.astimezone(timezone.utc).isoformat(timespec="seconds"),
+        value.astimezone(tz).isoformat(timespec="seconds"),
+    )
+
+
+def datetime_object(value: date | datetime | None, tzid: str) -> dict | None:
+    if value is None:
+        return None
+    utc, local = datetime_strings(value, tzid)
+    return {"utc": utc, "local": local}
+
+
+def interval_text(seconds: float | None) -> str | None:
+    """The text of `make_interval(secs=>seconds)`, e.g. 01:00:00."""
+    if seconds is None:
+        return None
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    text = f"{hours:02d}:{minutes:02d}:{int(seconds):02d}"
+    if seconds % 1:
+        text += f"{seconds % 1:.6f}".rstrip("0")[1:]
+    return text
+
+
+def round_half_up(value: float) -> int:
+    """ROUND of a numeric, halves are rounded away from zero."""
+    return int(math.copysign(math.floor(abs(value) + 0.5), value))
+
+
+def calculate_coverage(
+    observed: int, averaging: float, logging: float, duration: float
+) -> dict:
+    """The coverage of `calculate_coverage` in the database."""
+    expected = round_half_up(duration / logging)
+    return {
+        "observed_count": observed,
+        "observed_interval": interval_text(averaging * observed),
+        "expected_count": expected,
+        "expected_interval": interval_text(duration / logging * averaging),
+        "percent_complete": (
+            round_half_up(observed / expected * 100) if expected else None
+        ),
+        "percent_coverage": round_half_up(observed * averaging / duration * 100),
+    }
+
+
+def summary_object(row) -> dict:
+    return {
+        "avg": row["value_avg"],
+        "sd": row["value_sd"],
+        "min": row["value_min"],
+        "q02": row["value_p02"],
+        "q25": row["value_p25"],
+        "median": row["value_p50"],
+        "q75": row["value_p75"],
+        "q98": row["value_p98"],
+        "max": row["value_max"],
+    }
+
+
+def flag_columns(row) -> dict:
+    return {
+        "flags_sensors_id": row["flags_sensors_id"],
+        "flags_from": row["flags_from"],
+        "flags_to": row["flags_to"],
+    }
+
+
+def assemble_measurement(row, metadata: "SensorMetadata") -> dict:
+    tzid = metadata.timezone
+    averaging = metadata.averaging_seconds
+    logging = metadata.logging_seconds
+    dt = row["datetime"]
+    datetime_to = datetime_object(dt, tzid)
+    coverage = {
+        "expected_count": 1,
+        "observed_count": 1,
+        "expected_interval": interval_text(logging),
+        "observed_interval": interval_text(averaging),
+        "datetime_from": datetime_object(dt - timedelta(seconds=averaging), tzid),
+        "datetime_to": datetime_to,
+        "percent_complete": 100,
+        # integer division as in the database
+        "percent_coverage": (averaging // logging) * 100,
+    }
+    return {
+        "sensors_id": row["sensors_id"],
+        "value": row["value"],
+        "period": {
+            "label": "raw",
+            "interval": interval_text(logging),
+            "datetime_from": datetime_object(dt - timedelta(seconds=logging), tzid),
+            "datetime_to": datetime_to,
+        },
+        "coverage": coverage,
+        **flag_columns(row),
+    }
+
+
+def assemble_hour(row, metadata: "SensorMetadata") -> dict:
+    tzid = metadata.timezone
+    dt = row["datetime"]
+    coverage = calculate_coverage(
+        row["value_count"], metadata.averaging_seconds, metadata.logging_seconds, 3600
+    )
+    if row["datetime_first"] is not None:
+        coverage["datetime_from"] = datetime_object(
+            row["datetime_first"] - timedelta(hours=1), tzid
+        )
+        coverage["datetime_to"] = datetime_object(row["datetime_last"], tzid)
+    return {
+        "id": metadata.locations_id,
+        "period": {
+            "label": "1hour",
+            "datetime_from": datetime_object(dt - timedelta(hours=1), tzid),
+            "datetime_to": datetime_object(dt, tzid),
+            "interval": "01:00:00",
+        },
+        "summary": summary_object(row),
+        "value": row["value"],
+        "coverage": coverage,
+        **flag_columns(row),
+    }
+
+
+def assemble_day(row, metadata: "SensorMetadata") -> dict:
+    tzid = metadata.timezone
+    day = row["datetime"]
+    coverage = calculate_coverage(row["value_count"], 3600, 3600, 24 * 3600)
+    coverage["datetime_from"] = datetime_object(row["datetime_first"], tzid)
+    coverage["datetime_to"] = datetime_object(row["datetime_last"], tzid)
+    return {
+        "id": metadata.locations_id,
+        "period": {
+            "label": "1day",
+            "datetime_from": datetime_object(day, tzid),
+            "datetime_to": datetime_object(day + timedelta(days=1), tzid),
+            "interval": "24:00:00",
+        },
+        "summary": summary_object(row),
+        "value": row["value"],
+        "coverage": coverage,
+        **flag_columns(row),
+    }
+
+
+# builds the response objects of the scalar columns of a series template
+series_assemblers = {
+    "measurements": assemble_measurement,
+    "hourly_data": assemble_hour,
+    "daily_data": assemble_day,
+}
+
+
+def chunk_starts(table: str, start: datetime, end: datetime) -> list[datetime]:
+    """The starts of the `series_chunks` of a range."""
+    period = series_chunks[table]
+    return period_starts(period_start(start, period), end, period)
+
+
+def check_series_range(table: str, requested: tuple | None):
+    """Limits the range of a whole series read for `fill` or `max_points`
+    to `SERIES_CACHE_MAX_CHUNKS` chunks.
+
+    Raises:
+        HTTPException: if the range has no start or is longer
+    """
+    name = "date_from" if table == "daily_data" else "datetime_from"
+    if requested is None:
+        raise HTTPException(
+            status_code=422, detail=f"{name} is required with max_points or fill"
+        )
+    if len(chunk_starts(table, *requested)) > settings.SERIES_CACHE_MAX_CHUNKS:
+        raise HTTPException(
+            status_code=422,
+            detail=(
+                "max_points and fill are limited to ranges of "
+                f"{settings.SERIES_CACHE_MAX_CHUNKS} {series_chunks[table]}s"
+            ),
+        )
+
+
+async def fetch_series(query, table, series_sql, db):
+    """Fetches a page of a sensor time series through the `series_cache`.
+
+    The requested range is split into chunks aligned to `series_chunks`.
+    Closed chunks are read from the cache, the missing and the open chunks
+    are fetched in one query and the page is sliced from the chunk rows.
+    Requests without a start or spanning more than `SERIES_CACHE_MAX_CHUNKS`
+    chunks go straight to the database.
+
+    With `fill` or `max_points` the whole range is read instead of a page,
+    see `check_series_range`. It is put on a regular grid by `fill_hours`
+    and thinned by `downsample`, the interval of the returned rows is
+    returned as the resolution.
+
+    The sensor attributes come from `sensor_metadata` so the template only
+    reads the time series table. It returns scalar columns, the chunks are
+    cached, gap filled and thinned as such and only the rows of the response
+    are assembled. The period, coverage and datetime objects are built by
+    the `series_assemblers` and the parameter is added to the rows here.
+    """
+    params = query.params()
+    page = params.get("page", 1)
+    limit = params.get("limit", 100)
+    max_points = params.get("max_points")
+    fill = params.get("fill")
+    metadata = await sensor_metadata(params["sensors_id"], db)
+    if metadata is None:
+        return OpenAQResult(meta=Meta(page=page, limit=limit, found=0), results=[])
+    params.update(metadata.params())
+    columns = metadata_columns(table)
+    query.set_column_map(columns)
+    assemble = series_assemblers[table]
+
+    async def present(rows):
+        rows = await annotate_flags([assemble(row, metadata) for row in rows], db)
+        for row in rows:
+            row["parameter"] = metadata.parameter
+        return rows
+
+    async def fetch_page():
+        if max_points or fill:
+            rows = await db.fetch(
+                series_sql(query, True), {**params, "limit": None, "offset": 0}
+            )
+            return await whole(rows)
+        result = await db.fetchPage(series_sql(query, True), params)
+        result.results = await present(result.results)
+        return result
+
+    async def whole(rows):
+        step = series_steps.get(table) or metadata.logging_seconds
+        coverage = None
+        if fill:
+            rows, coverage = fill_hours(rows, fill, requested, metadata)
+        found = len(rows)
+        if max_points:
+            rows, step = downsample(table, rows, max_points, step, requested)
+            found = len(rows)
+        else:
+            rows = rows[(page - 1) * limit : page * limit]
+        meta = SeriesMeta(
+            page=1 if max_points else page,
+            limit=max_points or limit,
+            found=found,
+            resolution=interval_text(step),
+            coverage=coverage,
+        )
+        return OpenAQResult(meta=meta, results=await present(rows))
+
+    tz = ZoneInfo(metadata.timezone)
+    now = datetime.now(timezone.utc)
+    requested = series_range(table, params, tz, now)
+    if max_points or fill:
+        check_series_range(table, requested)
+    bounds = settings.SERIES_CACHE and requested
+    if not bounds:
+        return await fetch_page()
+    start, end = bounds
+    period = series_chunks[table]
+    if table == "daily_data":
+        now = local_datetime(now, tz)
+    closed = now - timedelta(seconds=settings.ROLLUP_LAG_SECONDS)
+
+    starts = chunk_starts(table, start, end)
+    if len(starts) > settings.SERIES_CACHE_MAX_CHUNKS:
+        return await fetch_page()
+
+    sensor = (params["sensors_id"], table)
+    chunks = {c: series_cache.get((*sensor, c)) for c in starts}
+    missing = [c for c, rows in chunks.items() if rows is None]
+    if missing:
+        missing_to = next_period(missing[-1], period)
+        missing_query = chunk_query(table, params["sensors_id"], missing[0], missing_to)
+        missing_query.set_column_map(columns)
+        missing_params = missing_query.params()
+        missing_params.update(metadata.params(), limit=None, offset=0)
+        rows = await db.fetch(series_sql(missing_query, True), missing_params)
+        fetched = {c: [] for c in missing}
+        for row in rows:
+            # rows are time ending and belong to the chunk ending at their time
+            c = period_start(series_time(table, row) - timedelta.resolution, period)
+            if c in fetched:
+                fetched[c].append(row)
+        for c in missing:
+            chunks[c] = fetched[c]
+            if next_period(c, period) <= closed:
+                series_cache.add((*sensor, c), fetched[c])
+
+    results = [
+        row
+        for c in starts
+        for row in chunks[c]
+        if start < series_time(table, row) <= end
+    ]
+    if max_points or fill:
+        return await whole(results)
+    return OpenAQResult(
+        meta=Meta(page=page, limit=limit, found=len(results)),
+        results=await present(results[(page - 1) * limit : page * limit]),
+    )
+
+
+@sql_template
+def measurements_sql(query: QueryBuilder, metadata: bool = False) -> str:
+    if metadata:
+        # scalar columns only, the sensor attributes are parameters from
+        # `sensor_metadata` and the objects are built by `assemble_measurement`
+        window = "make_interval(secs=>:averaging_seconds::int*-1)"
+        return f"""
+        SELECT m.sensors_id
+        , m.value
+        , m.datetime
+        , {flag_window("m.sensors_id", "m.datetime", window)}
+        FROM measurements m
+        {query.where()}
+        ORDER BY datetime
+        {query.pagination()}
+        """
+    return f"""
       SELECT m.sensors_id
        , value
         , get_datetime_object(m.datetime, tz.tzid)
@@ -382,7 +1923,7 @@ async def fetch_measurements(query, db):
        , 'percent_complete', 100
        , 'percent_coverage', (s.data_averaging_period_seconds/s.data_logging_period_seconds)*100
       ) as coverage
-        , sensor_flags_exist(m.sensors_id, m.datetime, make_interval(secs=>s.data_averaging_period_seconds*-1)) as flag_info
+        , {flag_window("m.sensors_id", "m.datetime", "make_interval(secs=>s.data_averaging_period_seconds*-1)")}
         FROM measurements m
         JOIN sensors s USING (sensors_id)
         JOIN measurands p USING (measurands_id)
@@ -393,10 +1934,16 @@ async def fetch_measurements(query, db):
         ORDER BY datetime
         {query.pagination()}
         """
-    return await db.fetchPage(sql, query.params())
 
 
-async def fetch_measurements_aggregated(query, aggregate_to, db):
+async def fetch_measurements(query, db):
+    return await fetch_series(query, "measurements", measurements_sql, db)
+
+
+@sql_template
+def measurements_aggregated_sql(
+    query: QueryBuilder, aggregate_to: str, rollup: str | None = None, excluded: int = 0
+) -> str:
     if aggregate_to == "hour":
         dur = "01:00:00"
         expected_hours = 1
@@ -407,9 +1954,7 @@ async def fetch_measurements_aggregated(query, aggregate_to, db):
     else:
         raise Exception(f"{aggregate_to} is not supported")
 
-    query.set_column_map({"timezone": "tz.tzid"})
-
-    sql = f"""
+    return f"""
         WITH meas AS (
         SELECT
         s.sensors_id
@@ -439,7 +1984,9 @@ async def fetch_measurements_aggregated(query, aggregate_to, db):
         JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
         JOIN timezones tz ON (sn.timezones_id = tz.timezones_id)
         {query.where()}
-        GROUP BY 1, 2, 3, 4)
+        {excluded_where(excluded)}
+        GROUP BY 1, 2, 3, 4
+        {rollup_sql(rollup, aggregate_to)})
         SELECT t.sensors_id
         ----------
         , json_build_object(
@@ -478,20 +2025,51 @@ async def fetch_measurements_aggregated(query, aggregate_to, db):
                 'datetime_from', get_datetime_object(datetime_first - make_interval(secs=>log_seconds), t.timezone)
                 , 'datetime_to', get_datetime_object(datetime_last, t.timezone)
                 ) as coverage
-        , sensor_flags_exist(t.sensors_id, t.datetime, '-{dur}'::interval) as flag_info
+        , {flag_window("t.sensors_id", "t.datetime", f"'-{dur}'::interval")}
+        , timezone(t.timezone, t.datetime) as period_start
         {query.total()}
         FROM meas t
         JOIN measurands m ON (t.measurands_id = m.measurands_id)
+        ORDER BY t.datetime
         {query.pagination()}
     """
 
-    params = query.params()
-    params["aggregate_to"] = aggregate_to
-    return await db.fetchPage(sql, params)
+
+async def fetch_measurements_aggregated(query, aggregate_to, db):
+    query.set_column_map({"timezone": "tz.tzid"})
+    return await fetch_aggregated(
+        query, "measurements", aggregate_to, measurements_aggregated_sql, db
+    )
 
 
-async def fetch_hours(query, db):
-    sql = f"""
+@sql_template
+def hours_sql(query: QueryBuilder, metadata: bool = False) -> str:
+    if metadata:
+        # scalar columns only, the sensor attributes are parameters from
+        # `sensor_metadata` and the objects are built by `assemble_hour`
+        return f"""
+        SELECT h.datetime
+        , h.datetime_first
+        , h.datetime_last
+        , h.value_count
+        , h.value_avg
+        , h.value_sd
+        , h.value_min
+        , h.value_p02
+        , h.value_p25
+        , h.value_p50
+        , h.value_p75
+        , h.value_p98
+        , h.value_max
+        , sig_digits(h.value_avg, 3) as value
+        , {flag_window("h.sensors_id", "h.datetime", "'-1hour'::interval")}
+        {query.fields()}
+        FROM hourly_data h
+        {query.where()}
+        ORDER BY datetime
+        {query.pagination()}
+        """
+    return f"""
         SELECT sn.id
         , json_build_object(
         'label', '1hour'
@@ -525,7 +2103,7 @@ async def fetch_hours(query, db):
           'datetime_from', get_datetime_object(h.datetime_first - '1h'::interval, sn.timezone)
         , 'datetime_to', get_datetime_object(h.datetime_last, sn.timezone)
         ) as coverage
-        , sensor_flags_exist(h.sensors_id, h.datetime) as flag_info
+        , {flag_window("h.sensors_id", "h.datetime", "'-1hour'::interval")}
         {query.fields()}
         FROM hourly_data h
         JOIN sensors s USING (sensors_id)
@@ -536,10 +2114,118 @@ async def fetch_hours(query, db):
         ORDER BY datetime
         {query.pagination()}
         """
-    return await db.fetchPage(sql, query.params())
 
 
-async def fetch_hours_aggregated(query, aggregate_to, db):
+async def fetch_hours(query, db):
+    return await fetch_series(query, "hourly_data", hours_sql, db)
+
+
+@sql_template
+def sensors_hours_sql(query: QueryBuilder) -> str:
+    return f"""
+        WITH hours AS (
+        SELECT h.*
+        , sn.id
+        , sn.timezone
+        , ROW_NUMBER() OVER (PARTITION BY h.sensors_id ORDER BY h.datetime) as rn
+        , COUNT(1) OVER (PARTITION BY h.sensors_id) as found
+        FROM hourly_data h
+        JOIN sensors s USING (sensors_id)
+        JOIN sensor_systems sy USING (sensor_systems_id)
+        JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)
+        {query.where()}
+        )
+        SELECT h.id
+        , h.sensors_id
+        , h.found
+        , json_build_object(
+        'label', '1hour'
+        , 'datetime_from', get_datetime_object(h.datetime - '1hour'::interval, h.timezone)
+        , 'datetime_to', get_datetime_object(h.datetime, h.timezone)
+        , 'interval',  '01:00:00'
+        ) as period
+        , json_build_object(
+        'id', s.measurands_id
+        , 'units', m.units
+        , 'name', m.measurand
+        ) as parameter
+        , json_build_object(
+             'avg', h.value_avg
+           , 'sd', h.value_sd
+        , 'min', h.value_min
+        , 'q02', h.value_p02
+        , 'q25', h.value_p25
+        , 'median', h.value_p50
+        , 'q75', h.value_p75
+        , 'q98', h.value_p98
+        , 'max', h.value_max
+        ) as summary
+        , sig_digits(h.value_avg, 3) as value
+        , calculate_coverage(
+          h.value_count
+        , s.data_averaging_period_seconds
+        , s.data_logging_period_seconds
+        , 1 * 3600
+        )||jsonb_build_object(
+          'datetime_from', get_datetime_object(h.datetime_first - '1h'::interval, h.timezone)
+        , 'datetime_to', get_datetime_object(h.datetime_last, h.timezone)
+        ) as coverage
+        , {flag_window("h.sensors_id", "h.datetime", "'-1hour'::interval")}
+        FROM hours h
+        JOIN sensors s USING (sensors_id)
+        JOIN measurands m ON (m.measurands_id = s.measurands_id)
+        WHERE h.rn > :offset AND h.rn <= :offset + :limit
+        ORDER BY h.sensors_id, h.datetime
+        """
+
+
+def sensors_hours_params(query: QueryBuilder) -> dict:
+    params = query.params()
+    params.setdefault("page", 1)
+    params.setdefault("limit", 100)
+    params["offset"] = (params["page"] - 1) * params["limit"]
+    return params
+
+
+async def fetch_sensors_hours(query, db):
+    params = sensors_hours_params(query)
+    rows = await annotate_flags(await db.fetch(sensors_hours_sql(query), params), db)
+    series = {
+        sensors_id: {"sensors_id": sensors_id, "found": 0, "results": []}
+        for sensors_id in params["sensors_id"]
+    }
+    for row in rows:
+        sensor = series[row["sensors_id"]]
+        sensor["found"] = row["found"]
+        sensor["results"].append(dict(row))
+    return OpenAQResult(
+        meta=Meta(page=params["page"], limit=params["limit"], found=len(series)),
+        results=list(series.values()),
+    )
+
+
+async def stream_sensors_hours(query, db):
+    params = sensors_hours_params(query)
+    rows = await open_stream(db.stream(sensors_hours_sql(query), params))
+    # the flags of every requested sensor are loaded once for the stream
+    flags = await sensor_flags(set(params["sensors_id"]), db)
+    return (
+        SensorHourlyData.model_validate(flagged_row(row, flags)).model_dump_json(
+            by_alias=True
+        )
+        + "\n"
+        async for row in rows
+    )
+
+
+@sql_template
+def hours_aggregated_sql(
+    query: QueryBuilder,
+    aggregate_to: str,
+    rollup: str | None = None,
+    excluded: int = 0,
+    engine: bool = False,
+) -> str:
     if aggregate_to == "year":
         dur = "1year"
     elif aggregate_to == "month":
@@ -549,10 +2235,10 @@ async def fetch_hours_aggregated(query, aggregate_to, db):
     else:
         raise Exception(f"{aggregate_to} is not supported")
 
-    query.set_column_map({"timezone": "tz.tzid"})
-
-    sql = f"""
-        WITH meas AS (
+    if engine:
+        aggregated = engine_periods_sql("hourly_data")
+    else:
+        aggregated = f"""
         SELECT
         s.sensors_id
         , s.measurands_id
@@ -581,7 +2267,14 @@ async def fetch_hours_aggregated(query, aggregate_to, db):
         JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
         JOIN timezones tz ON (sn.timezones_id = tz.timezones_id)
         {query.where()}
-        GROUP BY 1, 2, 3, 4)
+        {excluded_where(excluded)}
+        GROUP BY 1, 2, 3, 4
+"""
+
+    return f"""
+        WITH meas AS (
+{aggregated}
+        {rollup_sql(rollup, aggregate_to)})
         SELECT t.sensors_id
         ----------
         , json_build_object(
@@ -620,19 +2313,541 @@ async def fetch_hours_aggregated(query, aggregate_to, db):
                 'datetime_from', get_datetime_object(datetime_first - '1h'::interval, t.timezone)
                 , 'datetime_to', get_datetime_object(datetime_last, t.timezone)
                 ) as coverage
-        , sensor_flags_exist(t.sensors_id, t.datetime, '-{dur}'::interval) as flag_info
+        , {flag_window("t.sensors_id", "t.datetime", f"'-{dur}'::interval")}
+        , timezone(t.timezone, t.datetime) as period_start
         {query.total()}
         FROM meas t
         JOIN measurands m ON (t.measurands_id = m.measurands_id)
+        ORDER BY t.datetime
         {query.pagination()}
     """
-    params = query.params()
-    params["aggregate_to"] = aggregate_to
-    return await db.fetchPage(sql, params)
 
 
-async def fetch_days_trends(aggregate_to, query, db):
+async def fetch_hours_aggregated(query, aggregate_to, db):
+    query.set_column_map({"timezone": "tz.tzid"})
+    return await fetch_aggregated(
+        query, "hourly_data", aggregate_to, hours_aggregated_sql, db, numpy_engine()
+    )
+
+
+def trends_merged_sql(coverage_type: str) -> str:
+    """Reads the observed trends merged by `merge_trends` from parameters."""
+    return f"""
+        SELECT s.sensors_id
+        , s.data_averaging_period_seconds
+        , s.data_logging_period_seconds
+        , s.timezone
+        , s.measurands_id
+        , s.measurand
+        , s.units
+        , o.*
+        , current_timestamp as calculated_on
+        FROM sensor s
+        , unnest(
+            :merged_factor::text[]
+          , :merged_coverage_first::{coverage_type}[]
+          , :merged_coverage_last::{coverage_type}[]
+          , :merged_n::int[]
+          , :merged_value_avg::float8[]
+          , :merged_value_sd::float8[]
+          , :merged_value_min::float8[]
+          , :merged_value_max::float8[]
+          , :merged_value_p02::float8[]
+          , :merged_value_p25::float8[]
+          , :merged_value_p50::float8[]
+          , :merged_value_p75::float8[]
+          , :merged_value_p98::float8[]
+          , :merged_rank_error::float8[]
+        ) AS o(factor, coverage_first, coverage_last, n, value_avg, value_sd
+          , value_min, value_max, value_p02, value_p25, value_p50, value_p75
+          , value_p98, rank_error)
+        """
+
+
+@sql_template
+def trends_partial_sql(query: QueryBuilder, aggregate_to: str, source: str) -> str:
+    """Summarizes the values of one chunk of a trend by factor.
+
+    Each factor has the sums for the avg and sd, the min and max and a
+    sketch of the values, their quantiles at `sketch_fractions`.
+    """
+    period_format = {"hod": "'HH24'", "dow": "'ID'", "moy": "'MM'"}[aggregate_to]
+    if source == "daily_data":
+        factor = f"to_char(datetime, {period_format})"
+    else:
+        factor = f"to_char(timezone(s.timezone, datetime - '1sec'::interval), {period_format})"
+    return f"""
+        WITH sensor AS (
+        SELECT s.sensors_id
+        , tz.tzid as timezone
+        FROM sensors s
+        JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+        JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
+        JOIN timezones tz ON (sn.timezones_id = tz.timezones_id)
+        WHERE s.sensors_id = :sensors_id
+        AND sn.is_public AND s.is_public
+        )
+        SELECT {factor} as factor
+        , MIN(datetime) as coverage_first
+        , MAX(datetime) as coverage_last
+        , COUNT(1) as n
+        , COUNT(value_avg) as count
+        , SUM(value_avg) as total
+        , SUM(value_avg * value_avg) as squares
+        , MIN(value_avg) as value_min
+        , MAX(value_avg) as value_max
+        , PERCENTILE_CONT(:sketch_fractions::float8[])
+            WITHIN GROUP (ORDER BY value_avg) as quantiles
+        FROM {source} m
+        JOIN sensor s ON (m.sensors_id = s.sensors_id)
+        {query.where()}
+        GROUP BY 1
+        """
+
+
+def trend_chunks(start, end, inclusive: bool = False) -> list[tuple]:
+    """Splits a trend range into chunks of about `TRENDS_CHUNK_DAYS` days.
+
+    Chunks are split on whole days and do not overlap, the end of a chunk
+    is the start of the next one unless the range is `inclusive` of both
+    ends, as dates are, in which case chunks end the day before.
+    """
+    if type(start) is not type(end) or getattr(start, "tzinfo", None) != getattr(
+        end, "tzinfo", None
+    ):
+        return [(start, end)]
+    days = (end - start) / timedelta(days=1)
+    n = min(settings.TRENDS_MAX_CHUNKS, math.ceil(days / settings.TRENDS_CHUNK_DAYS))
+    if n <= 1:
+        return [(start, end)]
+    step = timedelta(days=math.ceil(days / n))
+    edges = [start + i * step for i in range(n) if start + i * step < end]
+    edges.append(end)
+    chunks = []
+    for chunk_start, chunk_end in zip(edges, edges[1:]):
+        if inclusive and chunk_end != end:
+            chunk_end -= timedelta(days=1)
+        chunks.append((chunk_start, chunk_end))
+    return chunks
+
+
+def sketch_fractions() -> list[float]:
+    """The fractions of the quantiles in the sketch of a chunk,
+    `TRENDS_SKETCH_SIZE` evenly spaced from 0 to 1."""
+    steps = settings.TRENDS_SKETCH_SIZE - 1
+    return [i / steps for i in range(steps + 1)]
+
+
+def sketch_rank(quantiles: list[float], value: float) -> float:
+    """The fraction of the values of a sketch below a value, interpolated
+    between its quantiles."""
+    if value >= quantiles[-1]:
+        return 1.0
+    i = bisect.bisect_right(quantiles, value) - 1
+    if i < 0:
+        return 0.0
+    step = (value - quantiles[i]) / (quantiles[i + 1] - quantiles[i])
+    return (i + step) / (len(quantiles) - 1)
+
+
+def merged_quantile(sketches: list[tuple[int, list[float]]], fraction: float):
+    """Estimates a quantile of the values of several sketches.
+
+    The rank of a value is the mean of its ranks in the sketches weighted
+    by their counts, the quantile is interpolated between the values where
+    the rank crosses the fraction. With a single sketch the quantiles at
+    its own fractions are returned as they are.
+
+    Args:
+        sketches: the count and quantiles of each sketch
+        fraction: the quantile to estimate
+    """
+    total = sum(count for count, _ in sketches)
+    values = sorted({value for _, quantiles in sketches for value in quantiles})
+    previous = None
+    for value in values:
+        rank = math.fsum(count * sketch_rank(q, value) for count, q in sketches) / total
+        if rank >= fraction:
+            if previous is None:
+                return value
+            lower, lower_rank = previous
+            return lower + (fraction - lower_rank) / (rank - lower_rank) * (
+                value - lower
+            )
+        previous = value, rank
+    return values[-1]
+
+
+def merge_trends(partials: list[list]) -> dict:
+    """Merges the factors of chunks from `trends_partial_sql`.
+
+    The n, avg, sd, min and max are merged exactly from the sums of the
+    chunks and are calculated the same way as the observed trends in
+    `hours_trends_sql` and `days_trends_sql`. The percentiles are estimated
+    from the sketches of the chunks with `merged_quantile`, exact for a
+    factor of a single chunk, otherwise within a rank error of one step of
+    the sketches. The rank error is None for exact percentiles.
+
+    Returns:
+        dict of parameters for `trends_merged_sql`
+    """
+    factors = {}
+    for rows in partials:
+        for row in rows:
+            factor = factors.get(row["factor"])
+            if factor is None:
+                factor = factors[row["factor"]] = {
+                    "coverage_first": row["coverage_first"],
+                    "coverage_last": row["coverage_last"],
+                    "n": 0,
+                    "count": 0,
+                    "total": 0.0,
+                    "squares": 0.0,
+                    "sketches": [],
+                }
+            else:
+                factor["coverage_first"] = min(
+                    factor["coverage_first"], row["coverage_first"]
+                )
+                factor["coverage_last"] = max(
+                    factor["coverage_last"], row["coverage_last"]
+                )
+            factor["n"] += row["n"]
+            if row["count"]:
+                factor["count"] += row["count"]
+                factor["total"] += row["total"]
+                factor["squares"] += row["squares"]
+                factor["sketches"].append((row["count"], row["quantiles"]))
+                factor["value_min"] = min(
+                    row["value_min"], factor.get("value_min", math.inf)
+                )
+                factor["value_max"] = max(
+                    row["value_max"], factor.get("value_max", -math.inf)
+                )
+    columns = [
+        "factor",
+        "coverage_first",
+        "coverage_last",
+        "n",
+        "value_avg",
+        "value_sd",
+        "value_min",
+        "value_max",
+        "value_p02",
+        "value_p25",
+        "value_p50",
+        "value_p75",
+        "value_p98",
+        "rank_error",
+    ]
+    fractions = (0.02, 0.25, 0.5, 0.75, 0.98)
+    params = {f"merged_{column}": [] for column in columns}
+    for name in sorted(factors):
+        factor = factors[name]
+        count = factor["count"]
+        sketches = factor["sketches"]
+        avg = factor["total"] / count if count else None
+        sd = None
+        if count > 1:
+            variance = (factor["squares"] - count * avg * avg) / (count - 1)
+            sd = math.sqrt(max(variance, 0.0))
+        rank_error = None
+        if len(sketches) > 1:
+            rank_error = 1 / (len(sketches[0][1]) - 1)
+        merged = [
+            name,
+            factor["coverage_first"],
+            factor["coverage_last"],
+            factor["n"],
+            avg,
+            sd,
+            factor["value_min"] if count else None,
+            factor["value_max"] if count else None,
+            *(merged_quantile(sketches, f) if count else None for f in fractions),
+            rank_error,
+        ]
+        for column, value in zip(columns, merged):
+            params[f"merged_{column}"].append(value)
+    return params
+
+
+# the chunks of every trend share TRENDS_CONCURRENCY connections, fewer
+# than the pool, so long trends can not take every connection of the pool
+trend_slots = asyncio.Semaphore(settings.TRENDS_CONCURRENCY)
+
+
+async def fetch_trend_chunk(db, partial_sql: str, params: dict) -> list:
+    async with trend_slots:
+        return await db.fetch(partial_sql, params)
+
+
+async def fetch_trends_chunked(query, aggregate_to, source, params, chunks, db):
+    """Aggregates the chunks of a trend concurrently, each on its own
+    connection, and adds the merged statistics to the parameters."""
+    if source == "daily_data":
+        names = ("date_from", "date_to")
+    else:
+        names = ("datetime_from", "datetime_to")
+    partial_sql = trends_partial_sql(query, aggregate_to, source)
+    params["sketch_fractions"] = sketch_fractions()
+    partials = await asyncio.gather(
+        *(
+            fetch_trend_chunk(
+                db, partial_sql, {**params, names[0]: start, names[1]: end}
+            )
+            for start, end in chunks
+        )
+    )
+    params.update(merge_trends(partials))
+
+
+@functools.cache
+def numpy_installed() -> bool:
+    if importlib.util.find_spec("numpy") is None:
+        logger.warning("numpy is not installed, summaries stay in the database")
+        return False
+    return True
+
+
+def numpy_engine() -> bool:
+    """Whether summaries are calculated with NumPy in the API, see
+    `SUMMARY_ENGINE`, instead of by the database."""
+    return settings.SUMMARY_ENGINE == "numpy" and numpy_installed()
+
+
+@sql_template
+def values_sql(query: QueryBuilder, source: str, excluded: int = 0) -> str:
+    """Selects the values of a sensor as arrays of epoch seconds and values.
+
+    The local datetimes are the epoch seconds of the local time, daily data
+    is already local. Time ending sources need the `timezone` mapped to
+    `tz.tzid`.
+    """
+    if source == "daily_data":
+        joins = "JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)"
+        utc = local = "EXTRACT(EPOCH FROM m.datetime::timestamp)"
+        excluded_sql = excluded_dates_where(excluded)
+    else:
+        joins = """JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
+        JOIN timezones tz ON (sn.timezones_id = tz.timezones_id)"""
+        utc = "EXTRACT(EPOCH FROM m.datetime)"
+        local = "EXTRACT(EPOCH FROM timezone(tz.tzid, m.datetime))"
+        excluded_sql = excluded_where(excluded)
+    return f"""
+        SELECT array_agg({utc}::float8 ORDER BY m.datetime) as datetimes
+        , array_agg({local}::float8 ORDER BY m.datetime) as local_datetimes
+        , array_agg(m.value_avg::float8 ORDER BY m.datetime) as values
+        FROM {source} m
+        JOIN sensors s ON (m.sensors_id = s.sensors_id)
+        JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+        {joins}
+        {query.where()}
+        {excluded_sql}
+        """
+
+
+async def fetch_values(query, source, params, excluded, db) -> tuple:
+    """Fetches the values for `group_summaries`.
+
+    Returns:
+        tuple of float arrays of the utc and local epoch seconds and values
+    """
+    import numpy as np
+
+    rows = await db.fetch(values_sql(query, source, excluded), params)
+    row = rows[0] if rows else {}
+    return tuple(
+        np.array(row.get(column) or [], dtype=np.float64)
+        for column in ("datetimes", "local_datetimes", "values")
+    )
+
+
+def engine_periods_sql(source: str) -> str:
+    """Reads the periods summarized by `summarize_periods` from parameters.
+
+    Returns the same columns as the aggregation in `hours_aggregated_sql`
+    and `days_aggregated_sql`.
+    """
+    if source == "daily_data":
+        timezone = "sn.timezone"
+        joins = "JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)"
+        period_from = "o.datetime"
+        period_to = "o.last_period"
+        coverage_type = "date"
+    else:
+        timezone = "tz.tzid"
+        joins = """JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
+        JOIN timezones tz ON (sn.timezones_id = tz.timezones_id)"""
+        period_from = "timezone(tz.tzid, o.datetime)"
+        period_to = "timezone(tz.tzid, o.last_period)"
+        coverage_type = "timestamp"
+    return f"""
+        SELECT
+        s.sensors_id
+        , s.measurands_id
+        , {timezone} as timezone
+        , {period_from} as datetime
+        , s.data_averaging_period_seconds as avg_seconds
+        , s.data_logging_period_seconds as log_seconds
+        , {period_to} as last_period
+        , o.datetime_first
+        , o.datetime_last
+        , o.value_count
+        , o.value_avg
+        , o.value_sd
+        , o.value_min
+        , o.value_max
+        , o.value_p02
+        , o.value_p25
+        , o.value_p50
+        , o.value_p75
+        , o.value_p98
+        , current_timestamp as calculated_on
+        FROM sensors s
+        JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+        {joins}
+        , unnest(
+            :engine_datetime::timestamp[]
+          , :engine_last_period::timestamp[]
+          , :engine_datetime_first::{coverage_type}[]
+          , :engine_datetime_last::{coverage_type}[]
+          , :engine_value_count::int[]
+          , :engine_value_avg::float8[]
+          , :engine_value_sd::float8[]
+          , :engine_value_min::float8[]
+          , :engine_value_max::float8[]
+          , :engine_value_p02::float8[]
+          , :engine_value_p25::float8[]
+          , :engine_value_p50::float8[]
+          , :engine_value_p75::float8[]
+          , :engine_value_p98::float8[]
+        ) AS o(datetime, last_period, datetime_first, datetime_last, value_count
+          , value_avg, value_sd, value_min, value_max, value_p02, value_p25
+          , value_p50, value_p75, value_p98)
+        WHERE s.sensors_id = :sensors_id
+        """
+
+
+def local_times(local_datetimes, source: str):
+    """Local datetimes of values as datetime64, time ending values are
+    moved into the period they end, like `truncate_timestamp`."""
+    import numpy as np
+
+    seconds = local_datetimes.astype(np.int64)
+    if source != "daily_data":
+        seconds = seconds - 1
+    return seconds.astype("datetime64[s]")
+
+
+def summarize_periods(arrays: tuple, source: str, aggregate_to: str) -> dict:
+    """Summarizes values to periods with `group_summaries`.
+
+    Returns:
+        dict of parameters for `engine_periods_sql`
+    """
+    import numpy as np
+
+    _, local_datetimes, values = arrays
+    unit = {"hour": "h", "day": "D", "month": "M", "year": "Y"}[aggregate_to]
+    periods = local_times(local_datetimes, source).astype(f"datetime64[{unit}]")
+    summaries = group_summaries(periods.astype(np.int64), values)
+    starts = summaries["key"].astype(f"datetime64[{unit}]")
+
+    def covered(rows):
+        seconds = local_datetimes[rows].astype(np.int64).astype("datetime64[s]")
+        if source == "daily_data":
+            return seconds.astype("datetime64[D]").tolist()
+        return seconds.tolist()
+
+    return {
+        "engine_datetime": starts.astype("datetime64[s]").tolist(),
+        "engine_last_period": (starts + 1).astype("datetime64[s]").tolist(),
+        "engine_datetime_first": covered(summaries["first"]),
+        "engine_datetime_last": covered(summaries["last"]),
+        "engine_value_count": summaries["n"].tolist(),
+        "engine_value_avg": nullable(summaries["avg"]),
+        "engine_value_sd": nullable(summaries["sd"]),
+        "engine_value_min": nullable(summaries["min"]),
+        "engine_value_max": nullable(summaries["max"]),
+        "engine_value_p02": nullable(summaries[0.02]),
+        "engine_value_p25": nullable(summaries[0.25]),
+        "engine_value_p50": nullable(summaries[0.5]),
+        "engine_value_p75": nullable(summaries[0.75]),
+        "engine_value_p98": nullable(summaries[0.98]),
+    }
+
+
+def summarize_trends(arrays: tuple, source: str, aggregate_to: str) -> dict:
+    """Summarizes values by hour of day, day of week or month of year with
+    `group_summaries`, the NumPy version of `merge_trends`.
+
+    Returns:
+        dict of parameters for `trends_merged_sql`
+    """
+    import numpy as np
+
+    datetimes, local_datetimes, values = arrays
+    local = local_times(local_datetimes, source)
+    seconds = local.astype(np.int64)
+    if aggregate_to == "hod":
+        factors = seconds // 3600 % 24
+        label = "{:02d}"
+    elif aggregate_to == "dow":
+        # 1970-01-01 was a thursday, ISO day 4
+        factors = (seconds // 86400 + 3) % 7 + 1
+        label = "{:d}"
+    else:
+        factors = local.astype("datetime64[M]").astype(np.int64) % 12 + 1
+        label = "{:02d}"
+    summaries = group_summaries(factors, values)
+
+    def covered(rows):
+        seconds = datetimes[rows].astype(np.int64).astype("datetime64[s]")
+        if source == "daily_data":
+            return seconds.astype("datetime64[D]").tolist()
+        return [value.replace(tzinfo=timezone.utc) for value in seconds.tolist()]
+
+    return {
+        "merged_factor": [label.format(key) for key in summaries["key"].tolist()],
+        "merged_coverage_first": covered(summaries["first"]),
+        "merged_coverage_last": covered(summaries["last"]),
+        "merged_n": summaries["n"].tolist(),
+        "merged_value_avg": nullable(summaries["avg"]),
+        "merged_value_sd": nullable(summaries["sd"]),
+        "merged_value_min": nullable(summaries["min"]),
+        "merged_value_max": nullable(summaries["max"]),
+        "merged_value_p02": nullable(summaries[0.02]),
+        "merged_value_p25": nullable(summaries[0.25]),
+        "merged_value_p50": nullable(summaries[0.5]),
+        "merged_value_p75": nullable(summaries[0.75]),
+        "merged_value_p98": nullable(summaries[0.98]),
+        "merged_rank_error": [None] * len(summaries["key"]),
+    }
+
+
+async def fetch_trends_values(query, aggregate_to, source, params, chunks, db):
+    """Fetches the values of the chunks of a trend concurrently and adds
+    their summaries from `summarize_trends` to the parameters."""
+    import numpy as np
+
+    if source == "daily_data":
+        names = ("date_from", "date_to")
+    else:
+        names = ("datetime_from", "datetime_to")
+    chunks = await asyncio.gather(
+        *(
+            fetch_values(query, source, {**params, names[0]: s, names[1]: e}, 0, db)
+            for s, e in chunks
+        )
+    )
+    arrays = tuple(np.concatenate(columns) for columns in zip(*chunks))
+    params.update(summarize_trends(arrays, source, aggregate_to))
+
 
+@sql_template
+def days_trends_sql(
+    query: QueryBuilder, aggregate_to: str, merged: bool = False
+) -> str:
     if aggregate_to == "dow":
         period_name = "day"
         period_format = "'ID'"
@@ -649,18 +2864,41 @@ async def fetch_days_trends(aggregate_to, query, db):
     dur = "24:00:00"
     interval_seconds = 3600 * 24
 
-    params = query.params()
-    params["aggregate_to"] = aggregate_to
-
-    datetime_field_name = "date"
-    if params.get("date_to") is None:
-        params["date_to"] = date.today()
-
-    if params.get("date_from") is None:
-        dt = params.get("date_to")
-        params["date_from"] = dt - timedelta(days=365)
+    rank_error = ""
+    if merged:
+        rank_error = "\n   , 'rank_error', o.rank_error"
+        observed = trends_merged_sql("date")
+    else:
+        observed = f"""
+        SELECT
+        s.sensors_id
+        , s.data_averaging_period_seconds
+        , s.data_logging_period_seconds
+ , s.timezone
+ , s.measurands_id
+ , s.measurand
+ , s.units
+ , to_char(datetime, {period_format}) as factor
+ , MIN(datetime) as coverage_first
+ , MAX(datetime) as coverage_last
+ , COUNT(1) as n
+ , AVG(value_avg) as value_avg
+ , STDDEV(value_avg) as value_sd
+ , MIN(value_avg) as value_min
+ , MAX(value_avg) as value_max
+ , PERCENTILE_CONT(0.02) WITHIN GROUP(ORDER BY value_avg) as value_p02
+ , PERCENTILE_CONT(0.25) WITHIN GROUP(ORDER BY value_avg) as value_p25
+ , PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY value_avg) as value_p50
+ , PERCENTILE_CONT(0.75) WITHIN GROUP(ORDER BY value_avg) as value_p75
+ , PERCENTILE_CONT(0.98) WITHIN GROUP(ORDER BY value_avg) as value_p98
+ , current_timestamp as calculated_on
+ FROM daily_data m
+ JOIN sensor s ON (m.sensors_id = s.sensors_id)
+ {query.where()}
+ GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+"""
 
-    sql = f"""
+    return f"""
     -----------------------------------
     -- start by getting some basic sensor information
     -- and transforming the timestamps
@@ -704,32 +2942,7 @@ async def fetch_days_trends(aggregate_to, query, db):
     -- we join the sensor CTE here so that we have access to the timezone
     ------------------------------------
     ), observed AS (
-        SELECT
-        s.sensors_id
-        , s.data_averaging_period_seconds
-        , s.data_logging_period_seconds
- , s.timezone
- , s.measurands_id
- , s.measurand
- , s.units
- , to_char(datetime, {period_format}) as factor
- , MIN(datetime) as coverage_first
- , MAX(datetime) as coverage_last
- , COUNT(1) as n
- , AVG(value_avg) as value_avg
- , STDDEV(value_avg) as value_sd
- , MIN(value_avg) as value_min
- , MAX(value_avg) as value_max
- , PERCENTILE_CONT(0.02) WITHIN GROUP(ORDER BY value_avg) as value_p02
- , PERCENTILE_CONT(0.25) WITHIN GROUP(ORDER BY value_avg) as value_p25
- , PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY value_avg) as value_p50
- , PERCENTILE_CONT(0.75) WITHIN GROUP(ORDER BY value_avg) as value_p75
- , PERCENTILE_CONT(0.98) WITHIN GROUP(ORDER BY value_avg) as value_p98
- , current_timestamp as calculated_on
- FROM daily_data m
- JOIN sensor s ON (m.sensors_id = s.sensors_id)
- {query.where()}
- GROUP BY 1, 2, 3, 4, 5, 6, 7, 8)
+{observed})
 -----------------------------------------
 -- And finally we tie it all together
 -----------------------------------------
@@ -749,7 +2962,7 @@ async def fetch_days_trends(aggregate_to, query, db):
    , 'median', o.value_p50
    , 'q75', o.value_p75
    , 'q98', o.value_p98
-   , 'max', o.value_max
+   , 'max', o.value_max{rank_error}
      ) as summary
     , json_build_object(
        'label', e.factor
@@ -773,11 +2986,40 @@ async def fetch_days_trends(aggregate_to, query, db):
     ORDER BY e.factor
     """
 
-    return await db.fetchPage(sql, params)
 
+async def fetch_days_trends(aggregate_to, query, db):
+    sql = days_trends_sql(query, aggregate_to)
+    params = query.params()
+    params["aggregate_to"] = {"dow": "day", "moy": "month"}.get(aggregate_to)
+
+    datetime_field_name = "date"
+    if params.get("date_to") is None:
+        params["date_to"] = date.today()
+
+    if params.get("date_from") is None:
+        dt = params.get("date_to")
+        params["date_from"] = dt - timedelta(days=365)
+
+    chunks = [(params["date_from"], params["date_to"])]
+    # chunks are only bounded when the range is part of the query
+    if query.query.date_from is not None and query.query.date_to is not None:
+        chunks = trend_chunks(params["date_from"], params["date_to"], inclusive=True)
+    if numpy_engine():
+        await fetch_trends_values(query, aggregate_to, "daily_data", params, chunks, db)
+        sql = days_trends_sql(query, aggregate_to, True)
+    elif len(chunks) > 1:
+        await fetch_trends_chunked(
+            query, aggregate_to, "daily_data", params, chunks, db
+        )
+        sql = days_trends_sql(query, aggregate_to, True)
+
+    return await db.fetchPage(sql, params)
 
-async def fetch_hours_trends(aggregate_to, query, db):
 
+@sql_template
+def hours_trends_sql(
+    query: QueryBuilder, aggregate_to: str, merged: bool = False
+) -> str:
     if aggregate_to == "hod":
         period_name = "hour"
         period_format = "'HH24'"
@@ -800,17 +3042,41 @@ async def fetch_hours_trends(aggregate_to, query, db):
     dur = "01:00:00"
     interval_seconds = 3600
 
-    params = query.params()
-    params["aggregate_to"] = aggregate_to
-
-    if params.get("datetime_to") is None:
-        params["datetime_to"] = date.today()
-
-    if params.get("datetime_from") is None:
-        dt = params.get("datetime_to")
-        params["datetime_from"] = dt - timedelta(days=365)
+    rank_error = ""
+    if merged:
+        rank_error = "\n   , 'rank_error', o.rank_error"
+        observed = trends_merged_sql("timestamptz")
+    else:
+        observed = f"""
+        SELECT
+        s.sensors_id
+        , s.data_averaging_period_seconds
+        , s.data_logging_period_seconds
+ , s.timezone
+ , s.measurands_id
+ , s.measurand
+ , s.units
+ , to_char(timezone(s.timezone, datetime - '1sec'::interval), {period_format}) as factor
+ , MIN(datetime) as coverage_first
+ , MAX(datetime) as coverage_last
+ , COUNT(1) as n
+ , AVG(value_avg) as value_avg
+ , STDDEV(value_avg) as value_sd
+ , MIN(value_avg) as value_min
+ , MAX(value_avg) as value_max
+ , PERCENTILE_CONT(0.02) WITHIN GROUP(ORDER BY value_avg) as value_p02
+ , PERCENTILE_CONT(0.25) WITHIN GROUP(ORDER BY value_avg) as value_p25
+ , PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY value_avg) as value_p50
+ , PERCENTILE_CONT(0.75) WITHIN GROUP(ORDER BY value_avg) as value_p75
+ , PERCENTILE_CONT(0.98) WITHIN GROUP(ORDER BY value_avg) as value_p98
+ , current_timestamp as calculated_on
+ FROM hourly_data m
+ JOIN sensor s ON (m.sensors_id = s.sensors_id)
+ {query.where()}
+ GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+"""
 
-    sql = f"""
+    return f"""
     -----------------------------------
     -- start by getting some basic sensor information
     -- and transforming the timestamps
@@ -854,32 +3120,7 @@ async def fetch_hours_trends(aggregate_to, query, db):
     -- we join the sensor CTE here so that we have access to the timezone
     ------------------------------------
     ), observed AS (
-        SELECT
-        s.sensors_id
-        , s.data_averaging_period_seconds
-        , s.data_logging_period_seconds
- , s.timezone
- , s.measurands_id
- , s.measurand
- , s.units
- , to_char(timezone(s.timezone, datetime - '1sec'::interval), {period_format}) as factor
- , MIN(datetime) as coverage_first
- , MAX(datetime) as coverage_last
- , COUNT(1) as n
- , AVG(value_avg) as value_avg
- , STDDEV(value_avg) as value_sd
- , MIN(value_avg) as value_min
- , MAX(value_avg) as value_max
- , PERCENTILE_CONT(0.02) WITHIN GROUP(ORDER BY value_avg) as value_p02
- , PERCENTILE_CONT(0.25) WITHIN GROUP(ORDER BY value_avg) as value_p25
- , PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY value_avg) as value_p50
- , PERCENTILE_CONT(0.75) WITHIN GROUP(ORDER BY value_avg) as value_p75
- , PERCENTILE_CONT(0.98) WITHIN GROUP(ORDER BY value_avg) as value_p98
- , current_timestamp as calculated_on
- FROM hourly_data m
- JOIN sensor s ON (m.sensors_id = s.sensors_id)
- {query.where()}
- GROUP BY 1, 2, 3, 4, 5, 6, 7, 8)
+{observed})
 -----------------------------------------
 -- And finally we tie it all together
 -----------------------------------------
@@ -899,7 +3140,7 @@ async def fetch_hours_trends(aggregate_to, query, db):
    , 'median', o.value_p50
    , 'q75', o.value_p75
    , 'q98', o.value_p98
-   , 'max', o.value_max
+   , 'max', o.value_max{rank_error}
      ) as summary
     , json_build_object(
        'label', e.factor
@@ -922,12 +3163,52 @@ async def fetch_hours_trends(aggregate_to, query, db):
     JOIN observed o ON (e.factor = o.factor)
     ORDER BY e.factor
     """
+
+
+async def fetch_hours_trends(aggregate_to, query, db):
+    sql = hours_trends_sql(query, aggregate_to)
+    params = query.params()
+    params["aggregate_to"] = {"hod": "hour", "dow": "day", "moy": "month"}.get(
+        aggregate_to
+    )
+
+    if params.get("datetime_to") is None:
+        params["datetime_to"] = date.today()
+
+    if params.get("datetime_from") is None:
+        dt = params.get("datetime_to")
+        params["datetime_from"] = dt - timedelta(days=365)
+
     logger.debug(params)
 
+    chunks = [(params["datetime_from"], params["datetime_to"])]
+    # chunks are only bounded when the range is part of the query
+    if query.query.datetime_from is not None and query.query.datetime_to is not None:
+        chunks = trend_chunks(params["datetime_from"], params["datetime_to"])
+    if numpy_engine():
+        query.set_column_map({"timezone": "tz.tzid"})
+        await fetch_trends_values(
+            query, aggregate_to, "hourly_data", params, chunks, db
+        )
+        sql = hours_trends_sql(query, aggregate_to, True)
+    elif len(chunks) > 1:
+        await fetch_trends_chunked(
+            query, aggregate_to, "hourly_data", params, chunks, db
+        )
+        sql = hours_trends_sql(query, aggregate_to, True)
+
     return await db.fetchPage(sql, params)
 
 
-async def fetch_days_aggregated(query, aggregate_to, db):
+@sql_template
+def days_aggregated_sql(
+    query: QueryBuilder,
+    aggregate_to: str,
+    rollup: None = None,
+    excluded: int = 0,
+    engine: bool = False,
+) -> str:
+    # there is no rollup of daily data with the same statistics, see `rollups`
     if aggregate_to == "year":
         dur = "1year"
         interval_seconds = 3600 * 24 * 365.24
@@ -937,8 +3218,10 @@ async def fetch_days_aggregated(query, aggregate_to, db):
     else:
         raise Exception(f"{aggregate_to} is not supported")
 
-    sql = f"""
-        WITH meas AS (
+    if engine:
+        aggregated = engine_periods_sql("daily_data")
+    else:
+        aggregated = f"""
         SELECT
         s.sensors_id
         , s.measurands_id
@@ -968,7 +3251,13 @@ async def fetch_days_aggregated(query, aggregate_to, db):
         JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
         JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)
         {query.where()}
-        GROUP BY 1, 2, 3, 4)
+        {excluded_dates_where(excluded)}
+        GROUP BY 1, 2, 3, 4
+"""
+
+    return f"""
+        WITH meas AS (
+{aggregated})
         SELECT t.sensors_id
         ----------
         , json_build_object(
@@ -1007,20 +3296,50 @@ async def fetch_days_aggregated(query, aggregate_to, db):
                 'datetime_from', get_datetime_object(datetime_first, t.timezone)
                 , 'datetime_to', get_datetime_object(datetime_last + '1day'::interval, t.timezone)
                 ) as coverage
-        , sensor_flags_exist(t.sensors_id, t.datetime, '-{dur}'::interval) as flag_info
+        , {flag_window("t.sensors_id", "t.datetime", f"'-{dur}'::interval")}
+        , datetime::date::timestamp as period_start
         {query.total()}
         FROM meas t
         JOIN measurands m ON (t.measurands_id = m.measurands_id)
         ORDER BY datetime
         {query.pagination()}
     """
-    params = query.params()
-    params["aggregate_to"] = aggregate_to
-    return await db.fetchPage(sql, params)
 
 
-async def fetch_days(query, db):
-    sql = f"""
+async def fetch_days_aggregated(query, aggregate_to, db):
+    return await fetch_aggregated(
+        query, "daily_data", aggregate_to, days_aggregated_sql, db, numpy_engine()
+    )
+
+
+@sql_template
+def days_sql(query: QueryBuilder, metadata: bool = False) -> str:
+    if metadata:
+        # scalar columns only, the sensor attributes are parameters from
+        # `sensor_metadata` and the objects are built by `assemble_day`
+        return f"""
+        SELECT h.datetime
+        , h.datetime_first
+        , h.datetime_last
+        , h.value_count
+        , h.value_avg
+        , h.value_sd
+        , h.value_min
+        , h.value_p02
+        , h.value_p25
+        , h.value_p50
+        , h.value_p75
+        , h.value_p98
+        , h.value_max
+        , sig_digits(h.value_avg, 3) as value
+        , {flag_window("h.sensors_id", "h.datetime", "'-1day'::interval")}
+        {query.fields()}
+        FROM daily_data h
+        {query.where()}
+        ORDER BY datetime
+        {query.pagination()}
+        """
+    return f"""
         SELECT sn.id
         , json_build_object(
         'label', '1day'
@@ -1054,7 +3373,7 @@ async def fetch_days(query, db):
           'datetime_from', get_datetime_object(h.datetime_first, sn.timezone)
         , 'datetime_to', get_datetime_object(h.datetime_last, sn.timezone)
         ) as coverage
-        , sensor_flags_exist(h.sensors_id, h.datetime, '-1day'::interval) as flag_info
+        , {flag_window("h.sensors_id", "h.datetime", "'-1day'::interval")}
         {query.fields()}
         FROM daily_data h
         JOIN sensors s USING (sensors_id)
@@ -1065,14 +3384,193 @@ async def fetch_days(query, db):
         ORDER BY datetime
         {query.pagination()}
         """
-    return await db.fetchPage(sql, query.params())
+
+
+async def fetch_days(query, db):
+    return await fetch_series(query, "daily_data", days_sql, db)
 
 
 def aggregate_days(query, aggregate_to, db): ...
 
 
-async def fetch_years(query, db):
-    sql = f"""
+@sql_template
+def location_series_sql(query: QueryBuilder, table: str, series_sql) -> str:
+    """The rows of a page of timestamps of a location.
+
+    The page of distinct timestamps is selected from the time series table
+    first, with the same filters, and the rows are only built for those
+    timestamps. The query has to map `timestamps_page`, see
+    `fetch_location_series`.
+    """
+    # the filters without the page itself
+    page = QueryBuilder(query.query)
+    return f"""
+        WITH timestamps_page AS (
+        SELECT DISTINCT h.datetime
+        FROM {table} h
+        JOIN sensors s USING (sensors_id)
+        JOIN sensor_systems sy USING (sensor_systems_id)
+        JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)
+        {page.where()}
+        ORDER BY h.datetime
+        LIMIT :limit OFFSET :offset
+        )
+        SELECT * FROM ({series_sql(query)}) h
+        ORDER BY timestamp_rank, sensors_id
+        """
+
+
+def wide_table(rows) -> list[dict]:
+    """Pivots sensor values ordered by timestamp to one column per sensor.
+
+    Args:
+        rows: rows of `location_series_sql` ordered by timestamp
+
+    Returns:
+        list with the table as its only element, empty if there are no rows
+    """
+    if not rows:
+        return []
+    timestamps = {}
+    datetime_from = {"utc": [], "local": []}
+    sensors = {}
+    for row in rows:
+        period = row["period"]
+        index = timestamps.setdefault(row["timestamp_rank"], len(timestamps))
+        if index == len(datetime_from["utc"]):
+            datetime_from["utc"].append(period["datetime_from"]["utc"])
+            datetime_from["local"].append(period["datetime_from"]["local"])
+        sensor = sensors.get(row["sensors_id"])
+        if sensor is None:
+            sensor = sensors[row["sensors_id"]] = {
+                "sensors_id": row["sensors_id"],
+                "parameter": row["parameter"],
+                "values": {},
+            }
+        sensor["values"][index] = row["value"]
+    for sensor in sensors.values():
+        values = sensor["values"]
+        sensor["values"] = [values.get(i) for i in range(len(timestamps))]
+    return [
+        {
+            "label": period["label"],
+            "interval": period["interval"],
+            "datetime_from": datetime_from,
+            "sensors": sorted(sensors.values(), key=lambda s: s["sensors_id"]),
+        }
+    ]
+
+
+summary_columns = ("avg", "sd", "min", "q02", "q25", "median", "q75", "q98", "max")
+
+
+def columnar_series(rows) -> list[dict]:
+    """Turns the rows of a sensor time series into parallel columns.
+
+    Args:
+        rows: rows of one sensor ordered by datetime
+
+    Returns:
+        list with the series as its only element, empty if there are no rows
+    """
+    if not rows:
+        return []
+    first = rows[0]
+    datetime_from = {"utc": [], "local": []}
+    datetime_to = {"utc": [], "local": []}
+    values = []
+    has_flags = []
+    coverage = {"observed_count": [], "percent_complete": [], "percent_coverage": []}
+    summary = {key: [] for key in summary_columns} if first.get("summary") else None
+    for row in rows:
+        period = row["period"]
+        for columns, key in (
+            (datetime_from, "datetime_from"),
+            (datetime_to, "datetime_to"),
+        ):
+            value = period.get(key) or {}
+            columns["utc"].append(value.get("utc"))
+            columns["local"].append(value.get("local"))
+        values.append(row["value"])
+        flag_info = row.get("flag_info")
+        if isinstance(flag_info, dict):
+            flag_info = flag_info.get("has_flags")
+        has_flags.append(flag_info)
+        row_coverage = row.get("coverage") or {}
+        for key, column in coverage.items():
+            column.append(row_coverage.get(key))
+        if summary is not None:
+            row_summary = row.get("summary") or {}
+            for key, column in summary.items():
+                column.append(row_summary.get(key))
+    return [
+        {
+            "label": first["period"]["label"],
+            "interval": first["period"]["interval"],
+            "parameter": first["parameter"],
+            "datetime_from": datetime_from,
+            "datetime_to": datetime_to,
+            "values": values,
+            "has_flags": has_flags,
+            "coverage": coverage,
+            "summary": summary,
+        }
+    ]
+
+
+def series_response(queries: SeriesFormatQuery, response: OpenAQResult):
+    """The response of a sensor time series in the requested `SeriesFormat`."""
+    if queries.format == SeriesFormat.columnar:
+        response.results = columnar_series(response.results)
+        return json_response(SensorTimeSeriesResponse, response)
+    return response
+
+
+async def fetch_location_series(query, table, series_sql, db):
+    params = query.params()
+    params.setdefault("page", 1)
+    params.setdefault("limit", 100)
+    params["offset"] = (params["page"] - 1) * params["limit"]
+    query.set_column_map({"timestamps_page": "timestamps_page"})
+    rows = await db.fetch(location_series_sql(query, table, series_sql), params)
+    results = wide_table(rows)
+    found = len(results[0]["datetime_from"]["utc"]) if results else 0
+    if found == params["limit"]:
+        found = f">{found}"
+    return OpenAQResult(
+        meta=Meta(page=params["page"], limit=params["limit"], found=found),
+        results=results,
+    )
+
+
+@sql_template
+def years_sql(query: QueryBuilder, metadata: bool = False) -> str:
+    if metadata:
+        # scalar columns only, the sensor attributes are parameters from
+        # `sensor_metadata`, used for the `series_table` downloads
+        return f"""
+        SELECT h.datetime
+        , h.datetime_first
+        , h.datetime_last
+        , h.value_count
+        , h.value_avg
+        , h.value_sd
+        , h.value_min
+        , h.value_p02
+        , h.value_p25
+        , h.value_p50
+        , h.value_p75
+        , h.value_p98
+        , h.value_max
+        , sig_digits(h.value_avg, 3) as value
+        , {flag_window("h.sensors_id", "h.datetime", "'-1year'::interval")}
+        {query.fields()}
+        FROM annual_data h
+        {query.where()}
+        ORDER BY datetime
+        {query.pagination()}
+        """
+    return f"""
         SELECT sn.id
         , json_build_object(
         'label', '1year'
@@ -1117,4 +3615,260 @@ async def fetch_years(query, db):
         ORDER BY datetime
         {query.pagination()}
         """
-    return await db.fetchPage(sql, query.params())
+
+
+async def fetch_years(query, db):
+    return await db.fetchPage(years_sql(query), query.params())
+
+
+# rows per record batch of the table downloads
+table_batch_rows = 10_000
+
+# statistics columns of the aggregated table downloads
+stat_columns = {
+    "avg": "value_avg",
+    "sd": "value_sd",
+    "min": "value_min",
+    "q02": "value_p02",
+    "q25": "value_p25",
+    "median": "value_p50",
+    "q75": "value_p75",
+    "q98": "value_p98",
+    "max": "value_max",
+}
+
+
+def series_columns(table: str) -> dict[str, str]:
+    """The columns of a table download and their kind, see `table_stream`."""
+    if table in ("measurements", "hourly_data"):
+        columns = {"datetime_from": "timestamp", "datetime_to": "timestamp"}
+    else:
+        # days and years are local dates
+        columns = {"datetime_from": "date", "datetime_to": "date"}
+    columns["value"] = "float"
+    if table != "measurements":
+        columns.update({name: "float" for name in stat_columns})
+        columns.update(
+            observed_count="int",
+            datetime_first="timestamp",
+            datetime_last="timestamp",
+        )
+    columns["has_flags"] = "bool"
+    return columns
+
+
+def floats(records: list, column: str) -> list[float | None]:
+    return [None if (v := r[column]) is None else float(v) for r in records]
+
+
+def series_batch(
+    table: str, records: list, metadata: SensorMetadata, flags: SensorFlags
+) -> dict[str, list]:
+    """The columns of a batch of rows of a scalar series template."""
+    datetimes = [r["datetime"] for r in records]
+    if table == "measurements":
+        step = timedelta(seconds=metadata.logging_seconds)
+        batch = {"datetime_from": [dt - step for dt in datetimes]}
+        batch["datetime_to"] = datetimes
+    elif table == "hourly_data":
+        batch = {"datetime_from": [dt - timedelta(hours=1) for dt in datetimes]}
+        batch["datetime_to"] = datetimes
+    elif table == "daily_data":
+        batch = {"datetime_from": datetimes}
+        batch["datetime_to"] = [day + timedelta(days=1) for day in datetimes]
+    else:
+        batch = {"datetime_from": datetimes}
+        batch["datetime_to"] = [day.replace(year=day.year + 1) for day in datetimes]
+    batch["value"] = floats(records, "value")
+    if table != "measurements":
+        for name, column in stat_columns.items():
+            batch[name] = floats(records, column)
+        batch["observed_count"] = [r["value_count"] for r in records]
+        batch["datetime_first"] = [r["datetime_first"] for r in records]
+        batch["datetime_last"] = [r["datetime_last"] for r in records]
+    batch["has_flags"] = [
+        flags.overlaps(r["flags_from"], r["flags_to"]) for r in records
+    ]
+    return batch
+
+
+async def record_batches(rows, size: int):
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# names of the series tables in the file names of downloads
+series_names = {
+    "measurements": "measurements",
+    "hourly_data": "hours",
+    "daily_data": "days",
+    "annual_data": "years",
+}
+
+
+async def series_table(queries, table, series_sql, metadata, db, export=False):
+    """The requested range of a sensor time series as batches of columns.
+
+    The whole range is read with a server side cursor, paging does not
+    apply. The columns are built from the rows of the scalar series
+    templates in batches of `table_batch_rows`, see `series_batch`.
+
+    Args:
+        export: read on the export pool, see `DB.stream`
+
+    Returns:
+        async iterator of the column batches
+    """
+    if table in ("daily_data", "annual_data"):
+        fields = {"sensors_id", "date_from", "date_to"}
+        query = QueryBuilder(
+            BaseDateQueries(**queries.model_dump(include=fields, exclude_none=True))
+        )
+    else:
+        fields = {"sensors_id", "datetime_from", "datetime_to"}
+        query = QueryBuilder(
+            BaseDatetimeQueries(**queries.model_dump(include=fields, exclude_none=True))
+        )
+    query.set_column_map(metadata_columns(table))
+    params = query.params()
+    params.update(metadata.params())
+    flags = (await sensor_flags({metadata.sensors_id}, db))[metadata.sensors_id]
+    rows = db.stream(series_sql(query, True), params, export=export)
+    if not export:
+        rows = await open_stream(rows)
+    return (
+        series_batch(table, records, metadata, flags)
+        async for records in record_batches(rows, table_batch_rows)
+    )
+
+
+async def fetch_series_table(queries, table, series_sql, media_type, db):
+    """Streams a sensor time series as an Arrow IPC stream or Parquet file,
+    see `series_table`."""
+    if not pyarrow_installed():
+        raise HTTPException(
+            status_code=406,
+            detail=f"{media_type} is not available, request application/json instead",
+        )
+    metadata = await sensor_metadata(queries.sensors_id, db)
+    if metadata is None:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    batches = await series_table(queries, table, series_sql, metadata, db)
+    name = series_names[table]
+    filename = f"sensor-{metadata.sensors_id}-{name}.{table_media_types[media_type]}"
+    return StreamingResponse(
+        table_stream(batches, series_columns(table), media_type, metadata.timezone),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+location_sensors_sql = """
+        SELECT s.sensors_id
+        , sn.timezone
+        FROM sensors s
+        JOIN sensor_systems sy USING (sensor_systems_id)
+        JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)
+        WHERE sy.sensor_nodes_id = :locations_id
+        ORDER BY s.sensors_id
+        """
+
+
+@sql_template
+def location_values_sql(query: QueryBuilder, table: str) -> str:
+    """The values of every sensor at a location ordered by timestamp, for
+    the table downloads of the wide location series."""
+    return f"""
+        SELECT h.datetime
+        , h.sensors_id
+        , sig_digits(h.value_avg, 3) as value
+        FROM {table} h
+        JOIN sensors s USING (sensors_id)
+        JOIN sensor_systems sy USING (sensor_systems_id)
+        JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)
+        {query.where()}
+        ORDER BY h.datetime, h.sensors_id
+        """
+
+
+def location_columns(table: str, sensors_ids: list[int]) -> dict[str, str]:
+    """The columns of a wide table download, one timestamp column and one
+    value column per sensor, see `table_stream`."""
+    columns = {"datetime_from": "timestamp" if table == "hourly_data" else "date"}
+    columns.update({f"sensor_{sensors_id}": "float" for sensors_id in sensors_ids})
+    return columns
+
+
+async def location_batches(rows, table: str, sensors_ids: list[int]):
+    """Pivots the rows of `location_values_sql` to batches of columns of
+    `table_batch_rows` timestamps.
+
+    Values of sensors added to the location after `sensors_ids` was read
+    are left out.
+    """
+    names = {sensors_id: f"sensor_{sensors_id}" for sensors_id in sensors_ids}
+
+    def empty() -> dict[str, list]:
+        return {name: [] for name in ["datetime_from", *names.values()]}
+
+    batch = empty()
+    current = None
+    async for row in rows:
+        if row["datetime"] != current:
+            if len(batch["datetime_from"]) == table_batch_rows:
+                yield batch
+                batch = empty()
+            current = row["datetime"]
+            if table == "hourly_data":
+                batch["datetime_from"].append(current - timedelta(hours=1))
+            else:
+                batch["datetime_from"].append(current)
+            for name in names.values():
+                batch[name].append(None)
+        name = names.get(row["sensors_id"])
+        if name is not None and row["value"] is not None:
+            batch[name][-1] = float(row["value"])
+    if batch["datetime_from"]:
+        yield batch
+
+
+async def fetch_location_table(queries, table, media_type, db):
+    """Streams the wide time series of a location as an Arrow IPC stream or
+    Parquet file.
+
+    The whole requested range is read with a server side cursor, paging
+    does not apply.
+    """
+    if not pyarrow_installed():
+        raise HTTPException(
+            status_code=406,
+            detail=f"{media_type} is not available, request application/json instead",
+        )
+    sensors = await db.fetch(
+        location_sensors_sql, {"locations_id": queries.locations_id}
+    )
+    if not sensors:
+        raise HTTPException(status_code=404, detail="Location not found")
+    sensors_ids = [row["sensors_id"] for row in sensors]
+    query = QueryBuilder(queries)
+    rows = await open_stream(
+        db.stream(location_values_sql(query, table), query.params())
+    )
+    name = series_names[table]
+    filename = f"location-{queries.locations_id}-{name}.{table_media_types[media_type]}"
+    return StreamingResponse(
+        table_stream(
+            location_batches(rows, table, sensors_ids),
+            location_columns(table, sensors_ids),
+            media_type,
+            sensors[0]["timezone"],
+        ),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
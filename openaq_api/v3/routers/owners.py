@@ -10,6 +10,7 @@ from openaq_api.v3.models.queries import (
     QueryBaseModel,
     QueryBuilder,
     SortingBase,
+    sql_template,
 )
 from openaq_api.v3.models.responses import OwnersResponse
 
@@ -92,9 +93,9 @@ async def owners_get(
     return response
 
 
-async def fetch_owners(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
+@sql_template
+def owners_sql(query_builder: QueryBuilder) -> str:
+    return f"""
     SELECT e.entities_id AS id
     , e.full_name AS name
     FROM entities e
@@ -105,5 +106,9 @@ async def fetch_owners(query, db):
     ORDER BY e.entities_id
     {query_builder.pagination()};
     """
-    response = await db.fetchPage(sql, query_builder.params())
+
+
+async def fetch_owners(query, db):
+    query_builder = QueryBuilder(query)
+    response = await db.fetchPage(owners_sql(query_builder), query_builder.params())
     return response
@@ -14,6 +14,7 @@ from openaq_api.v3.models.queries import (
     QueryBuilder,
     RadiusQuery,
     SortingBase,
+    sql_template,
 )
 from openaq_api.v3.models.responses import ParametersResponse
 
@@ -168,10 +169,10 @@ async def parameters_get(
     return response
 
 
-async def fetch_parameters(query, db) -> ParametersResponse:
-    query_builder = QueryBuilder(query)
+@sql_template
+def parameters_sql(query_builder: QueryBuilder) -> str:
     ## TODO
-    sql = f"""
+    return f"""
     SELECT id
         , p.name
         , p.display_name
@@ -185,5 +186,9 @@ async def fetch_parameters(query, db) -> ParametersResponse:
     {query_builder.where()}
     {query_builder.pagination()}
     """
-    response = await db.fetchPage(sql, query_builder.params())
+
+
+async def fetch_parameters(query, db) -> ParametersResponse:
+    query_builder = QueryBuilder(query)
+    response = await db.fetchPage(parameters_sql(query_builder), query_builder.params())
     return response
@@ -16,6 +16,7 @@ from openaq_api.v3.models.queries import (
     QueryBuilder,
     RadiusQuery,
     SortingBase,
+    sql_template,
 )
 from openaq_api.v3.models.responses import ProvidersResponse
 
@@ -120,9 +121,9 @@ async def providers_get(
     return response
 
 
-async def fetch_providers(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
+@sql_template
+def providers_sql(query_builder: QueryBuilder) -> str:
+    return f"""
     SELECT id
     , name
     , source_name
@@ -138,5 +139,9 @@ async def fetch_providers(query, db):
     {query_builder.where()}
     {query_builder.pagination()}
     """
-    response = await db.fetchPage(sql, query_builder.params())
+
+
+async def fetch_providers(query, db):
+    query_builder = QueryBuilder(query)
+    response = await db.fetchPage(providers_sql(query_builder), query_builder.params())
     return response
@@ -7,6 +7,7 @@ from openaq_api.db import DB
 from openaq_api.v3.models.queries import (
     QueryBaseModel,
     QueryBuilder,
+    sql_template,
 )
 
 from openaq_api.v3.models.responses import (
@@ -71,11 +72,9 @@ async def sensor_get(
     return response
 
 
-async def fetch_sensors(q, db):
-    query = QueryBuilder(q)
-
-    logger.debug(query.params())
-    sql = f"""
+@sql_template
+def sensors_sql(query: QueryBuilder) -> str:
+    return f"""
     SELECT s.sensors_id as id
     , m.measurand||' '||m.units as name
     , json_build_object(
@@ -129,4 +128,10 @@ async def fetch_sensors(q, db):
     {query.where()} AND n.is_public AND s.is_public
     {query.pagination()}
     """
-    return await db.fetchPage(sql, query.params())
+
+
+async def fetch_sensors(q, db):
+    query = QueryBuilder(q)
+
+    logger.debug(query.params())
+    return await db.fetchPage(sensors_sql(query), query.params())
@@ -12,6 +12,7 @@ from openaq_api.v3.models.queries import (
     MonitorQuery,
     QueryBaseModel,
     QueryBuilder,
+    sql_template,
 )
 
 logger = logging.getLogger("tiles")
@@ -153,9 +154,9 @@ async def get_threshold_tile(
     return Response(content=vt, status_code=200, media_type="application/x-protobuf")
 
 
-async def fetch_tiles(query, db):
-    query_builder = QueryBuilder(query)
-    sql = f"""
+@sql_template
+def tiles_sql(query_builder: QueryBuilder) -> str:
+    return f"""
     WITH
         tile AS (
             SELECT ST_TileEnvelope(:z,:x,:y) AS tile
@@ -205,13 +206,17 @@ async def fetch_tiles(query, db):
         )
         SELECT ST_AsMVT(t, 'default') FROM t;
     """
-    response = await db.fetchval(sql, query_builder.params())
-    return response
 
 
-async def fetch_threshold_tiles(query, db):
+async def fetch_tiles(query, db):
     query_builder = QueryBuilder(query)
-    sql = f"""
+    response = await db.fetchval(tiles_sql(query_builder), query_builder.params())
+    return response
+
+
+@sql_template
+def threshold_tiles_sql(query_builder: QueryBuilder) -> str:
+    return f"""
     WITH
         tile AS (
             SELECT ST_TileEnvelope(:z,:x,:y) AS tile
@@ -279,7 +284,13 @@ async def fetch_threshold_tiles(query, db):
         )
         SELECT ST_AsMVT(t, 'default') FROM t;
     """
-    response = await db.fetchval(sql, query_builder.params())
+
+
+async def fetch_threshold_tiles(query, db):
+    query_builder = QueryBuilder(query)
+    response = await db.fetchval(
+        threshold_tiles_sql(query_builder), query_builder.params()
+    )
     return response
 
 
@@ -0,0 +1,55 @@
+from fastapi.testclient import TestClient
+import json
+import pytest
+
+from openaq_api.main import app
+from openaq_api.settings import settings
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as c:
+        yield c
+
+
+# the catalogue has to answer every filter of /v3/locations the same as
+# the database, including the rows on the edges of boxes and circles
+queries = [
+    "limit=1000",
+    "limit=1000&page=2&sort_order=desc",
+    "bbox=-77.1200,38.7916,-76.9094,38.9955&limit=1000",
+    "bbox=-180,-90,180,90&limit=1000&page=3",
+    "bbox=-0.5,51.2,0.3,51.7&monitor=true&limit=1000",
+    "coordinates=38.907,-77.037&radius=25000&limit=1000",
+    "coordinates=51.5074,-0.1278&radius=12000&parameters_id=2&limit=1000",
+    "coordinates=-33.8688,151.2093&radius=1000",
+    "providers_id=1,2&limit=1000",
+    "owner_contacts_id=4&limit=1000",
+    "parameters_id=2,7&mobile=false&limit=1000",
+    "mobile=true&limit=1000",
+    "monitor=false&sort_order=desc&limit=1000",
+    "iso=US&limit=1000",
+    "countries_id=13,155&limit=1000",
+    "licenses_id=1&limit=1000",
+    "manufacturers_id=1&limit=1000",
+    "instruments_id=3&limit=1000",
+]
+
+
+@pytest.mark.parametrize("query", queries)
+def test_catalogue_matches_sql(client, monkeypatch, query):
+    monkeypatch.setattr(settings, "LOCATIONS_CATALOGUE", False)
+    response = client.get(f"/v3/locations?{query}")
+    assert response.status_code == 200
+    expected = json.loads(response.content)
+    monkeypatch.setattr(settings, "LOCATIONS_CATALOGUE", True)
+    response = client.get(f"/v3/locations?{query}")
+    assert response.status_code == 200
+    actual = json.loads(response.content)
+    # geodesic distances agree to well under a millimeter
+    for row, expected_row in zip(actual["results"], expected["results"]):
+        if "distance" in expected_row:
+            assert row.pop("distance") == pytest.approx(
+                expected_row.pop("distance"), abs=1e-4
+            )
+    assert actual == expected
@@ -0,0 +1,188 @@
+import importlib.util
+import inspect
+import operator
+import os
+import timeit
+from abc import ABC
+
+import orjson
+import pytest
+from pydantic import BaseModel
+
+from openaq_api.v3.models.queries import QueryBuilder
+from openaq_api.v3.models.responses import HourlyDataResponse, Meta, OpenAQResult
+from openaq_api.v3.models.serializers import serialize
+from openaq_api.v3.routers.locations import LocationsQueries
+from openaq_api.v3.routers.measurements import merge_trends, summarize_trends
+
+from .test_measurements import trend_partial
+from .test_serializers import hours, validated
+
+# timings depend on the machine and its load, only compared on request
+benchmark = pytest.mark.skipif(
+    not os.environ.get("RUN_BENCHMARKS"), reason="RUN_BENCHMARKS is not set"
+)
+
+
+class LegacyQueryBuilder:
+    """The MRO walking QueryBuilder, kept as the benchmark baseline."""
+
+    def __init__(self, query):
+        self.query = query
+
+    def _bases(self):
+        base_classes = inspect.getmro(self.query.__class__)
+        bases = [x for x in base_classes if ABC not in x.__bases__]
+        bases.remove(object)
+        bases.remove(ABC)
+        bases.remove(BaseModel)
+        return sorted(bases, key=operator.attrgetter("__name__"))
+
+    def fields(self):
+        fields = []
+        for base in self._bases():
+            if callable(getattr(base, "fields", None)):
+                if base.fields(self.query):
+                    fields.append(base.fields(self.query))
+        if len(fields):
+            return "\n," + ("\n,").join(list(set(fields)))
+        return ""
+
+    def pagination(self):
+        pagination = []
+        for base in self._bases():
+            if callable(getattr(base, "pagination", None)):
+                if base.pagination(self.query):
+                    pagination.append(base.pagination(self.query))
+        if len(pagination):
+            return "\n" + ("\n,").join(list(set(pagination)))
+        return ""
+
+    def where(self):
+        where = []
+        for base in self._bases():
+            if callable(getattr(base, "where", None)):
+                setattr(self.query, "__column_map__", {})
+                clause = base.where(self.query)
+                if clause:
+                    where.append(clause)
+        if len(where):
+            where = list(set(where))
+            where.sort()
+            return "WHERE " + ("\nAND ").join(where)
+        return ""
+
+
+def build(builder_class, query):
+    builder = builder_class(query)
+    return builder.where(), builder.fields(), builder.pagination()
+
+
+class TestQueryPlanBenchmark:
+    query = LocationsQueries(
+        coordinates="38.9072,-77.0369", radius=1000, providers_id="1,2", limit=10
+    )
+
+    def test_same_sql(self):
+        assert build(QueryBuilder, self.query) == build(LegacyQueryBuilder, self.query)
+
+    @benchmark
+    def test_per_request_overhead(self):
+        number = 2000
+        before = min(
+            timeit.repeat(
+                lambda: build(LegacyQueryBuilder, self.query), number=number, repeat=3
+            )
+        )
+        after = min(
+            timeit.repeat(
+                lambda: build(QueryBuilder, self.query), number=number, repeat=3
+            )
+        )
+        assert after < before
+
+
+@pytest.mark.skipif(
+    importlib.util.find_spec("numpy") is None, reason="numpy is not installed"
+)
+class TestSummaryEngineBenchmark:
+    """The NumPy summaries against the same statistics row by row in Python,
+    the database side of `SUMMARY_ENGINE` needs a database to compare."""
+
+    def arrays(self):
+        import numpy as np
+
+        rng = np.random.default_rng(1)
+        # ten years of hourly values
+        epochs = 1_262_304_000 + 3600 * np.arange(1, 24 * 3652 + 1, dtype=np.float64)
+        values = rng.normal(10, 3, len(epochs))
+        values[rng.random(len(epochs)) < 0.05] = np.nan
+        return epochs, epochs, values
+
+    def partials(self, arrays):
+        epochs, _, values = arrays
+        groups = {}
+        for epoch, value in zip(epochs.tolist(), values.tolist()):
+            factor = f"{int(epoch - 1) // 3600 % 24:02d}"
+            groups.setdefault(factor, []).append(
+                (epoch, None if value != value else value)
+            )
+        return [
+            [
+                trend_partial(f, rows[0][0], rows[-1][0], [v for _, v in rows])
+                for f, rows in groups.items()
+            ]
+        ]
+
+    def test_same_summaries(self):
+        arrays = self.arrays()
+        expected = merge_trends(self.partials(arrays))
+        params = summarize_trends(arrays, "hourly_data", "hod")
+        assert params["merged_factor"] == expected["merged_factor"]
+        assert params["merged_value_p98"] == pytest.approx(expected["merged_value_p98"])
+
+    @benchmark
+    def test_hour_of_day_summaries(self):
+        arrays = self.arrays()
+        before = min(
+            timeit.repeat(
+                lambda: merge_trends(self.partials(arrays)), number=1, repeat=3
+            )
+        )
+        after = min(
+            timeit.repeat(
+                lambda: summarize_trends(arrays, "hourly_data", "hod"),
+                number=1,
+                repeat=3,
+            )
+        )
+        assert after < before
+
+
+class TestResponseSerializerBenchmark:
+    """The trusted serializer against FastAPI validating the response model."""
+
+    content = OpenAQResult(meta=Meta(limit=1000, found=1000), results=hours(1000))
+
+    def test_same_json(self):
+        assert orjson.loads(serialize(HourlyDataResponse, self.content)) == (
+            orjson.loads(validated(HourlyDataResponse, self.content))
+        )
+
+    @benchmark
+    def test_page_of_1000_hours(self):
+        before = min(
+            timeit.repeat(
+                lambda: validated(HourlyDataResponse, self.content),
+                number=5,
+                repeat=3,
+            )
+        )
+        after = min(
+            timeit.repeat(
+                lambda: serialize(HourlyDataResponse, self.content),
+                number=5,
+                repeat=3,
+            )
+        )
+        assert after < before
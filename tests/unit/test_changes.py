@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi import FastAPI
+from fastapi.exceptions import RequestValidationError
+from fastapi.testclient import TestClient
+
+from openaq_api.db import DB
+from openaq_api.main import openaq_request_validation_exception_handler
+from openaq_api.v3.routers import changes
+from openaq_api.v3.routers.changes import decode_cursor, encode_cursor
+
+start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def change(sensors_id: int, locations_id: int, hours: int) -> dict:
+    dt = start + timedelta(hours=hours)
+    return {
+        "sensors_id": sensors_id,
+        "locations_id": locations_id,
+        "parameter": {"id": 2, "name": "pm25", "units": "µg/m³"},
+        "datetime": {"utc": dt.isoformat(), "local": dt.isoformat()},
+        "value": float(sensors_id),
+        "coordinates": {"latitude": 39.7, "longitude": -105.0},
+        "datetime_last": dt,
+    }
+
+
+def location(locations_id: int) -> dict:
+    return {
+        "id": locations_id,
+        "name": f"location {locations_id}",
+        "timezone": "UTC",
+        "country": {"id": 1, "code": "US", "name": "United States"},
+        "owner": {"id": 1, "name": "owner"},
+        "provider": {"id": 1, "name": "provider"},
+        "is_mobile": False,
+        "is_monitor": True,
+        "instruments": [],
+        "sensors": [],
+        "coordinates": {"latitude": 39.7, "longitude": -105.0},
+        "bounds": [-105.0, 39.7, -105.0, 39.7],
+    }
+
+
+class FakeDB:
+    """Applies the keyset of `changes_sql` to a list of rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    async def stream(self, query, kwargs):
+        self.queries.append((query, kwargs))
+        if "locations_id" in kwargs:
+            for i in kwargs["locations_id"]:
+                yield location(i)
+            return
+        position = (kwargs["after"], kwargs["after_sensors_id"])
+        rows = sorted(self.rows, key=lambda r: (r["datetime_last"], r["sensors_id"]))
+        rows = [r for r in rows if (r["datetime_last"], r["sensors_id"]) > position]
+        for row in rows[: kwargs["limit"]]:
+            yield row
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB(
+        [
+            change(3, 10, 1),
+            change(1, 10, 2),
+            change(2, 11, 2),
+            change(4, 12, 3),
+        ]
+    )
+    app = FastAPI()
+    app.include_router(changes.router)
+    app.dependency_overrides[DB] = lambda: db
+    app.add_exception_handler(
+        RequestValidationError, openaq_request_validation_exception_handler
+    )
+    db.client = TestClient(app)
+    return db
+
+
+def test_cursor():
+    dt = datetime(2024, 1, 1, 2, 30, 0, 123456, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor(dt, 42)) == (dt, 42)
+    for cursor in ["", "not a cursor", encode_cursor(dt, 42)[:-3]]:
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
+
+
+def test_sync(db):
+    response = db.client.get("/v3/changes?since=2024-01-01T00:30:00&limit=2")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "no-store"
+    body = response.json()
+    assert [r["sensorsId"] for r in body["results"]] == [3, 1]
+    assert [r["id"] for r in body["locations"]] == [10]
+    assert body["meta"]["found"] == 2
+    assert db.queries[0][1]["after"] == start + timedelta(minutes=30)
+    # sensors updated at the same time are split by sensors id
+    cursor = body["meta"]["next"]
+    body = db.client.get(f"/v3/changes?cursor={cursor}&limit=2").json()
+    assert [r["sensorsId"] for r in body["results"]] == [2, 4]
+    assert [r["id"] for r in body["locations"]] == [11, 12]
+    # caught up, the cursor is kept for the next sync
+    cursor = body["meta"]["next"]
+    body = db.client.get(f"/v3/changes?cursor={cursor}").json()
+    assert body["results"] == [] and body["locations"] == []
+    assert body["meta"]["next"] == cursor
+    db.rows.append(change(1, 10, 4))
+    body = db.client.get(f"/v3/changes?cursor={cursor}").json()
+    assert [(r["sensorsId"], r["datetime"]["utc"]) for r in body["results"]] == [
+        (1, "2024-01-01T04:00:00Z")
+    ]
+    # caught up with results, the cursor trails the last one by the overlap
+    cursor = body["meta"]["next"]
+    assert decode_cursor(cursor) == (start + timedelta(hours=2), 0)
+
+
+def test_late_upload(db, monkeypatch):
+    monkeypatch.setattr(changes.settings, "CHANGES_OVERLAP_SECONDS", 3600)
+    body = db.client.get("/v3/changes?since=2024-01-01T00:00:00Z").json()
+    assert [r["sensorsId"] for r in body["results"]] == [3, 1, 2, 4]
+    cursor = body["meta"]["next"]
+    # updated after the sync with a datetime before its last result
+    db.rows.append(change(5, 12, 2.5))
+    db.rows.append(change(6, 12, 1.5))
+    body = db.client.get(f"/v3/changes?cursor={cursor}").json()
+    # the sensors within the overlap are returned again, the one before it
+    # is missed
+    assert [r["sensorsId"] for r in body["results"]] == [1, 2, 5, 4]
+
+
+def test_validation(db):
+    assert db.client.get("/v3/changes").status_code == 422
+    assert db.client.get("/v3/changes?cursor=nope").status_code == 422
+    cursor = encode_cursor(start, 1)
+    url = f"/v3/changes?since=2024-01-01&cursor={cursor}"
+    assert db.client.get(url).status_code == 422
@@ -0,0 +1,236 @@
+import asyncio
+import contextlib
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+from buildpg import render
+from buildpg.components import BuildError
+from fastapi import HTTPException
+
+from openaq_api.db import (
+    DB,
+    open_stream,
+    plan_cost,
+    query_costs,
+    render_query,
+    rendered_queries,
+)
+from openaq_api.settings import settings
+
+query = "SELECT * FROM t WHERE a = :a AND b > :b AND c = ANY(:c) AND a < :a::int"
+
+
+class TestRenderQuery:
+    def test_same_as_buildpg(self):
+        kwargs = {"c": [1, 2], "b": date(2024, 1, 1), "a": 42, "unused": "x"}
+        assert render_query(query, kwargs) == render(query, **kwargs)
+
+    def test_cached_binds_values_in_order(self):
+        render_query(query, {"a": 1, "b": 2, "c": 3})
+        rquery, args = render_query(query, {"c": 6, "b": 5, "a": 4})
+        assert (
+            rquery
+            == "SELECT * FROM t WHERE a = $1 AND b > $2 AND c = ANY($3) AND a < $1::int"
+        )
+        assert args == [4, 5, 6]
+        assert rendered_queries[query] == (rquery, ("a", "b", "c"))
+
+    def test_missing_parameter(self):
+        render_query(query, {"a": 1, "b": 2, "c": 3})
+        with pytest.raises(BuildError):
+            render_query(query, {"a": 1, "b": 2})
+
+
+class FakeConnection:
+    def __init__(self, cost):
+        self.cost = cost
+        self.explained = []
+
+    async def fetchval(self, query, *args):
+        self.explained.append(query)
+        return [{"Plan": {"Total Cost": self.cost}}]
+
+
+class FakePool:
+    def __init__(self, cost):
+        self.con = FakeConnection(cost)
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                return pool.con
+
+            async def __aexit__(self, *args): ...
+
+        return Acquire()
+
+
+class FakeTimer:
+    def mark(self, *args): ...
+
+
+def fake_db(heavy_pool=None, stream_pool=None):
+    state = SimpleNamespace(heavy_pool=heavy_pool, stream_pool=stream_pool)
+    request = SimpleNamespace(
+        app=SimpleNamespace(state=state),
+        state=SimpleNamespace(timer=FakeTimer()),
+    )
+    return DB(request)
+
+
+def test_app_scoped_shares_the_pools():
+    db = fake_db(heavy_pool=FakePool(0))
+    app_db = db.app_scoped()
+    assert app_db.request is not db.request
+    assert app_db.request.app is db.request.app
+    app_db.request.state.timer.mark("db")
+
+
+class TestQueryCostGuard:
+    def setup_method(self):
+        query_costs.clear()
+
+    def test_plan_cost(self):
+        assert plan_cost('[{"Plan": {"Total Cost": 12.5}}]') == 12.5
+        assert plan_cost([{"Plan": {"Total Cost": 3}}]) == 3.0
+
+    def test_cheap_query_keeps_pool(self):
+        pool = FakePool(10)
+        db = fake_db()
+        assert asyncio.run(db.guard(pool, "SELECT 1", [], 6)) == (pool, 6)
+
+    def test_cost_is_cached_per_query_and_parameters(self):
+        pool = FakePool(10)
+        db = fake_db()
+        asyncio.run(db.guard(pool, "SELECT $1", [1], 6))
+        asyncio.run(db.guard(pool, "SELECT $1", [1], 6))
+        assert pool.con.explained == ["EXPLAIN (FORMAT JSON) SELECT $1"]
+        # a wider range of the same shape is estimated again
+        pool.con.cost = settings.QUERY_COST_LIMIT + 1
+        with pytest.raises(HTTPException):
+            asyncio.run(db.guard(pool, "SELECT $1", [2], 6))
+        assert len(pool.con.explained) == 2
+
+    def test_heavy_query_uses_heavy_pool(self, monkeypatch):
+        async def db_pool(pool, max_size=10):
+            return pool
+
+        monkeypatch.setattr("openaq_api.db.db_pool", db_pool)
+        heavy = FakePool(0)
+        db = fake_db(heavy)
+        pool = FakePool(settings.QUERY_COST_HEAVY + 1)
+        assert asyncio.run(db.guard(pool, "SELECT 2", [], 6)) == (heavy, 15)
+
+    def test_expensive_query_rejected(self):
+        db = fake_db()
+        pool = FakePool(settings.QUERY_COST_LIMIT + 1)
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(db.guard(pool, "SELECT 3", [], 6))
+        assert e.value.status_code == 422
+
+
+class TestOpenStream:
+    def test_errors_before_the_first_row(self):
+        async def rows():
+            raise HTTPException(status_code=422, detail="too expensive")
+            yield
+
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(open_stream(rows()))
+        assert e.value.status_code == 422
+
+    def test_all_rows(self):
+        async def rows(n):
+            for i in range(n):
+                yield i
+
+        async def collect(n):
+            return [row async for row in await open_stream(rows(n))]
+
+        assert asyncio.run(collect(3)) == [0, 1, 2]
+        assert asyncio.run(collect(0)) == []
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetch(self, n):
+        rows, self.rows = self.rows[:n], self.rows[n:]
+        return rows
+
+
+class FakeStreamConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    async def cursor(self, query, *args):
+        return FakeCursor(list(self.rows))
+
+
+class FakeStreamPool:
+    def __init__(self, rows, busy=False):
+        self.con = FakeStreamConnection(rows)
+        self.busy = busy
+        self.acquired = 0
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout=None):
+        if self.busy:
+            raise TimeoutError()
+        self.acquired += 1
+        try:
+            yield self.con
+        finally:
+            self.acquired -= 1
+
+
+class TestStream:
+    @pytest.fixture(autouse=True)
+    def pools(self, monkeypatch):
+        async def db_pool(pool, max_size=10):
+            return pool
+
+        monkeypatch.setattr("openaq_api.db.db_pool", db_pool)
+        monkeypatch.setattr(settings, "STREAM_BUFFER_BATCHES", 1)
+
+    def test_rows_in_batches(self):
+        async def collect():
+            return [row async for row in db.stream("SELECT 1", {}, prefetch=2)]
+
+        pool = FakeStreamPool(list(range(5)))
+        db = fake_db(stream_pool=pool)
+        assert asyncio.run(collect()) == [0, 1, 2, 3, 4]
+        assert pool.acquired == 0
+
+    def test_idle_reader_releases_connection(self, monkeypatch):
+        monkeypatch.setattr(settings, "STREAM_IDLE_SECONDS", 0.01)
+
+        async def read_slowly():
+            rows = db.stream("SELECT 1", {}, prefetch=1)
+            read = [await anext(rows)]
+            assert pool.acquired == 1
+            await asyncio.sleep(0.1)
+            # given up while the client was not reading
+            assert pool.acquired == 0
+            with pytest.raises(TimeoutError):
+                async for row in rows:
+                    read.append(row)
+            return read
+
+        pool = FakeStreamPool(list(range(100)))
+        db = fake_db(stream_pool=pool)
+        # the row read and the batch buffered before the reader stopped
+        assert asyncio.run(read_slowly()) == [0, 1]
+
+    def test_busy_pool(self):
+        db = fake_db(stream_pool=FakeStreamPool([], busy=True))
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(open_stream(db.stream("SELECT 1", {})))
+        assert e.value.status_code == 503
@@ -0,0 +1,185 @@
+import asyncio
+import gzip
+import importlib.util
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from openaq_api.exports import ExportStore, LocalExportStore
+from openaq_api.settings import settings
+from openaq_api.v3.routers import exports
+from openaq_api.v3.routers.exports import (
+    MeasurementsExportQueries,
+    export_tasks,
+    sensor_measurements_export_post,
+)
+from openaq_api.v3.routers.measurements import flags_cache, flags_version
+
+from .test_measurements import FakeDB
+
+
+def measurement(hours: int) -> dict:
+    end = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=hours)
+    return {
+        "datetime": end,
+        "value": float(hours),
+        "flags_sensors_id": 1,
+        "flags_from": end - timedelta(hours=1),
+        "flags_to": end,
+    }
+
+
+class FailingDB(FakeDB):
+    async def stream(self, query, kwargs, export=False):
+        raise HTTPException(status_code=500, detail="connection lost")
+        yield
+
+
+class SlowDB(FakeDB):
+    async def stream(self, query, kwargs, export=False):
+        for row in self.rows:
+            await asyncio.sleep(0.01)
+            yield row
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = LocalExportStore(str(tmp_path))
+    monkeypatch.setattr(exports, "export_store", lambda: store)
+    flags_cache.clear()
+    flags_version.update(checked=0.0, version=None)
+    return store
+
+
+def export(db, **kwargs) -> dict:
+    async def run():
+        queries = MeasurementsExportQueries(sensors_id=1, **kwargs)
+        response = await sensor_measurements_export_post(queries, db)
+        (job,) = response.results
+        assert job["status"] == "queued"
+        await asyncio.gather(*export_tasks)
+        return job
+
+    return asyncio.run(run())
+
+
+def client() -> TestClient:
+    app = FastAPI()
+    app.include_router(exports.router)
+    return TestClient(app)
+
+
+def test_ndjson(store):
+    db = FakeDB([measurement(h + 1) for h in range(24)])
+    job = export(db, datetime_from="2024-01-01T00:00:00Z")
+    assert db.exported
+    assert job["status"] == "complete"
+    assert job["rows"] == 24
+    status = client().get(f"/v3/exports/{job['id']}")
+    assert status.headers["cache-control"] == "no-store"
+    (result,) = status.json()["results"]
+    assert result["status"] == "complete"
+    assert result["download"] == f"/v3/exports/{job['id']}/download"
+    path = store.path(f"{job['id']}/sensor-1-measurements.ndjson.gz")
+    assert result["size"] == path.stat().st_size
+    lines = gzip.decompress(path.read_bytes()).splitlines()
+    assert len(lines) == 24
+    assert orjson.loads(lines[0]) == {
+        "datetime_from": "2024-01-01T00:00:00+00:00",
+        "datetime_to": "2024-01-01T01:00:00+00:00",
+        "value": 1.0,
+        "has_flags": False,
+    }
+
+
+def test_download_ranges(store):
+    job = export(FakeDB([measurement(h + 1) for h in range(1000)]))
+    data = store.path(f"{job['id']}/sensor-1-measurements.ndjson.gz").read_bytes()
+    url = f"/v3/exports/{job['id']}/download"
+    response = client().get(url)
+    assert response.status_code == 200
+    assert response.content == data
+    assert response.headers["content-type"] == "application/gzip"
+    assert "sensor-1-measurements.ndjson.gz" in response.headers["content-disposition"]
+    response = client().get(url, headers={"Range": "bytes=10-99"})
+    assert response.status_code == 206
+    assert response.content == data[10:100]
+    assert response.headers["content-range"] == f"bytes 10-99/{len(data)}"
+
+
+@pytest.mark.skipif(
+    importlib.util.find_spec("pyarrow") is None, reason="pyarrow is not installed"
+)
+def test_parquet(store):
+    import pyarrow.parquet as pq
+
+    job = export(FakeDB([measurement(h + 1) for h in range(5)]), format="parquet")
+    table = pq.read_table(store.path(f"{job['id']}/sensor-1-measurements.parquet"))
+    assert table.to_pydict()["value"] == [1.0, 2.0, 3.0, 4.0, 5.0]
+    assert job["rows"] == 5
+
+
+def test_failed(store):
+    job = export(FailingDB([]))
+    assert job["status"] == "failed"
+    assert job["error"] == "connection lost"
+    assert list(store.root.glob(f"{job['id']}/sensor-*")) == []
+    response = client().get(f"/v3/exports/{job['id']}/download")
+    assert response.status_code == 409
+
+
+def test_unknown(store):
+    assert client().get(f"/v3/exports/{'0' * 32}").status_code == 404
+    assert client().get("/v3/exports/..%2Fsecret").status_code in (404, 422)
+
+
+def test_too_many_jobs(store, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_MAX_JOBS", 0)
+    with pytest.raises(HTTPException) as e:
+        export(FakeDB([]))
+    assert e.value.status_code == 429
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        ExportStore()
+
+
+def test_heartbeat(store, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_HEARTBEAT_SECONDS", 0.01)
+    statuses = []
+    put_json = store.put_json
+
+    async def recorded(key, content):
+        statuses.append(content["status"])
+        await put_json(key, content)
+
+    monkeypatch.setattr(store, "put_json", recorded)
+    job = export(SlowDB([measurement(h + 1) for h in range(10)]))
+    assert job["status"] == "complete"
+    assert statuses.count("running") > 2
+    # nothing is written after the final status
+    assert statuses[-1] == "complete"
+
+
+def test_stale(store, monkeypatch):
+    job = export(FakeDB([measurement(1)]))
+    status = asyncio.run(store.get_json(f"{job['id']}/status.json"))
+    # left running by an instance that is gone
+    status.update(status="running", heartbeat="2024-01-01T00:00:00+00:00")
+    asyncio.run(store.put_json(f"{job['id']}/status.json", status))
+    (result,) = client().get(f"/v3/exports/{job['id']}").json()["results"]
+    assert result["status"] == "failed"
+    status = asyncio.run(store.get_json(f"{job['id']}/status.json"))
+    assert status["status"] == "failed"
+    response = client().get(f"/v3/exports/{job['id']}/download")
+    assert response.status_code == 409
+    # running jobs are not stale while they beat
+    monkeypatch.setattr(settings, "EXPORT_STALE_SECONDS", 10**10)
+    status.update(status="running")
+    asyncio.run(store.put_json(f"{job['id']}/status.json", status))
+    (result,) = client().get(f"/v3/exports/{job['id']}").json()["results"]
+    assert result["status"] == "running"
@@ -0,0 +1,425 @@
+import asyncio
+from datetime import date, datetime, timezone
+
+import orjson
+import pytest
+from fastapi import HTTPException
+
+from openaq_api.settings import settings
+from openaq_api.v3.models.responses import Meta, OpenAQResult
+from openaq_api.v3.routers import latest
+from fastapi.exceptions import RequestValidationError
+
+from openaq_api.v3.routers.latest import (
+    LatestHub,
+    LatestQueries,
+    LatestStore,
+    LocationsLatestQueries,
+    LocationLatestPathQuery,
+    ParameterLatestPathQuery,
+    ParametersLatestQueries,
+    fetch_latest,
+    latest_events,
+    location_latest_stream_get,
+    parameters_latest_stream_get,
+    refresh_latest,
+)
+
+
+def sensor(sensors_id, locations_id, measurands_id, hour, value, tzid="UTC"):
+    return {
+        "sensors_id": sensors_id,
+        "locations_id": locations_id,
+        "measurands_id": measurands_id,
+        "tzid": tzid,
+        "datetime_last": datetime(2024, 1, 1, hour, tzinfo=timezone.utc),
+        "value": value,
+        "latitude": 39.7,
+        "longitude": -105.0,
+    }
+
+
+class FakeDB:
+    def __init__(self, rows, updates=()):
+        self.rows = rows
+        self.updates = list(updates)
+        self.queries = []
+        self.fail = False
+
+    async def stream(self, query, kwargs):
+        self.queries.append((query, kwargs))
+        if self.fail:
+            raise ValueError("connection lost")
+        for row in self.updates if "watermark" in kwargs else self.rows:
+            yield row
+
+    async def fetch(self, query, kwargs, cache_read=True):
+        assert not cache_read
+        self.queries.append((query, kwargs))
+        # rows shaped as the latest_sql rows
+        store = LatestStore()
+        for row in self.rows:
+            store.upsert(row)
+        positions = store.select(locations_id=list(kwargs["locations_id"]))
+        return [{**store.row(i), "found": len(positions)} for i in positions]
+
+    async def fetchPage(self, query, kwargs):
+        self.queries.append((query, kwargs))
+        return OpenAQResult(meta=Meta(), results=[])
+
+    def app_scoped(self):
+        return self
+
+
+class RequestDB(FakeDB):
+    """DB of a request, the background tasks have to use its app's DB."""
+
+    def __init__(self, app_db):
+        super().__init__([])
+        self.app_db = app_db
+
+    async def stream(self, query, kwargs):
+        raise AssertionError("read on the DB of a request")
+        yield
+
+    def app_scoped(self):
+        return self.app_db
+
+
+@pytest.fixture(autouse=True)
+def empty_store(monkeypatch):
+    monkeypatch.setattr(latest, "latest_store", LatestStore())
+    monkeypatch.setattr(latest, "latest_hub", LatestHub())
+    monkeypatch.setattr(latest, "latest_cache", {})
+    monkeypatch.setattr(latest, "latest_tasks", set())
+
+
+def rows():
+    return [
+        sensor(1, 10, 2, 5, 1.5),
+        sensor(2, 10, 3, 6, None),
+        sensor(3, 11, 2, 7, 3.5, tzid="America/Denver"),
+        sensor(4, 12, 2, 8, 4.5),
+    ]
+
+
+def fetch(query, db):
+    return asyncio.run(fetch_latest(query, db))
+
+
+def load(db):
+    asyncio.run(refresh_latest(db, wait=True))
+
+
+def test_location():
+    db = FakeDB(rows())
+    load(db)
+    response = fetch(LocationsLatestQueries(locations_id=10), db)
+    assert response.meta.found == 2
+    assert response.results == [
+        {
+            "locations_id": 10,
+            "sensors_id": 1,
+            "datetime": {
+                "utc": "2024-01-01T05:00:00+00:00",
+                "local": "2024-01-01T05:00:00+00:00",
+            },
+            "value": 1.5,
+            "coordinates": {"latitude": 39.7, "longitude": -105.0},
+        },
+        {
+            "locations_id": 10,
+            "sensors_id": 2,
+            "datetime": {
+                "utc": "2024-01-01T06:00:00+00:00",
+                "local": "2024-01-01T06:00:00+00:00",
+            },
+            "value": None,
+            "coordinates": {"latitude": 39.7, "longitude": -105.0},
+        },
+    ]
+    fetch(LocationsLatestQueries(locations_id=11), db)
+    assert len(db.queries) == 1
+
+
+def test_parameter_paging_and_datetime_min():
+    db = FakeDB(rows())
+    load(db)
+    query = ParametersLatestQueries(parameters_id=2, limit=2, page=2)
+    response = fetch(query, db)
+    assert response.meta.found == 3
+    assert [r["sensors_id"] for r in response.results] == [4]
+    query = ParametersLatestQueries(
+        parameters_id=2, datetime_min="2024-01-01T06:00:00Z"
+    )
+    assert [r["sensors_id"] for r in fetch(query, db).results] == [3, 4]
+    # naive datetimes are local, 06:00 in Denver is 13:00 UTC
+    query = ParametersLatestQueries(parameters_id=2, datetime_min="2024-01-01T06:00")
+    assert [r["sensors_id"] for r in fetch(query, db).results] == [4]
+    query = ParametersLatestQueries(parameters_id=2, datetime_min=date(2024, 1, 1))
+    assert [r["sensors_id"] for r in fetch(query, db).results] == [1, 4]
+
+
+def test_incremental_refresh(monkeypatch):
+    monkeypatch.setattr(settings, "LATEST_REFRESH_SECONDS", 0)
+    db = FakeDB(rows(), updates=[sensor(1, 10, 2, 9, 9.5), sensor(5, 10, 2, 9, 1.0)])
+    load(db)
+    response = fetch(LocationsLatestQueries(locations_id=10), db)
+    sql, params = db.queries[-1]
+    assert "r.datetime_last > :watermark" in sql
+    overlap = settings.LATEST_OVERLAP_SECONDS
+    assert params["watermark"].timestamp() == (
+        datetime(2024, 1, 1, 8, tzinfo=timezone.utc).timestamp() - overlap
+    )
+    assert [(r["sensors_id"], r["value"]) for r in response.results] == [
+        (1, 9.5),
+        (2, None),
+        (5, 1.0),
+    ]
+    query = ParametersLatestQueries(parameters_id=2)
+    assert [r["sensors_id"] for r in fetch(query, db).results] == [1, 3, 4, 5]
+
+
+def test_reload(monkeypatch):
+    db = FakeDB(rows())
+    load(db)
+    db.rows = rows()[:1]
+    query = LocationsLatestQueries(locations_id=10)
+
+    async def run():
+        monkeypatch.setattr(settings, "LATEST_RELOAD_SECONDS", 0)
+        # the previous store is served while the next one is loaded
+        response = await fetch_latest(query, db)
+        assert [r["sensors_id"] for r in response.results] == [1, 2]
+        assert len(latest.latest_tasks) == 1
+        await fetch_latest(query, db)
+        await asyncio.gather(*latest.latest_tasks)
+        monkeypatch.setattr(settings, "LATEST_RELOAD_SECONDS", 3600)
+        response = await fetch_latest(query, db)
+        assert [r["sensors_id"] for r in response.results] == [1]
+
+    asyncio.run(run())
+    # one load at a time
+    assert [params for _, params in db.queries] == [{}, {}]
+
+
+def test_sql_until_loaded():
+    db = FakeDB(rows())
+    query = LocationsLatestQueries(locations_id=10)
+
+    async def run():
+        response = await fetch_latest(query, db)
+        assert [r["sensors_id"] for r in response.results] == [1, 2]
+        assert "sensors_rollup" in db.queries[0][0]
+        await asyncio.gather(*latest.latest_tasks)
+        response = await fetch_latest(LocationsLatestQueries(locations_id=11), db)
+        assert [r["sensors_id"] for r in response.results] == [3]
+
+    asyncio.run(run())
+    assert len(db.queries) == 2
+
+
+def test_failed_load_backs_off(monkeypatch):
+    db = FakeDB(rows())
+    db.fail = True
+    query = ParametersLatestQueries(parameters_id=2)
+
+    async def run():
+        await fetch_latest(query, db)
+        await asyncio.gather(*latest.latest_tasks)
+        assert latest.latest_store.failed is not None
+        # not loaded again until the retry
+        await fetch_latest(query, db)
+        assert not latest.latest_tasks
+        monkeypatch.setattr(settings, "LATEST_REFRESH_SECONDS", 0)
+        db.fail = False
+        await fetch_latest(query, db)
+        await asyncio.gather(*latest.latest_tasks)
+
+    asyncio.run(run())
+    assert latest.latest_store.loaded
+    loads = [sql for sql, params in db.queries if params == {}]
+    assert len(loads) == 2
+
+
+def test_background_tasks_use_the_app_db(monkeypatch):
+    monkeypatch.setattr(settings, "LATEST_REFRESH_SECONDS", 0)
+    app_db = FakeDB(rows(), updates=[sensor(1, 10, 2, 9, 9.5)])
+    db = RequestDB(app_db)
+
+    async def run():
+        await refresh_latest(db, wait=True)
+        stream = latest_events(("locations", 10), db)
+        await anext(stream)
+        # the poller refreshes the store on the app's DB
+        while len(app_db.queries) < 2:
+            await asyncio.sleep(0)
+        await stream.aclose()
+
+    asyncio.run(run())
+    assert latest.latest_store.loaded
+    assert [params for _, params in app_db.queries][0] == {}
+    assert "watermark" in app_db.queries[1][1]
+
+
+def test_sql_without_store(monkeypatch):
+    monkeypatch.setattr(settings, "LATEST_STORE", False)
+    db = FakeDB(rows())
+    fetch(LocationsLatestQueries(locations_id=10, datetime_min="2024-01-01"), db)
+    sql, params = db.queries[0]
+    assert "sensors_rollup" in sql
+    assert params["locations_id"] == 10
+
+
+def event(data: bytes) -> dict:
+    kind, payload = data.decode().strip().split("\n")
+    assert kind == "event: latest"
+    return orjson.loads(payload.removeprefix("data: "))
+
+
+def test_stream_fan_out(monkeypatch):
+    db = FakeDB(rows(), updates=[sensor(1, 10, 2, 9, 9.5), sensor(2, 10, 3, 6, None)])
+
+    async def run():
+        await refresh_latest(db, wait=True)
+        streams = [latest_events(("locations", 10), db) for _ in range(50)]
+        for stream in streams:
+            assert (await anext(stream)).startswith(b"retry: ")
+            snapshot = [event(await anext(stream)) for _ in range(2)]
+            assert [r["sensorsId"] for r in snapshot] == [1, 2]
+        assert latest.latest_hub.subscribers == 50
+        # the shared poller runs once and waits for the next refresh
+        await asyncio.sleep(0)
+        monkeypatch.setattr(settings, "LATEST_REFRESH_SECONDS", 0)
+        # one poll for every stream, the unchanged sensor 2 is not sent
+        assert await refresh_latest(db) == [0]
+        for stream in streams:
+            update = event(await anext(stream))
+            assert (update["sensorsId"], update["value"]) == (1, 9.5)
+            await stream.aclose()
+        assert latest.latest_hub.subscribers == 0
+        assert latest.latest_hub.queues == {}
+
+    asyncio.run(run())
+    assert len(db.queries) == 2
+
+
+def test_stream_heartbeat(monkeypatch):
+    monkeypatch.setattr(settings, "LATEST_STREAM_HEARTBEAT_SECONDS", 0)
+    db = FakeDB(rows())
+
+    async def run():
+        await refresh_latest(db, wait=True)
+        stream = latest_events(("parameters", 3), db)
+        await anext(stream)
+        assert event(await anext(stream))["sensorsId"] == 2
+        assert await anext(stream) == b": keep-alive\n\n"
+        await stream.aclose()
+
+    asyncio.run(run())
+
+
+def test_stream_without_store(monkeypatch):
+    monkeypatch.setattr(settings, "LATEST_STORE", False)
+    db = FakeDB(rows())
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(
+            location_latest_stream_get(LocationLatestPathQuery(locations_id=10), db)
+        )
+    assert e.value.status_code == 503
+    assert db.queries == []
+
+
+def test_stream_failed_load():
+    db = FakeDB(rows())
+    db.fail = True
+    query = ParameterLatestPathQuery(parameters_id=2)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(parameters_latest_stream_get(query, db))
+    assert e.value.status_code == 503
+    assert "Retry-After" in e.value.headers
+    assert latest.latest_hub.subscribers == 0
+
+
+def test_bounded_queues(monkeypatch):
+    monkeypatch.setattr(settings, "LATEST_STREAM_QUEUE_SIZE", 2)
+    store = LatestStore()
+    for row in rows():
+        store.upsert(row)
+    hub = LatestHub()
+    queue = hub.subscribe(("parameters", 2))
+    hub.publish(store, [0, 1, 2, 3])
+    # the oldest update is dropped for the newer ones
+    assert [queue.get_nowait()["sensors_id"] for _ in range(2)] == [3, 4]
+    assert queue.empty()
+
+
+def test_reload_changes():
+    old = LatestStore()
+    for row in rows():
+        old.upsert(row)
+    new = LatestStore()
+    for row in [sensor(1, 10, 2, 5, 1.5), sensor(2, 10, 3, 6, None)]:
+        new.upsert(row)
+    new.upsert(sensor(3, 11, 2, 9, 3.5, tzid="America/Denver"))
+    new.upsert(sensor(6, 12, 2, 9, 1.0))
+    assert new.changed(old) == [2, 3]
+    assert new.upsert(sensor(6, 12, 2, 9, 1.0)) is None
+
+
+def test_bulk_locations():
+    db = FakeDB(rows())
+    load(db)
+    response = fetch(LatestQueries(locations_id="11,10"), db)
+    assert [r["sensors_id"] for r in response.results] == [1, 2, 3]
+    response = fetch(LatestQueries(locations_id="10,12,99", limit=1, page=3), db)
+    assert response.meta.found == 3
+    assert [r["sensors_id"] for r in response.results] == [4]
+
+
+def test_bulk_bbox():
+    db = FakeDB(rows() + [{**sensor(5, 13, 2, 9, 1.0), "longitude": -100.0}])
+    load(db)
+    query = LatestQueries(bbox="-106,39,-104,40")
+    assert [r["sensors_id"] for r in fetch(query, db).results] == [1, 2, 3, 4]
+    query = LatestQueries(bbox="-101,39,-100,40", datetime_min="2024-01-01T08:00Z")
+    assert [r["sensors_id"] for r in fetch(query, db).results] == [5]
+    query = LatestQueries(locations_id="10,13", bbox="-101,39,-100,40")
+    assert [r["sensors_id"] for r in fetch(query, db).results] == [5]
+
+
+def test_bulk_validation():
+    with pytest.raises(RequestValidationError):
+        LatestQueries()
+    with pytest.raises(RequestValidationError):
+        LatestQueries(locations_id=",".join(map(str, range(1, 102))))
+
+
+def test_sql_location_cache(monkeypatch):
+    monkeypatch.setattr(settings, "LATEST_STORE", False)
+    db = FakeDB(rows())
+    response = fetch(LatestQueries(locations_id="11,10", limit=2), db)
+    assert response.meta.found == 3
+    assert [r["sensors_id"] for r in response.results] == [1, 2]
+    ((sql, params),) = db.queries
+    assert "n.sensor_nodes_id = ANY(:locations_id)" in sql
+    assert "LIMIT" not in sql
+    assert sorted(params["locations_id"]) == [10, 11]
+    # the single location endpoint reuses the rows of the bulk request
+    response = fetch(LocationsLatestQueries(locations_id=10), db)
+    assert [r["sensors_id"] for r in response.results] == [1, 2]
+    assert "found" not in response.results[0]
+    fetch(LatestQueries(locations_id="10,12"), db)
+    assert db.queries[-1][1]["locations_id"] == [12]
+    monkeypatch.setattr(settings, "LATEST_REFRESH_SECONDS", 0)
+    fetch(LocationsLatestQueries(locations_id=10), db)
+    assert len(db.queries) == 3
+
+
+def test_sql_bbox(monkeypatch):
+    monkeypatch.setattr(settings, "LATEST_STORE", False)
+    db = FakeDB(rows())
+    fetch(LatestQueries(bbox="-106,39,-104,40"), db)
+    sql, params = db.queries[0]
+    assert "&& COALESCE(r.geom_latest, n.geom)" in sql
+    assert (params["minx"], params["maxy"]) == (-106, 40)
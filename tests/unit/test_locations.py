@@ -0,0 +1,192 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from openaq_api.db import DB
+from openaq_api.settings import settings
+from openaq_api.v3.models.responses import Meta, OpenAQResult
+from openaq_api.v3.routers import locations
+from openaq_api.v3.routers.locations import LocationsCatalogue, LocationsQueries
+
+
+def location(
+    id: int,
+    lon: float | None,
+    lat: float | None,
+    provider: int = 1,
+    owner: int = 1,
+    country: tuple[int, str] = (1, "US"),
+    parameters: list[int] | None = (2,),
+    mobile: bool | None = False,
+    monitor: bool | None = True,
+) -> dict:
+    return {
+        "id": id,
+        "name": f"location {id}",
+        "is_mobile": mobile,
+        "is_monitor": monitor,
+        "locality": None,
+        "country": {"id": country[0], "code": country[1], "name": country[1]},
+        "owner": {"id": owner, "name": "owner"},
+        "provider": {"id": provider, "name": "provider"},
+        "coordinates": {"latitude": lat, "longitude": lon},
+        "instruments": [],
+        "sensors": [],
+        "timezone": "UTC",
+        "bounds": [lon, lat, lon, lat],
+        "datetime_first": None,
+        "datetime_last": None,
+        "licenses": None,
+        "lon": lon,
+        "lat": lat,
+        "parameter_ids": None if parameters is None else list(parameters),
+        "manufacturer_ids": [1],
+        "license_ids": None,
+        "instrument_ids": [3],
+    }
+
+
+def rows() -> list[dict]:
+    return [
+        location(1, -77.037, 38.907),
+        # just outside of the bbox, inside its single precision box
+        location(2, -77.03700001, 38.95, provider=2),
+        location(3, -77.0369, 38.92, owner=4, parameters=[2, 5], monitor=False),
+        location(4, -77.1, 39.99, mobile=True, parameters=None),
+        location(5, 0.0, 0.0, country=(2, "GH")),
+        location(6, 0.00898, 0.0, country=(2, "GH")),
+        location(7, 0.009, 0.0, country=(2, "GH")),
+        location(8, 179.9995, 0.0, monitor=None),
+        location(9, None, None),
+    ]
+
+
+class FakeDB:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    async def stream(self, query, kwargs):
+        self.queries.append(query)
+        if self.rows is None:
+            raise ValueError("connection lost")
+        for row in self.rows:
+            yield row
+
+    async def fetchPage(self, query, kwargs):
+        self.queries.append(query)
+        return OpenAQResult(meta=Meta(), results=[])
+
+
+@pytest.fixture
+def catalogue() -> LocationsCatalogue:
+    catalogue = LocationsCatalogue()
+    for row in rows():
+        catalogue.add(row)
+    return catalogue
+
+
+def ids(catalogue: LocationsCatalogue, **kwargs) -> list[int]:
+    response = catalogue.page(LocationsQueries(**kwargs))
+    return [row["id"] for row in response.results]
+
+
+def test_bbox(catalogue):
+    bbox = "-77.037,38.907,-77.0,39.910"
+    assert ids(catalogue, bbox=bbox) == [1, 2, 3]
+    assert ids(catalogue, bbox="-77.2,38.9,-77.0,40") == [1, 2, 3, 4]
+    assert ids(catalogue, bbox="-1,-1,1,1") == [5, 6, 7]
+    assert ids(catalogue, bbox="179,-1,180,1") == [8]
+
+
+def test_radius(catalogue):
+    response = catalogue.page(LocationsQueries(coordinates="0,0", radius=1000))
+    assert [row["id"] for row in response.results] == [5, 6]
+    distances = [row["distance"] for row in response.results]
+    assert distances[0] == 0
+    assert distances[1] == pytest.approx(999.65, abs=0.01)
+    assert "distance" not in catalogue.rows[5]
+    # across the antimeridian
+    assert ids(catalogue, coordinates="0,-179.9995", radius=1000) == [8]
+    assert ids(catalogue, coordinates="38.907,-77.037", radius=2000) == [1, 3]
+    assert ids(catalogue, coordinates="38.907,-77.037", radius=5000) == [1, 2, 3]
+
+
+def test_attributes(catalogue):
+    assert ids(catalogue, providers_id="2") == [2]
+    assert ids(catalogue, owner_contacts_id="4,5") == [3]
+    assert ids(catalogue, parameters_id="5,6") == [3]
+    assert ids(catalogue, parameters_id="2", mobile=False) == [1, 2, 3, 5, 6, 7, 8, 9]
+    assert ids(catalogue, mobile=True) == [4]
+    # NULL is neither a monitor nor not a monitor
+    assert ids(catalogue, monitor=False) == [3]
+    assert ids(catalogue, iso="GH") == [5, 6, 7]
+    assert ids(catalogue, countries_id="2", bbox="-1,-1,0,0") == [5]
+    assert ids(catalogue, manufacturers_id="1", instruments_id="3", limit=2) == [1, 2]
+    assert ids(catalogue, licenses_id="1") == []
+
+
+def test_paging(catalogue):
+    response = catalogue.page(LocationsQueries(limit=4, page=2, sort_order="desc"))
+    assert [row["id"] for row in response.results] == [5, 4, 3, 2]
+    # counted as `fetchPage` counts, a full page is more than the limit
+    assert response.meta.found == ">4"
+    response = catalogue.page(LocationsQueries(limit=4, page=3))
+    assert (response.meta.page, response.meta.found) == (3, 1)
+    response = catalogue.page(LocationsQueries(providers_id="3"))
+    assert response.meta.found == 0
+
+
+def client(db) -> TestClient:
+    app = FastAPI()
+    app.include_router(locations.router)
+    app.dependency_overrides[DB] = lambda: db
+    return TestClient(app)
+
+
+@pytest.fixture
+def empty_catalogue(monkeypatch):
+    monkeypatch.setattr(locations, "locations_catalogue", LocationsCatalogue())
+    monkeypatch.setattr(settings, "LOCATIONS_CATALOGUE", True)
+
+
+def test_endpoint(empty_catalogue, monkeypatch):
+    # the locations the response model allows, responses are validated
+    db = FakeDB(rows()[:7])
+    body = client(db).get("/v3/locations?bbox=-1,-1,1,1&limit=2").json()
+    assert [row["id"] for row in body["results"]] == [5, 6]
+    assert body["meta"]["found"] == ">2"
+    client(db).get("/v3/locations?iso=US")
+    assert db.queries == [locations.catalogue_sql]
+    # stale catalogues are served while they are reloaded
+    monkeypatch.setattr(settings, "LOCATIONS_CATALOGUE_SECONDS", 0)
+    db.rows = rows()[:1]
+    body = client(db).get("/v3/locations").json()
+    assert len(body["results"]) == 7
+    assert len(locations.locations_catalogue) == 1
+
+
+def test_endpoint_fallback(empty_catalogue, monkeypatch):
+    db = FakeDB(None)
+    client(db).get("/v3/locations")
+    assert db.queries[0] == locations.catalogue_sql
+    assert "FROM locations_view_cached" in db.queries[1]
+    assert locations.locations_catalogue.loaded == 0
+    # the failed load is not retried by every request
+    client(db).get("/v3/locations")
+    assert db.queries.count(locations.catalogue_sql) == 1
+    monkeypatch.setattr(settings, "LOCATIONS_CATALOGUE_RETRY_SECONDS", 0)
+    db.rows = rows()[:7]
+    body = client(db).get("/v3/locations").json()
+    assert db.queries.count(locations.catalogue_sql) == 2
+    assert len(body["results"]) == 7
+    assert locations.locations_catalogue.loaded
+
+
+def test_without_catalogue():
+    assert not settings.LOCATIONS_CATALOGUE
+    db = FakeDB(rows())
+    asyncio.run(locations.locations_get(LocationsQueries(), db))
+    assert len(db.queries) == 1 and "LIMIT" in db.queries[0]
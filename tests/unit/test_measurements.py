@@ -0,0 +1,1646 @@
+import asyncio
+import bisect
+import contextlib
+import importlib.util
+import math
+import random
+import statistics
+
+import orjson
+import pytest
+from fastapi import HTTPException
+from datetime import date, datetime, timedelta, timezone
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+
+from openaq_api.db import DB
+from openaq_api.settings import settings
+from openaq_api.v3.models.queries import QueryBuilder
+from openaq_api.v3.models.responses import (
+    HourlyData,
+    HourlyDataResponse,
+    Measurement,
+    Meta,
+    OpenAQResult,
+)
+from openaq_api.v3.models.serializers import serialize, table_media_type
+from openaq_api.v3.routers import measurements
+from openaq_api.v3.routers.measurements import (
+    BaseDateQueries,
+    BaseDatetimeQueries,
+    LocationDateQueries,
+    LocationDatetimeQueries,
+    PagedDateQueries,
+    PagedDatetimeQueries,
+    PagedSensorsDatetimeQueries,
+    HoursSeriesQueries,
+    SampledDateQueries,
+    SampledDatetimeQueries,
+    SensorFlags,
+    SeriesDateQueries,
+    SeriesDatetimeQueries,
+    calculate_coverage,
+    datetime_object,
+    fetch_hours_aggregated,
+    flags_cache,
+    flags_version,
+    fetch_location_series,
+    fetch_location_table,
+    fetch_measurements_aggregated,
+    fetch_sensors_hours,
+    hours_sql,
+    merge_trends,
+    metadata_columns,
+    sketch_fractions,
+    aggregated_periods,
+    fetch_days,
+    fetch_days_aggregated,
+    fetch_days_trends,
+    fetch_hours,
+    fetch_hours_trends,
+    fetch_measurements,
+    fetch_series_table,
+    days_sql,
+    interval_text,
+    plan_rollup,
+    sensors_metadata,
+    series_cache,
+    series_response,
+    sensor_flags,
+    sensor_metadata,
+    whole_periods,
+    stream_sensors_hours,
+    summarize_periods,
+    summarize_trends,
+    trend_chunks,
+    wide_table,
+)
+
+
+def hour(sensors_id, found, value):
+    dt = datetime(2024, 1, 1, int(value), tzinfo=timezone.utc)
+    return {
+        "id": 1,
+        "sensors_id": sensors_id,
+        "found": found,
+        "value": value,
+        "parameter": {"id": 2, "name": "pm25", "units": "µg/m³"},
+        "flags_sensors_id": sensors_id,
+        "flags_from": dt - timedelta(hours=1),
+        "flags_to": dt,
+    }
+
+
+@pytest.fixture(autouse=True)
+def clear_sensors_metadata():
+    sensors_metadata.clear()
+
+
+class FakeDB:
+    def __init__(self, rows, tzid="UTC", flags=(), flags_version="1"):
+        self.rows = rows
+        self.tzid = tzid
+        self.flags = list(flags)
+        self.flags_version = flags_version
+        self.queries = []
+        self.flag_queries = []
+        self.metadata_queries = []
+
+    def metadata(self, sensors_id):
+        return {
+            "sensors_id": sensors_id,
+            "locations_id": 1,
+            "measurands_id": 2,
+            "measurand": "pm25",
+            "units": "µg/m³",
+            "timezone": self.tzid,
+            "averaging_seconds": 3600,
+            "logging_seconds": 3600,
+        }
+
+    async def fetchval(self, query, kwargs):
+        return self.tzid
+
+    async def fetchPage(self, query, kwargs):
+        self.queries.append((query, kwargs))
+        return OpenAQResult(meta=Meta(), results=[dict(row) for row in self.rows])
+
+    async def fetch(self, query, kwargs, cache_read=True):
+        if "FROM flags f" in query:
+            assert not cache_read
+            return [[self.flags_version]]
+        if "as logging_seconds" in query:
+            self.metadata_queries.append((query, kwargs))
+            return [self.metadata(kwargs["sensors_id"])] if self.tzid else []
+        if "JOIN flags" in query:
+            assert not cache_read
+            self.flag_queries.append((query, kwargs))
+            return [f for f in self.flags if f["sensors_id"] in kwargs["sensors_ids"]]
+        self.queries.append((query, kwargs))
+        return self.rows
+
+    async def stream(self, query, kwargs, export=False):
+        self.queries.append((query, kwargs))
+        self.exported = export
+        for row in self.rows:
+            yield row
+
+
+class TestSensorsHours:
+    query = QueryBuilder(
+        PagedSensorsDatetimeQueries(sensors_id="3,1,2", limit=2, page=2)
+    )
+    rows = [hour(1, 3, 1.0), hour(3, 4, 2.0), hour(3, 4, 3.0)]
+    # flags the second hour of sensor 3
+    flags = [
+        {
+            "sensors_id": 3,
+            "datetime_from": datetime(2024, 1, 1, 2, 30, tzinfo=timezone.utc),
+            "datetime_to": datetime(2024, 1, 1, 4, tzinfo=timezone.utc),
+            "from_inc": True,
+            "to_inc": False,
+        }
+    ]
+
+    def setup_method(self):
+        flags_cache.clear()
+        flags_version.update(checked=0.0, version=None)
+
+    def test_grouped_by_sensor_in_requested_order(self):
+        db = FakeDB(self.rows)
+        response = asyncio.run(fetch_sensors_hours(self.query, db))
+        assert [s["sensors_id"] for s in response.results] == [3, 1, 2]
+        assert [s["found"] for s in response.results] == [4, 3, 0]
+        assert [len(s["results"]) for s in response.results] == [2, 1, 0]
+        assert response.meta.found == 3
+
+    def test_flags_of_all_sensors_at_once(self):
+        db = FakeDB(self.rows, flags=self.flags)
+        response = asyncio.run(fetch_sensors_hours(self.query, db))
+        flagged = [
+            [row["flag_info"]["has_flags"] for row in s["results"]]
+            for s in response.results
+        ]
+        assert flagged == [[False, True], [False], []]
+        assert "sensor_flags_exist" not in db.queries[0][0]
+        assert len(db.flag_queries) == 1
+
+    def test_one_query_with_per_sensor_paging(self):
+        db = FakeDB(self.rows)
+        asyncio.run(fetch_sensors_hours(self.query, db))
+        assert len(db.queries) == 1
+        query, params = db.queries[0]
+        assert "h.rn > :offset AND h.rn <= :offset + :limit" in query
+        assert params["offset"] == 2
+        assert params["limit"] == 2
+
+    def test_stream_ndjson(self):
+        async def collect():
+            lines = await stream_sensors_hours(self.query, db)
+            return [line async for line in lines]
+
+        db = FakeDB(self.rows, flags=self.flags)
+        lines = asyncio.run(collect())
+        assert len(lines) == 3
+        assert lines[0].endswith("\n")
+        assert '"sensorsId":1' in lines[0]
+        assert '"flagInfo":{"hasFlags":false}' in lines[0]
+        assert '"flagInfo":{"hasFlags":true}' in lines[2]
+        assert len(db.flag_queries) == 1
+
+
+def location_hour(rank, sensors_id, value):
+    utc = f"2024-01-01T{rank:02d}:00:00Z"
+    local = f"2024-01-01T{rank:02d}:00:00+00:00"
+    return {
+        "timestamp_rank": rank,
+        "sensors_id": sensors_id,
+        "value": value,
+        "parameter": {"id": sensors_id, "name": "pm25", "units": "µg/m³"},
+        "period": {
+            "label": "1hour",
+            "interval": "01:00:00",
+            "datetime_from": {"utc": utc, "local": local},
+        },
+    }
+
+
+class TestLocationSeries:
+    rows = [
+        location_hour(1, 7, 1.0),
+        location_hour(1, 5, 2.0),
+        location_hour(2, 7, 3.0),
+        location_hour(3, 5, 4.0),
+    ]
+
+    def test_wide_table(self):
+        (table,) = wide_table(self.rows)
+        assert table["datetime_from"]["utc"] == [
+            "2024-01-01T01:00:00Z",
+            "2024-01-01T02:00:00Z",
+            "2024-01-01T03:00:00Z",
+        ]
+        assert [s["sensors_id"] for s in table["sensors"]] == [5, 7]
+        assert table["sensors"][0]["values"] == [2.0, None, 4.0]
+        assert table["sensors"][1]["values"] == [1.0, 3.0, None]
+
+    def test_empty(self):
+        assert wide_table([]) == []
+
+    def test_pages_timestamps(self):
+        query = QueryBuilder(LocationDatetimeQueries(locations_id=1, limit=3, page=3))
+        db = FakeDB(self.rows)
+        response = asyncio.run(
+            fetch_location_series(query, "hourly_data", hours_sql, db)
+        )
+        sql, params = db.queries[0]
+        assert "DENSE_RANK() OVER (ORDER BY h.datetime) as timestamp_rank" in sql
+        # the page of timestamps is selected before the rows are built
+        page, rows = sql.split("SELECT * FROM")
+        assert "SELECT DISTINCT h.datetime\n        FROM hourly_data h" in page
+        assert "sy.sensor_nodes_id = :locations_id" in page
+        assert "LIMIT :limit OFFSET :offset" in page
+        assert "timestamps_page" not in page.split("AS (", 1)[1]
+        assert "h.datetime IN (SELECT datetime FROM timestamps_page)" in rows
+        assert "sy.sensor_nodes_id = :locations_id" in rows
+        assert "LIMIT" not in rows
+        assert params["offset"] == 6
+        assert response.meta.found == ">3"
+
+
+class TestRollupPlanner:
+    tz = ZoneInfo("America/Denver")
+    now = datetime(2024, 6, 15, 12, tzinfo=timezone.utc)
+
+    def setup_method(self):
+        aggregated_periods.clear()
+
+    def test_whole_years(self):
+        start, end = whole_periods(
+            datetime(2020, 3, 1, tzinfo=timezone.utc), None, "year", self.tz, self.now
+        )
+        assert start == datetime(2021, 1, 1, tzinfo=self.tz)
+        assert end == datetime(2024, 1, 1, tzinfo=self.tz)
+
+    def test_local_bounds(self):
+        start, end = whole_periods(
+            date(2024, 1, 1), datetime(2024, 2, 1, 12), "day", self.tz, self.now
+        )
+        assert start == datetime(2024, 1, 1, tzinfo=self.tz)
+        assert end == datetime(2024, 2, 1, tzinfo=self.tz)
+
+    def test_open_start(self):
+        start, end = whole_periods(None, None, "day", self.tz, self.now)
+        assert start is None
+        assert end == datetime(2024, 6, 14, tzinfo=self.tz)
+
+    def test_no_whole_period(self):
+        assert (
+            whole_periods(
+                datetime(2024, 2, 1), datetime(2024, 5, 1), "year", self.tz, self.now
+            )
+            is None
+        )
+
+    def test_half_hour_offsets(self):
+        tz = ZoneInfo("Asia/Kolkata")
+        start, end = whole_periods(date(2024, 1, 1), None, "hour", tz, self.now)
+        assert plan_rollup("measurements", "hour", start, end) is None
+        start, end = whole_periods(date(2024, 1, 1), None, "hour", self.tz, self.now)
+        assert plan_rollup("measurements", "hour", start, end) == "hourly_data"
+
+    def test_hours_to_years_uses_annual_data(self):
+        query = QueryBuilder(
+            PagedDatetimeQueries(sensors_id=1, datetime_from="2020-01-01")
+        )
+        db = FakeDB([], tzid="America/Denver")
+        asyncio.run(fetch_hours_aggregated(query, "year", db))
+        sql, params = db.queries[0]
+        assert "FROM annual_data r" in sql
+        assert "AND NOT (" in sql
+        assert params["rollup_from"] == datetime(2020, 1, 1, tzinfo=self.tz)
+        assert params["excluded_from_0"] == datetime(2020, 1, 1, tzinfo=self.tz)
+
+    def test_hours_to_months_has_no_rollup(self):
+        query = QueryBuilder(PagedDatetimeQueries(sensors_id=1))
+        db = FakeDB([])
+        asyncio.run(fetch_hours_aggregated(query, "month", db))
+        sql, params = db.queries[0]
+        assert "UNION ALL" not in sql
+        assert "rollup_from" not in params
+
+    def test_measurements_to_days_has_no_rollup(self):
+        query = QueryBuilder(PagedDatetimeQueries(sensors_id=1))
+        db = FakeDB([])
+        asyncio.run(fetch_measurements_aggregated(query, "day", db))
+        sql, params = db.queries[0]
+        assert "UNION ALL" not in sql
+
+
+def month(sensors_id, year, month, value, found=3):
+    start = datetime(year, month, 1)
+    return {
+        "sensors_id": sensors_id,
+        "value": value,
+        "found": found,
+        # a date is cast to a timestamptz in the UTC session timezone by
+        # get_datetime_object, the local start is the one grouped by
+        "period": {"datetime_from": {"utc": f"{start.isoformat()}Z"}},
+        "period_start": start,
+    }
+
+
+def day(sensors_id, value, *args):
+    start = datetime(*args)
+    return {
+        "sensors_id": sensors_id,
+        "value": value,
+        "found": 1,
+        "period": {"datetime_from": {"local": start.isoformat()}},
+        "period_start": start,
+    }
+
+
+class TestAggregatedPeriods:
+    def setup_method(self):
+        aggregated_periods.clear()
+
+    def query(self, **kwargs):
+        return QueryBuilder(PagedDateQueries(sensors_id=1, **kwargs))
+
+    def test_closed_periods_computed_once(self):
+        db = FakeDB([month(1, 2023, 2, 1.0), month(1, 2023, 1, 2.0)])
+        query = self.query(date_from="2023-01-01", date_to="2023-03-31")
+        response = asyncio.run(fetch_days_aggregated(query, "month", db))
+        assert [r["value"] for r in response.results] == [2.0, 1.0]
+        assert "period_start" not in response.results[0]
+        assert response.meta.found == 3
+        assert len(aggregated_periods) == 3
+
+        db.rows = []
+        response = asyncio.run(fetch_days_aggregated(query, "month", db))
+        assert [r["value"] for r in response.results] == [2.0, 1.0]
+        assert response.meta.found == 2
+        sql, params = db.queries[-1]
+        assert params["excluded_from_0"] == date(2023, 1, 1)
+        assert params["excluded_to_0"] == date(2023, 4, 1)
+
+    @pytest.mark.parametrize("tzid", ["America/Denver", "Asia/Kolkata"])
+    def test_local_periods(self, tzid):
+        db = FakeDB([month(1, 2023, 1, 2.0), month(1, 2023, 2, 1.0)], tzid=tzid)
+        query = self.query(date_from="2023-01-01", date_to="2023-03-31")
+        asyncio.run(fetch_days_aggregated(query, "month", db))
+        stored = {key[-1]: row for key, (row, _) in aggregated_periods.items()}
+        assert stored[datetime(2023, 1, 1)]["value"] == 2.0
+        assert stored[datetime(2023, 2, 1)]["value"] == 1.0
+        assert stored[datetime(2023, 3, 1)] is None
+        db.rows = []
+        response = asyncio.run(fetch_days_aggregated(query, "month", db))
+        assert [r["value"] for r in response.results] == [2.0, 1.0]
+
+    @pytest.mark.parametrize("tzid", ["America/Denver", "Asia/Kolkata"])
+    def test_local_hours_to_days(self, tzid):
+        rows = [day(1, 1.0, 2024, 1, 1), day(1, 2.0, 2024, 1, 2)]
+        db = FakeDB(rows, tzid=tzid)
+        query = QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1, datetime_from="2024-01-01", datetime_to="2024-01-03"
+            )
+        )
+        asyncio.run(fetch_hours_aggregated(query, "day", db))
+        sql, params = db.queries[-1]
+        assert params["rollup_from"] == datetime(2024, 1, 1, tzinfo=ZoneInfo(tzid))
+        db.rows = []
+        response = asyncio.run(fetch_hours_aggregated(query, "day", db))
+        assert [r["value"] for r in response.results] == [1.0, 2.0]
+
+    def test_only_new_periods_queried(self):
+        db = FakeDB([month(1, 2023, 1, 2.0)])
+        query = self.query(date_from="2023-01-01", date_to="2023-01-31")
+        asyncio.run(fetch_days_aggregated(query, "month", db))
+        db.rows = [month(1, 2023, 2, 1.0, found=2), month(1, 2023, 3, 3.0, found=2)]
+        query = self.query(
+            date_from="2023-01-01", date_to="2023-03-15", limit=1, page=2
+        )
+        response = asyncio.run(fetch_days_aggregated(query, "month", db))
+        sql, params = db.queries[-1]
+        assert params["excluded_from_0"] == date(2023, 1, 1)
+        assert params["excluded_to_0"] == date(2023, 2, 1)
+        assert "excluded_from_1" not in params
+        assert params["limit"] == 2
+        assert response.meta.found == 3
+        assert [r["value"] for r in response.results] == [1.0]
+        assert len(aggregated_periods) == 2
+
+    def test_stored_between_missing_periods(self):
+        db = FakeDB([month(1, 2023, 2, 1.0)])
+        query = self.query(date_from="2023-02-01", date_to="2023-02-28")
+        asyncio.run(fetch_days_aggregated(query, "month", db))
+        # the database no longer aggregates the stored February
+        db.rows = [month(1, 2023, 1, 2.0, found=2), month(1, 2023, 3, 3.0, found=2)]
+        query = self.query(date_from="2023-01-01", date_to="2023-03-31")
+        response = asyncio.run(fetch_days_aggregated(query, "month", db))
+        sql, params = db.queries[-1]
+        assert params["excluded_from_0"] == date(2023, 2, 1)
+        assert params["excluded_to_0"] == date(2023, 3, 1)
+        assert "excluded_from_1" not in params
+        assert [r["value"] for r in response.results] == [2.0, 1.0, 3.0]
+        assert response.meta.found == 3
+
+    def test_stored_between_missing_rollup_periods(self):
+        rows = [day(1, 2.0, 2024, 1, 2)]
+        db = FakeDB(rows)
+        query = QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1, datetime_from="2024-01-02", datetime_to="2024-01-03"
+            )
+        )
+        asyncio.run(fetch_hours_aggregated(query, "day", db))
+        db.rows = [day(1, 1.0, 2024, 1, 1), day(1, 3.0, 2024, 1, 3)]
+        query = QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1, datetime_from="2024-01-01", datetime_to="2024-01-04"
+            )
+        )
+        response = asyncio.run(fetch_hours_aggregated(query, "day", db))
+        sql, params = db.queries[-1]
+        assert "ANY(:rollup_stored" in sql
+        utc = ZoneInfo("UTC")
+        assert params["rollup_from"] == datetime(2024, 1, 1, tzinfo=utc)
+        assert params["rollup_stored"] == [datetime(2024, 1, 2, tzinfo=utc)]
+        assert [r["value"] for r in response.results] == [1.0, 2.0, 3.0]
+
+    def test_rows_up_to_the_page(self):
+        # the database returns the first of two rows, the periods after it
+        # are left for a later page
+        db = FakeDB([month(1, 2023, 1, 2.0, found=2)])
+        query = self.query(date_from="2023-01-01", date_to="2023-03-31", limit=1)
+        response = asyncio.run(fetch_days_aggregated(query, "month", db))
+        assert db.queries[-1][1]["limit"] == 1
+        assert response.meta.found == 2
+        assert [key[-1] for key in aggregated_periods] == [datetime(2023, 1, 1)]
+
+    def test_stored_periods_expire(self, monkeypatch):
+        db = FakeDB([month(1, 2023, 1, 2.0)])
+        query = self.query(date_from="2023-01-01", date_to="2023-01-31")
+        asyncio.run(fetch_days_aggregated(query, "month", db))
+        monkeypatch.setattr(settings, "AGGREGATION_STORE_SECONDS", 0)
+        db.rows = [month(1, 2023, 1, 5.0)]
+        response = asyncio.run(fetch_days_aggregated(query, "month", db))
+        assert [r["value"] for r in response.results] == [5.0]
+        sql, params = db.queries[-1]
+        assert "excluded_from_0" not in params
+
+    def test_open_period_not_stored(self):
+        db = FakeDB([])
+        query = self.query(date_from=date.today().replace(day=1))
+        asyncio.run(fetch_days_aggregated(query, "month", db))
+        assert len(aggregated_periods) == 0
+
+
+def stats(value, count):
+    return {
+        "value": value,
+        "value_count": count,
+        "value_avg": value,
+        "value_sd": 0.0,
+        "value_min": value,
+        "value_p02": value,
+        "value_p25": value,
+        "value_p50": value,
+        "value_p75": value,
+        "value_p98": value,
+        "value_max": value,
+    }
+
+
+def hourly(end):
+    return {
+        "datetime": end,
+        "datetime_first": end,
+        "datetime_last": end,
+        **stats(end.hour, 1),
+        "flags_sensors_id": 1,
+        "flags_from": end - timedelta(hours=1),
+        "flags_to": end,
+    }
+
+
+def daily(day):
+    start = datetime.combine(day, datetime.min.time(), ZoneInfo("America/Denver"))
+    return {
+        "datetime": day,
+        "datetime_first": start + timedelta(hours=1),
+        "datetime_last": start + timedelta(days=1),
+        **stats(day.day, 24),
+        "flags_sensors_id": 1,
+        "flags_from": start,
+        "flags_to": start + timedelta(days=1),
+    }
+
+
+class TestSeriesCache:
+    def setup_method(self):
+        series_cache.clear()
+
+    def hours(self, start, end):
+        hours = []
+        while start < end:
+            start += timedelta(hours=1)
+            hours.append(hourly(start))
+        return hours
+
+    def test_missing_chunks_in_one_query(self):
+        rows = self.hours(
+            datetime(2024, 1, 1, tzinfo=timezone.utc),
+            datetime(2024, 3, 1, tzinfo=timezone.utc),
+        )
+        db = FakeDB(rows)
+        query = QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1,
+                datetime_from="2024-01-31T00:00:00Z",
+                datetime_to="2024-02-02T00:00:00Z",
+                limit=10,
+                page=2,
+            )
+        )
+        response = asyncio.run(fetch_hours(query, db))
+        sql, params = db.queries[0]
+        assert len(db.queries) == 1
+        assert params["datetime_from"] == datetime(2024, 1, 1, tzinfo=timezone.utc)
+        assert params["datetime_to"] == datetime(2024, 3, 1, tzinfo=timezone.utc)
+        assert params["limit"] is None
+        assert response.meta.found == 48
+        assert response.results[0]["value"] == 11
+        assert len(series_cache.chunks) == 2
+
+        query = QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1,
+                datetime_from="2024-02-01T00:00:00Z",
+                datetime_to="2024-02-03T00:00:00Z",
+            )
+        )
+        response = asyncio.run(fetch_hours(query, db))
+        assert len(db.queries) == 1
+        assert response.meta.found == 48
+        assert response.results[0]["period"]["datetime_to"]["utc"] == (
+            "2024-02-01T01:00:00+00:00"
+        )
+
+    def test_open_chunk_not_cached(self):
+        db = FakeDB([])
+        today = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        query = QueryBuilder(
+            PagedDatetimeQueries(sensors_id=1, datetime_from=today.isoformat())
+        )
+        asyncio.run(fetch_hours(query, db))
+        asyncio.run(fetch_hours(query, db))
+        assert len(db.queries) == 2
+
+    def test_closed_chunks_expire(self, monkeypatch):
+        rows = self.hours(
+            datetime(2024, 1, 1, tzinfo=timezone.utc),
+            datetime(2024, 2, 1, tzinfo=timezone.utc),
+        )
+        db = FakeDB(rows)
+        query = QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1,
+                datetime_from="2024-01-01T00:00:00Z",
+                datetime_to="2024-01-02T00:00:00Z",
+            )
+        )
+        asyncio.run(fetch_hours(query, db))
+        asyncio.run(fetch_hours(query, db))
+        assert len(db.queries) == 1
+        # a late upload is seen once the chunk has expired
+        db.rows = [dict(rows[0], value=50.0), *rows[1:]]
+        monkeypatch.setattr(settings, "SERIES_CACHE_SECONDS", 0)
+        response = asyncio.run(fetch_hours(query, db))
+        assert len(db.queries) == 2
+        assert response.results[0]["value"] == 50.0
+        assert series_cache.rows == len(rows)
+
+    def test_without_start(self):
+        db = FakeDB([])
+        query = QueryBuilder(PagedDatetimeQueries(sensors_id=1))
+        asyncio.run(fetch_hours(query, db))
+        assert "LIMIT :limit OFFSET :offset" in db.queries[0][0]
+        assert len(series_cache.chunks) == 0
+
+    def test_days_chunked_by_local_year(self):
+        db = FakeDB([daily(date(2023, 12, 31)), daily(date(2023, 1, 1))])
+        query = QueryBuilder(
+            PagedDateQueries(sensors_id=1, date_from="2023-12-30", date_to="2023-12-31")
+        )
+        response = asyncio.run(fetch_days(query, db))
+        sql, params = db.queries[0]
+        assert params["date_from"] == date(2023, 1, 1)
+        assert params["date_to"] == date(2023, 12, 31)
+        assert [r["value"] for r in response.results] == [31]
+
+
+def percentile_cont(values: list[float], fraction: float) -> float:
+    """Same as PERCENTILE_CONT for sorted values."""
+    position = fraction * (len(values) - 1)
+    lower = math.floor(position)
+    if lower + 1 == len(values):
+        return values[lower]
+    return values[lower] + (position - lower) * (values[lower + 1] - values[lower])
+
+
+def trend_partial(factor, first, last, values) -> dict:
+    """The row of `trends_partial_sql` for the values of a factor."""
+    present = sorted(v for v in values if v is not None)
+    return {
+        "factor": factor,
+        "coverage_first": first,
+        "coverage_last": last,
+        "n": len(values),
+        "count": len(present),
+        "total": math.fsum(present) if present else None,
+        "squares": math.fsum(v * v for v in present) if present else None,
+        "value_min": present[0] if present else None,
+        "value_max": present[-1] if present else None,
+        "quantiles": (
+            [percentile_cont(present, f) for f in sketch_fractions()]
+            if present
+            else None
+        ),
+    }
+
+
+class TestChunkedTrends:
+    def test_chunks(self):
+        start = datetime(2019, 1, 1, tzinfo=timezone.utc)
+        end = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        chunks = trend_chunks(start, end)
+        assert len(chunks) == 4
+        assert chunks[0][0] == start
+        assert chunks[-1][1] == end
+        assert all(a[1] == b[0] for a, b in zip(chunks, chunks[1:]))
+
+    def test_inclusive_chunks(self):
+        chunks = trend_chunks(date(2020, 1, 1), date(2021, 12, 31), inclusive=True)
+        assert chunks == [
+            (date(2020, 1, 1), date(2020, 12, 30)),
+            (date(2020, 12, 31), date(2021, 12, 31)),
+        ]
+
+    def test_short_or_mixed_ranges(self):
+        assert len(trend_chunks(date(2024, 1, 1), date(2024, 6, 1))) == 1
+        assert len(trend_chunks(date(2019, 1, 1), datetime(2024, 1, 1))) == 1
+
+    def test_merge(self):
+        first = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        last = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        partials = [
+            [
+                trend_partial("01", last, last, [3.0, None]),
+                trend_partial("02", last, last, [None]),
+            ],
+            [
+                trend_partial("02", first, first, [5.0, 7.0, 6.0]),
+                trend_partial("01", first, first, [1.0, 2.0]),
+                trend_partial("03", first, first, [None]),
+            ],
+        ]
+        params = merge_trends(partials)
+        assert params["merged_factor"] == ["01", "02", "03"]
+        assert params["merged_n"] == [4, 4, 1]
+        assert params["merged_coverage_first"] == [first, first, first]
+        assert params["merged_coverage_last"] == [last, last, first]
+        assert params["merged_value_avg"] == [2.0, 6.0, None]
+        assert params["merged_value_sd"][0] == pytest.approx(
+            statistics.stdev([1, 2, 3])
+        )
+        assert params["merged_value_min"] == [1.0, 5.0, None]
+        assert params["merged_value_max"] == [3.0, 7.0, None]
+        # a single sketch is exact
+        assert params["merged_value_p50"][1:] == [6.0, None]
+        assert params["merged_value_p25"][1] == pytest.approx(5.5)
+        assert params["merged_rank_error"] == [1 / 200, None, None]
+
+    def test_merged_quantiles(self):
+        rng = random.Random(1)
+        values = [rng.gauss(10, 3) for _ in range(20_000)]
+        partials = [[trend_partial("01", 1, 2, values[i::3])] for i in range(3)]
+        params = merge_trends(partials)
+        assert params["merged_n"] == [20_000]
+        assert params["merged_value_avg"][0] == pytest.approx(statistics.fmean(values))
+        assert params["merged_value_sd"][0] == pytest.approx(statistics.stdev(values))
+        assert params["merged_value_min"] == [min(values)]
+        assert params["merged_value_max"] == [max(values)]
+        error = params["merged_rank_error"][0]
+        values.sort()
+        for q, fraction in (("p02", 0.02), ("p25", 0.25), ("p50", 0.5), ("p98", 0.98)):
+            estimate = params[f"merged_value_{q}"][0]
+            rank = bisect.bisect(values, estimate) / len(values)
+            assert abs(rank - fraction) <= error
+
+    def test_hours_trends_run_in_chunks(self):
+        db = FakeDB([trend_partial("01", 1, 2, [1.0])])
+        query = QueryBuilder(
+            BaseDatetimeQueries(
+                sensors_id=1,
+                datetime_from="2019-01-01T00:00:00Z",
+                datetime_to="2024-01-01T00:00:00Z",
+            )
+        )
+        asyncio.run(fetch_hours_trends("hod", query, db))
+        partials, (sql, params) = db.queries[:-1], db.queries[-1]
+        assert len(partials) == 4
+        assert all("PERCENTILE_CONT(:sketch_fractions" in q for q, _ in partials)
+        assert len(partials[0][1]["sketch_fractions"]) == settings.TRENDS_SKETCH_SIZE
+        assert "unnest(" in sql
+        assert params["merged_n"] == [4]
+
+    def test_chunks_share_slots(self, monkeypatch):
+        class SlowDB(FakeDB):
+            running = most = 0
+
+            async def fetch(self, query, kwargs, cache_read=True):
+                self.running += 1
+                self.most = max(self.most, self.running)
+                await asyncio.sleep(0.01)
+                self.running -= 1
+                return await super().fetch(query, kwargs, cache_read)
+
+        db = SlowDB([trend_partial("01", 1, 2, [1.0])])
+        query = QueryBuilder(
+            BaseDatetimeQueries(
+                sensors_id=1,
+                datetime_from="2019-01-01T00:00:00Z",
+                datetime_to="2024-01-01T00:00:00Z",
+            )
+        )
+
+        async def trends():
+            monkeypatch.setattr(measurements, "trend_slots", asyncio.Semaphore(2))
+            await fetch_hours_trends("hod", query, db)
+
+        asyncio.run(trends())
+        assert len(db.queries) == 5
+        assert db.most == 2
+
+    def test_short_days_trends_in_one_query(self):
+        db = FakeDB([])
+        query = QueryBuilder(
+            BaseDateQueries(sensors_id=1, date_from="2023-01-01", date_to="2023-06-01")
+        )
+        asyncio.run(fetch_days_trends("moy", query, db))
+        assert len(db.queries) == 1
+        assert "PERCENTILE_CONT" in db.queries[0][0]
+
+    def test_long_days_trends_in_chunks(self):
+        db = FakeDB([trend_partial("01", 1, 2, [1.0])])
+        query = QueryBuilder(
+            BaseDateQueries(sensors_id=1, date_from="2020-01-01", date_to="2021-12-31")
+        )
+        asyncio.run(fetch_days_trends("moy", query, db))
+        sql, params = db.queries[-1]
+        assert len(db.queries) == 3
+        assert "'rank_error', o.rank_error" in sql
+        assert params["merged_rank_error"] == [1 / 200]
+
+
+def hourly_values(start, hours, seed=1):
+    rng = random.Random(seed)
+    datetimes = [start + timedelta(hours=h + 1) for h in range(hours)]
+    values = [None if rng.random() < 0.05 else rng.gauss(10, 3) for _ in datetimes]
+    return datetimes, values
+
+
+@pytest.mark.skipif(
+    importlib.util.find_spec("numpy") is None, reason="numpy is not installed"
+)
+class TestNumpyEngine:
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def arrays(self, datetimes, values):
+        import numpy as np
+
+        epochs = np.array([d.timestamp() for d in datetimes])
+        return epochs, epochs, np.array(values, dtype=float)
+
+    def test_trends_match_merge(self):
+        datetimes, values = hourly_values(self.start, 24 * 60)
+        for aggregate_to, label in (
+            ("hod", lambda d: f"{d.hour:02d}"),
+            ("dow", lambda d: str(d.isoweekday())),
+            ("moy", lambda d: f"{d.month:02d}"),
+        ):
+            partial = {}
+            for d, v in zip(datetimes, values):
+                partial.setdefault(label(d - timedelta(seconds=1)), []).append((d, v))
+            expected = merge_trends(
+                [
+                    [
+                        trend_partial(f, rows[0][0], rows[-1][0], [v for _, v in rows])
+                        for f, rows in partial.items()
+                    ]
+                ]
+            )
+            params = summarize_trends(
+                self.arrays(datetimes, values), "hourly_data", aggregate_to
+            )
+            assert params.keys() == expected.keys()
+            for column, value in expected.items():
+                if column.startswith("merged_value"):
+                    value = pytest.approx(value)
+                assert params[column] == value, column
+
+    def test_periods(self):
+        datetimes = [self.start + timedelta(hours=h + 1) for h in range(48)]
+        values = [float(h) for h in range(48)]
+        values[3] = None
+        params = summarize_periods(self.arrays(datetimes, values), "hourly_data", "day")
+        assert params["engine_datetime"] == [datetime(2024, 1, 1), datetime(2024, 1, 2)]
+        assert params["engine_last_period"] == [
+            datetime(2024, 1, 2),
+            datetime(2024, 1, 3),
+        ]
+        assert params["engine_datetime_first"] == [
+            datetime(2024, 1, 1, 1),
+            datetime(2024, 1, 2, 1),
+        ]
+        assert params["engine_datetime_last"][0] == datetime(2024, 1, 2)
+        assert params["engine_value_count"] == [24, 24]
+        day = [v for v in values[:24] if v is not None]
+        assert params["engine_value_avg"][0] == pytest.approx(statistics.fmean(day))
+        assert params["engine_value_sd"][0] == pytest.approx(statistics.stdev(day))
+        assert params["engine_value_p50"] == [12.0, 35.5]
+        assert params["engine_value_min"] == [0.0, 24.0]
+
+    def test_empty_values(self):
+        params = summarize_periods(self.arrays([], []), "hourly_data", "month")
+        assert params["engine_value_count"] == []
+
+    def test_hours_aggregated(self, monkeypatch):
+        monkeypatch.setattr(settings, "SUMMARY_ENGINE", "numpy")
+        datetimes, values = hourly_values(self.start, 48)
+        epochs = [d.timestamp() for d in datetimes]
+        db = FakeDB(
+            [{"datetimes": epochs, "local_datetimes": epochs, "values": values}],
+            tzid=None,
+        )
+        query = QueryBuilder(PagedDatetimeQueries(sensors_id=1))
+        asyncio.run(fetch_hours_aggregated(query, "day", db))
+        (values_sql, _), (sql, params) = db.queries
+        assert "array_agg(m.value_avg::float8" in values_sql
+        assert "PERCENTILE_CONT" not in sql
+        assert "unnest(" in sql
+        assert params["engine_value_count"] == [24, 24]
+
+    def test_days_trends_by_iso_weekday(self, monkeypatch):
+        monkeypatch.setattr(settings, "SUMMARY_ENGINE", "numpy")
+        days = [datetime(2024, 1, d) for d in range(1, 8)]
+        epochs = [d.replace(tzinfo=timezone.utc).timestamp() for d in days]
+        db = FakeDB(
+            [{"datetimes": epochs, "local_datetimes": epochs, "values": [1.0] * 7}]
+        )
+        query = QueryBuilder(
+            BaseDateQueries(sensors_id=1, date_from="2024-01-01", date_to="2024-01-07")
+        )
+        asyncio.run(fetch_days_trends("dow", query, db))
+        sql, params = db.queries[-1]
+        assert params["merged_factor"] == ["1", "2", "3", "4", "5", "6", "7"]
+        assert params["merged_coverage_first"][0] == date(2024, 1, 1)
+        assert "unnest(" in sql
+
+
+class TestFlags:
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def setup_method(self):
+        series_cache.clear()
+        flags_cache.clear()
+        flags_version.update(checked=0.0, version=None)
+
+    def flag(self, hours_from, hours_to, from_inc=True, to_inc=False):
+        return {
+            "sensors_id": 1,
+            "datetime_from": self.start + timedelta(hours=hours_from),
+            "datetime_to": self.start + timedelta(hours=hours_to),
+            "from_inc": from_inc,
+            "to_inc": to_inc,
+        }
+
+    def fetch(self, db):
+        query = QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1,
+                datetime_from="2024-01-01T00:00:00Z",
+                datetime_to="2024-01-02T00:00:00Z",
+                limit=24,
+            )
+        )
+        response = asyncio.run(fetch_hours(query, db))
+        assert not any("flags_from" in r for r in response.results)
+        return [r["flag_info"]["has_flags"] for r in response.results]
+
+    def test_overlaps(self):
+        flags = SensorFlags(
+            [
+                (self.start, self.start + timedelta(hours=2)),
+                (self.start + timedelta(hours=1), self.start + timedelta(hours=3)),
+                (self.start + timedelta(hours=5), self.start + timedelta(hours=6)),
+            ]
+        )
+        assert flags.starts == [self.start, self.start + timedelta(hours=5)]
+        hour = timedelta(hours=1)
+        assert flags.overlaps(self.start - hour, self.start)
+        assert flags.overlaps(self.start + 3 * hour, self.start + 4 * hour)
+        assert not flags.overlaps(self.start + 3.5 * hour, self.start + 4 * hour)
+        assert not flags.overlaps(self.start - 2 * hour, self.start - hour)
+        assert SensorFlags([]).overlaps(self.start, self.start) is False
+
+    def test_one_flag_query_per_response(self):
+        rows = [hourly(self.start + timedelta(hours=h + 1)) for h in range(48)]
+        # the hour ending at 03:00 touches the inclusive start of the flag and
+        # the hour starting at 05:00 its exclusive end
+        db = FakeDB(rows, flags=[self.flag(3, 5)])
+        has_flags = self.fetch(db)
+        assert has_flags[:6] == [False, False, True, True, True, False]
+        assert not any(has_flags[6:])
+        assert len(db.flag_queries) == 1
+        assert db.flag_queries[0][1]["sensors_ids"] == [1]
+        assert "sensor_flags_exist" not in db.queries[0][0]
+        assert self.fetch(db) == has_flags
+        assert len(db.flag_queries) == 1
+        cached = series_cache.get((1, "hourly_data", datetime(2024, 1, 1)))
+        assert cached is None or "flags_from" in cached[0]
+
+    def test_flags_change(self, monkeypatch):
+        monkeypatch.setattr(settings, "FLAGS_CHECK_SECONDS", 0)
+        rows = [hourly(self.start + timedelta(hours=h + 1)) for h in range(24)]
+        db = FakeDB(rows)
+        assert not any(self.fetch(db))
+        db.flags = [self.flag(10, 11, to_inc=True)]
+        assert not any(self.fetch(db))
+        db.flags_version = "2"
+        assert self.fetch(db)[8:13] == [False, True, True, True, False]
+        assert len(db.flag_queries) == 2
+
+    def test_flags_change_behind_the_query_cache(self, monkeypatch):
+        monkeypatch.setattr(settings, "FLAGS_CHECK_SECONDS", 0)
+        source = FakeDB([], flags_version="cached 1")
+        db = cached_db(source)
+        window = (self.start + timedelta(hours=3), self.start + timedelta(hours=4))
+        assert not asyncio.run(sensor_flags({1}, db))[1].overlaps(*window)
+        source.flags = [self.flag(3, 5)]
+        source.flags_version = "cached 2"
+        assert asyncio.run(sensor_flags({1}, db))[1].overlaps(*window)
+
+
+class FakeTransaction:
+    async def start(self): ...
+
+    async def commit(self): ...
+
+
+class FakeConnection:
+    """Answers the rendered queries of `DB.fetch` with a FakeDB."""
+
+    def __init__(self, source):
+        self.source = source
+
+    def transaction(self):
+        return FakeTransaction()
+
+    async def fetch(self, query, *args):
+        if "JOIN flags" in query:
+            return await self.source.fetch(
+                query, {"sensors_ids": args[0]}, cache_read=False
+            )
+        if "as logging_seconds" in query:
+            return await self.source.fetch(query, {"sensors_id": args[0]})
+        return await self.source.fetch(query, {}, cache_read=False)
+
+
+class FakePool:
+    def __init__(self, con):
+        self.con = con
+
+    def acquire(self):
+        return contextlib.nullcontext(self.con)
+
+
+def cached_db(source) -> DB:
+    """A DB with the query cache of `DB.fetch` in front of a FakeDB."""
+    state = SimpleNamespace(pool=FakePool(FakeConnection(source)))
+    request = SimpleNamespace(
+        app=SimpleNamespace(state=state),
+        state=SimpleNamespace(timer=SimpleNamespace(mark=lambda *args: None)),
+    )
+    return DB(request)
+
+
+class TestSensorMetadata:
+    def setup_method(self):
+        series_cache.clear()
+
+    def query(self):
+        return QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1,
+                datetime_from="2024-01-01T00:00:00",
+                datetime_to="2024-01-02T00:00:00",
+            )
+        )
+
+    def test_series_without_sensor_joins(self):
+        rows = [
+            hourly(datetime(2024, 1, 1, h + 8, tzinfo=timezone.utc)) for h in range(3)
+        ]
+        db = FakeDB(rows, tzid="America/Denver")
+        response = asyncio.run(fetch_hours(self.query(), db))
+        sql, params = db.queries[0]
+        assert "JOIN sensors" not in sql
+        assert "h.sensors_id = :sensors_id" in sql
+        query = self.query()
+        query.set_column_map(metadata_columns("hourly_data"))
+        assert "AT TIME ZONE :timezone::text" in hours_sql(query, True)
+        assert params["timezone"] == "America/Denver"
+        assert params["locations_id"] == 1
+        assert response.results[0]["parameter"] == {
+            "id": 2,
+            "units": "µg/m³",
+            "name": "pm25",
+        }
+        asyncio.run(fetch_hours(self.query(), db))
+        assert len(db.metadata_queries) == 1
+
+    def test_metadata_reloaded(self, monkeypatch):
+        monkeypatch.setattr(settings, "SENSOR_METADATA_SECONDS", 0)
+        db = FakeDB([])
+        asyncio.run(fetch_hours(self.query(), db))
+        asyncio.run(fetch_hours(self.query(), db))
+        assert len(db.metadata_queries) == 2
+
+    def test_metadata_reloaded_behind_the_query_cache(self, monkeypatch):
+        db = cached_db(FakeDB([], tzid="America/Denver"))
+        assert asyncio.run(sensor_metadata(1, db)).timezone == "America/Denver"
+        db.request.app.state.pool.con.source.tzid = "Asia/Kolkata"
+        assert asyncio.run(sensor_metadata(1, db)).timezone == "America/Denver"
+        monkeypatch.setattr(settings, "SENSOR_METADATA_SECONDS", 0)
+        assert asyncio.run(sensor_metadata(1, db)).timezone == "Asia/Kolkata"
+
+    def test_unknown_sensor(self):
+        db = FakeDB([hourly(datetime(2024, 1, 1, 1, tzinfo=timezone.utc))], tzid=None)
+        response = asyncio.run(fetch_hours(self.query(), db))
+        assert response.results == []
+        assert response.meta.found == 0
+        assert db.queries == []
+
+
+class TestResponseAssembly:
+    def setup_method(self):
+        series_cache.clear()
+
+    def test_datetime_object(self):
+        denver = "America/Denver"
+        utc = datetime(2024, 7, 1, 6, tzinfo=timezone.utc)
+        assert datetime_object(utc, denver) == {
+            "utc": "2024-07-01T06:00:00+00:00",
+            "local": "2024-07-01T00:00:00-06:00",
+        }
+        # dates and naive datetimes are local
+        assert datetime_object(date(2024, 1, 1), denver) == {
+            "utc": "2024-01-01T07:00:00+00:00",
+            "local": "2024-01-01T00:00:00-07:00",
+        }
+        assert datetime_object(datetime(2024, 1, 1), denver)["utc"] == (
+            "2024-01-01T07:00:00+00:00"
+        )
+        assert datetime_object(None, denver) is None
+
+    def test_coverage(self):
+        assert calculate_coverage(45, 60, 60, 3600) == {
+            "observed_count": 45,
+            "observed_interval": "00:45:00",
+            "expected_count": 60,
+            "expected_interval": "01:00:00",
+            "percent_complete": 75,
+            "percent_coverage": 75,
+        }
+        assert calculate_coverage(24, 3600, 3600, 24 * 3600)["expected_interval"] == (
+            "24:00:00"
+        )
+        assert interval_text(1.5) == "00:00:01.5"
+
+    def test_hours_assembled(self):
+        rows = [
+            hourly(datetime(2024, 1, 1, h + 8, tzinfo=timezone.utc)) for h in range(3)
+        ]
+        db = FakeDB(rows, tzid="America/Denver")
+        query = QueryBuilder(
+            PagedDatetimeQueries(
+                sensors_id=1,
+                datetime_from="2024-01-01T00:00:00",
+                datetime_to="2024-01-02T00:00:00",
+            )
+        )
+        response = asyncio.run(fetch_hours(query, db))
+        sql, _ = db.queries[0]
+        for function in (
+            "json_build_object",
+            "get_datetime_object",
+            "calculate_coverage",
+        ):
+            assert function not in sql
+        row = response.results[0]
+        assert row["id"] == 1
+        assert row["period"] == {
+            "label": "1hour",
+            "datetime_from": {
+                "utc": "2024-01-01T07:00:00+00:00",
+                "local": "2024-01-01T00:00:00-07:00",
+            },
+            "datetime_to": {
+                "utc": "2024-01-01T08:00:00+00:00",
+                "local": "2024-01-01T01:00:00-07:00",
+            },
+            "interval": "01:00:00",
+        }
+        assert row["coverage"]["percent_complete"] == 100
+        assert row["summary"]["median"] == 8
+        HourlyData.model_validate(row)
+
+    def test_measurements_assembled(self):
+        end = datetime(2024, 1, 1, 1, tzinfo=timezone.utc)
+        rows = [
+            {
+                "sensors_id": 1,
+                "value": 4.0,
+                "datetime": end,
+                "flags_sensors_id": 1,
+                "flags_from": end - timedelta(hours=1),
+                "flags_to": end,
+            }
+        ]
+        db = FakeDB(rows)
+        query = QueryBuilder(PagedDatetimeQueries(sensors_id=1))
+        response = asyncio.run(fetch_measurements(query, db))
+        row = response.results[0]
+        assert row["period"]["label"] == "raw"
+        assert row["period"]["datetime_from"]["utc"] == "2024-01-01T00:00:00+00:00"
+        assert row["coverage"]["observed_interval"] == "01:00:00"
+        assert row["coverage"]["percent_coverage"] == 100
+        assert row["flag_info"] == {"has_flags": False}
+        Measurement.model_validate(row)
+
+
+class TestColumnarSeries:
+    def setup_method(self):
+        series_cache.clear()
+        flags_cache.clear()
+        flags_version.update(checked=0.0, version=None)
+
+    def fetch(self, format):
+        rows = [
+            hourly(datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(hours=h + 1))
+            for h in range(24)
+        ]
+        queries = SeriesDatetimeQueries(
+            sensors_id=1,
+            datetime_from="2024-01-01T00:00:00Z",
+            datetime_to="2024-01-02T00:00:00Z",
+            format=format,
+        )
+        response = asyncio.run(fetch_hours(QueryBuilder(queries), FakeDB(rows)))
+        return series_response(queries, response)
+
+    def test_columnar(self):
+        response = self.fetch("columnar")
+        body = orjson.loads(response.body)
+        assert body["meta"]["found"] == 24
+        (series,) = body["results"]
+        assert series["label"] == "1hour"
+        assert series["interval"] == "01:00:00"
+        assert series["parameter"] == {
+            "id": 2,
+            "name": "pm25",
+            "units": "µg/m³",
+            "displayName": None,
+        }
+        assert series["datetimeFrom"]["utc"][:2] == [
+            "2024-01-01T00:00:00Z",
+            "2024-01-01T01:00:00Z",
+        ]
+        assert series["datetimeTo"]["utc"][-1] == "2024-01-02T00:00:00Z"
+        assert series["values"][:3] == [1.0, 2.0, 3.0]
+        assert series["hasFlags"] == [False] * 24
+        assert series["coverage"]["percentComplete"] == [100] * 24
+        assert series["summary"]["median"][0] == 1.0
+        rows = serialize(HourlyDataResponse, self.fetch("rows"))
+        assert len(response.body) * 4 < len(rows)
+
+    def test_columnar_validated(self, monkeypatch):
+        monkeypatch.setattr(settings, "VALIDATE_RESPONSES", True)
+        body = orjson.loads(self.fetch("columnar").body)
+        assert body["results"][0]["values"][0] == 1.0
+
+    def test_empty(self):
+        queries = SeriesDatetimeQueries(sensors_id=1, format="columnar")
+        response = asyncio.run(fetch_hours(QueryBuilder(queries), FakeDB([])))
+        assert orjson.loads(series_response(queries, response).body)["results"] == []
+
+
+class TestDownsampling:
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def setup_method(self):
+        series_cache.clear()
+        flags_cache.clear()
+        flags_version.update(checked=0.0, version=None)
+
+    def fetch(self, rows, **kwargs):
+        queries = SampledDatetimeQueries(sensors_id=1, **kwargs)
+        db = FakeDB(rows)
+        return asyncio.run(fetch_hours(QueryBuilder(queries), db)), db
+
+    def days(self, n):
+        return [hourly(self.start + timedelta(hours=h + 1)) for h in range(24 * n)]
+
+    def test_extremes_per_bucket(self):
+        rows = self.days(10)
+        # a one hour peak the thinned series must keep
+        rows[30].update(value=100.0)
+        response, _ = self.fetch(
+            rows,
+            datetime_from="2024-01-01T00:00:00Z",
+            datetime_to="2024-01-11T00:00:00Z",
+            max_points=20,
+            limit=5,
+        )
+        assert response.meta.found == 20
+        assert response.meta.limit == 20
+        assert response.meta.resolution == "24:00:00"
+        values = [row["value"] for row in response.results]
+        assert values[:4] == [23, 0, 100.0, 0]
+        assert values[4:] == [23, 0] * 8
+        assert all("flag_info" in row for row in response.results)
+
+    def test_series_fits(self):
+        response, _ = self.fetch(
+            self.days(1),
+            datetime_from="2024-01-01T00:00:00Z",
+            datetime_to="2024-01-02T00:00:00Z",
+            max_points=100,
+        )
+        assert response.meta.found == 24
+        assert response.meta.resolution == "01:00:00"
+
+    def test_range_required(self):
+        with pytest.raises(HTTPException) as e:
+            self.fetch(self.days(10), max_points=10)
+        assert e.value.status_code == 422
+        with pytest.raises(HTTPException) as e:
+            self.fetch(self.days(10), datetime_from="2020-01-01", max_points=10)
+        assert e.value.status_code == 422
+        assert "36 months" in e.value.detail
+
+    def test_without_cache(self, monkeypatch):
+        monkeypatch.setattr(settings, "SERIES_CACHE", False)
+        response, db = self.fetch(
+            self.days(10),
+            datetime_from="2024-01-01T00:00:00Z",
+            datetime_to="2024-01-11T00:00:00Z",
+            max_points=10,
+        )
+        sql, params = db.queries[0]
+        assert params["limit"] is None
+        assert response.meta.found == 10
+        # 240 hours in 5 buckets
+        assert response.meta.resolution == "48:00:00"
+
+    def test_without_numpy(self, monkeypatch):
+        rows = self.days(10)
+        for i, row in enumerate(rows):
+            row.update(value=None if i % 7 == 0 else float(i % 5))
+        kwargs = dict(
+            datetime_from="2024-01-01T00:00:00Z",
+            datetime_to="2024-01-11T00:00:00Z",
+            max_points=50,
+        )
+        expected, _ = self.fetch(rows, **kwargs)
+        monkeypatch.setattr(measurements, "numpy_installed", lambda: False)
+        response, _ = self.fetch(rows, **kwargs)
+        assert response.results == expected.results
+        assert response.meta == expected.meta
+
+    def test_days(self):
+        rows = [daily(date(2024, 1, 1) + timedelta(days=d)) for d in range(60)]
+        queries = SampledDateQueries(
+            sensors_id=1, date_from="2024-01-01", date_to="2024-02-29", max_points=10
+        )
+        response = asyncio.run(fetch_days(QueryBuilder(queries), FakeDB(rows)))
+        assert response.meta.resolution == "288:00:00"
+        assert [row["value"] for row in response.results][:2] == [1, 12]
+
+
+class TestGapFill:
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def setup_method(self):
+        series_cache.clear()
+        flags_cache.clear()
+        flags_version.update(checked=0.0, version=None)
+
+    def rows(self, missing=(0, 4, 5, 6)):
+        return [
+            hourly(self.start + timedelta(hours=h + 1))
+            for h in range(24)
+            if h not in missing
+        ]
+
+    def fetch(self, fill, rows=None, **kwargs):
+        kwargs.setdefault("datetime_from", "2024-01-01T00:00:00Z")
+        kwargs.setdefault("datetime_to", "2024-01-02T00:00:00Z")
+        queries = HoursSeriesQueries(sensors_id=1, fill=fill, **kwargs)
+        db = FakeDB(self.rows() if rows is None else rows)
+        return asyncio.run(fetch_hours(QueryBuilder(queries), db)), db
+
+    def test_null(self):
+        response, _ = self.fetch("null", limit=10)
+        assert response.meta.found == 24
+        assert response.meta.resolution == "01:00:00"
+        assert response.meta.coverage.observed_count == 20
+        assert response.meta.coverage.percent_complete == 83
+        assert response.meta.coverage.datetime_from.utc == self.start
+        values = [row["value"] for row in response.results]
+        assert values == [None, 2, 3, 4, None, None, None, 8, 9, 10]
+        gap = response.results[0]
+        assert gap["period"]["datetime_to"]["utc"] == "2024-01-01T01:00:00+00:00"
+        assert gap["coverage"]["observed_count"] == 0
+        assert gap["coverage"]["percent_complete"] == 0
+        assert gap["flag_info"] == {"has_flags": False}
+        HourlyDataResponse.model_validate(response.model_dump())
+
+    def test_linear(self):
+        response, _ = self.fetch("linear", datetime_to="2024-01-02T02:00:00Z")
+        values = [row["value"] for row in response.results]
+        assert len(values) == 26
+        # not extrapolated before the first and after the last value
+        assert values[:8] == [None, 2, 3, 4, 5.0, 6.0, 7.0, 8]
+        assert values[-2:] == [None, None]
+        assert response.meta.coverage.expected_count == 26
+
+    def test_without_numpy(self, monkeypatch):
+        rows = self.rows(missing=(3, 9, 10, 11, 20))
+        rows[5].update(value=None)
+        expected, _ = self.fetch("linear", rows)
+        monkeypatch.setattr(measurements, "numpy_installed", lambda: False)
+        response, _ = self.fetch("linear", rows)
+        assert response.results == expected.results
+        assert response.meta == expected.meta
+
+    def test_range_required(self):
+        with pytest.raises(HTTPException) as e:
+            self.fetch("null", datetime_from=None, datetime_to=None)
+        assert e.value.status_code == 422
+        assert "datetime_from" in e.value.detail
+        with pytest.raises(HTTPException) as e:
+            self.fetch("linear", datetime_from="2020-01-01T00:00:00Z")
+        assert e.value.status_code == 422
+
+    def test_without_cache(self, monkeypatch):
+        monkeypatch.setattr(settings, "SERIES_CACHE", False)
+        response, db = self.fetch("null", page=3, limit=10)
+        sql, params = db.queries[0]
+        assert params["limit"] is None
+        assert response.meta.found == 24
+        assert [row["value"] for row in response.results] == [21, 22, 23, 0]
+
+    def test_columnar(self):
+        queries = HoursSeriesQueries(
+            sensors_id=1,
+            datetime_from="2024-01-01T00:00:00Z",
+            datetime_to="2024-01-02T00:00:00Z",
+            fill="null",
+            format="columnar",
+        )
+        response = asyncio.run(fetch_hours(QueryBuilder(queries), FakeDB(self.rows())))
+        body = orjson.loads(series_response(queries, response).body)
+        (series,) = body["results"]
+        assert series["values"][:5] == [None, 2.0, 3.0, 4.0, None]
+        assert series["coverage"]["observedCount"][:2] == [0, 1]
+        assert series["summary"]["median"][:2] == [None, 2.0]
+        assert body["meta"]["coverage"]["expectedCount"] == 24
+
+    def test_downsampled(self):
+        response, _ = self.fetch("linear", max_points=8)
+        assert response.meta.found == 8
+        assert response.meta.resolution == "06:00:00"
+        assert response.meta.coverage.observed_count == 20
+
+
+def test_table_media_type():
+    arrow = "application/vnd.apache.arrow.stream"
+    assert table_media_type(None) is None
+    assert table_media_type("*/*") is None
+    assert table_media_type(f"{arrow}, application/json") == arrow
+    assert table_media_type(f"application/json, {arrow};q=0.5") is None
+    assert table_media_type("application/vnd.apache.parquet;q=0.9") == (
+        "application/vnd.apache.parquet"
+    )
+
+
+class TestSeriesTables:
+    def setup_method(self):
+        flags_cache.clear()
+        flags_version.update(checked=0.0, version=None)
+
+    def download(self, db, table, series_sql, media_type, **kwargs):
+        async def collect():
+            response = await fetch_series_table(
+                queries, table, series_sql, media_type, db
+            )
+            return response, b"".join([chunk async for chunk in response.body_iterator])
+
+        if table == "daily_data":
+            queries = SeriesDateQueries(sensors_id=1, **kwargs)
+        else:
+            queries = SeriesDatetimeQueries(sensors_id=1, **kwargs)
+        return asyncio.run(collect())
+
+    def test_not_acceptable_without_pyarrow(self, monkeypatch):
+        monkeypatch.setattr(measurements, "pyarrow_installed", lambda: False)
+        with pytest.raises(HTTPException) as e:
+            self.download(
+                FakeDB([]), "hourly_data", hours_sql, "application/vnd.apache.parquet"
+            )
+        assert e.value.status_code == 406
+
+    @pytest.mark.skipif(
+        importlib.util.find_spec("pyarrow") is None, reason="pyarrow is not installed"
+    )
+    def test_arrow_hours(self, monkeypatch):
+        import pyarrow as pa
+
+        monkeypatch.setattr(measurements, "table_batch_rows", 10)
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        rows = [hourly(start + timedelta(hours=h + 1)) for h in range(24)]
+        flag = {
+            "sensors_id": 1,
+            "datetime_from": start + timedelta(hours=3),
+            "datetime_to": start + timedelta(hours=4),
+            "from_inc": True,
+            "to_inc": False,
+        }
+        db = FakeDB(rows, tzid="America/Denver", flags=[flag])
+        response, body = self.download(
+            db,
+            "hourly_data",
+            hours_sql,
+            "application/vnd.apache.arrow.stream",
+            datetime_from="2024-01-01T00:00:00Z",
+            limit=5,
+        )
+        assert response.headers["content-disposition"] == (
+            'attachment; filename="sensor-1-hours.arrows"'
+        )
+        sql, params = db.queries[-1]
+        assert "LIMIT" not in sql
+        reader = pa.ipc.open_stream(body)
+        batches = list(reader)
+        assert [b.num_rows for b in batches] == [10, 10, 4]
+        table = pa.Table.from_batches(batches)
+        assert table.schema.field("datetime_to").type == pa.timestamp(
+            "us", tz="America/Denver"
+        )
+        columns = table.to_pydict()
+        assert columns["datetime_to"][0] == start + timedelta(hours=1)
+        assert columns["datetime_from"][0] == start
+        assert columns["value"][:3] == [1.0, 2.0, 3.0]
+        assert columns["median"][:3] == [1.0, 2.0, 3.0]
+        assert columns["observed_count"][0] == 1
+        assert columns["has_flags"][:6] == [False, False, True, True, False, False]
+
+    @pytest.mark.skipif(
+        importlib.util.find_spec("pyarrow") is None, reason="pyarrow is not installed"
+    )
+    def test_parquet_days(self):
+        import io
+
+        import pyarrow.parquet as pq
+
+        db = FakeDB([daily(date(2024, 1, 1)), daily(date(2024, 1, 2))])
+        _, body = self.download(
+            db, "daily_data", days_sql, "application/vnd.apache.parquet"
+        )
+        columns = pq.read_table(io.BytesIO(body)).to_pydict()
+        assert columns["datetime_from"] == [date(2024, 1, 1), date(2024, 1, 2)]
+        assert columns["datetime_to"] == [date(2024, 1, 2), date(2024, 1, 3)]
+        assert columns["value"] == [1.0, 2.0]
+
+
+class LocationTableDB(FakeDB):
+    sensors = [
+        {"sensors_id": 5, "timezone": "America/Denver"},
+        {"sensors_id": 7, "timezone": "America/Denver"},
+    ]
+
+    async def fetch(self, query, kwargs, cache_read=True):
+        self.queries.append((query, kwargs))
+        return self.sensors
+
+
+class TestLocationTables:
+    def download(self, db, table, queries, media_type):
+        async def collect():
+            response = await fetch_location_table(queries, table, media_type, db)
+            return response, b"".join([chunk async for chunk in response.body_iterator])
+
+        return asyncio.run(collect())
+
+    def test_not_acceptable_without_pyarrow(self, monkeypatch):
+        monkeypatch.setattr(measurements, "pyarrow_installed", lambda: False)
+        with pytest.raises(HTTPException) as e:
+            self.download(
+                LocationTableDB([]),
+                "hourly_data",
+                LocationDatetimeQueries(locations_id=1),
+                "application/vnd.apache.parquet",
+            )
+        assert e.value.status_code == 406
+
+    def test_location_not_found(self):
+        db = LocationTableDB([])
+        db.sensors = []
+        with pytest.raises(HTTPException) as e:
+            self.download(
+                db,
+                "hourly_data",
+                LocationDatetimeQueries(locations_id=1),
+                "application/vnd.apache.parquet",
+            )
+        assert e.value.status_code == 404
+
+    @pytest.mark.skipif(
+        importlib.util.find_spec("pyarrow") is None, reason="pyarrow is not installed"
+    )
+    def test_arrow_hours(self, monkeypatch):
+        import pyarrow as pa
+
+        monkeypatch.setattr(measurements, "table_batch_rows", 2)
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        rows = [
+            {"datetime": start + timedelta(hours=1), "sensors_id": 5, "value": 1.0},
+            {"datetime": start + timedelta(hours=1), "sensors_id": 7, "value": 2.0},
+            {"datetime": start + timedelta(hours=2), "sensors_id": 7, "value": 3.0},
+            # added to the location after its sensors were read
+            {"datetime": start + timedelta(hours=2), "sensors_id": 9, "value": 9.0},
+            {"datetime": start + timedelta(hours=3), "sensors_id": 5, "value": None},
+        ]
+        db = LocationTableDB(rows)
+        queries = LocationDatetimeQueries(
+            locations_id=1, datetime_from="2024-01-01T00:00:00Z", limit=1
+        )
+        response, body = self.download(
+            db, "hourly_data", queries, "application/vnd.apache.arrow.stream"
+        )
+        assert response.headers["content-disposition"] == (
+            'attachment; filename="location-1-hours.arrows"'
+        )
+        sql, params = db.queries[-1]
+        assert "sy.sensor_nodes_id = :locations_id" in sql
+        assert "LIMIT" not in sql
+        reader = pa.ipc.open_stream(body)
+        batches = list(reader)
+        assert [b.num_rows for b in batches] == [2, 1]
+        table = pa.Table.from_batches(batches)
+        assert table.schema.names == ["datetime_from", "sensor_5", "sensor_7"]
+        assert table.schema.field("datetime_from").type == pa.timestamp(
+            "us", tz="America/Denver"
+        )
+        columns = table.to_pydict()
+        assert columns["datetime_from"][0] == start
+        assert columns["sensor_5"] == [1.0, None, None]
+        assert columns["sensor_7"] == [2.0, 3.0, None]
+
+    @pytest.mark.skipif(
+        importlib.util.find_spec("pyarrow") is None, reason="pyarrow is not installed"
+    )
+    def test_parquet_days(self):
+        import io
+
+        import pyarrow.parquet as pq
+
+        rows = [
+            {"datetime": date(2024, 1, 1), "sensors_id": 7, "value": 1.0},
+            {"datetime": date(2024, 1, 2), "sensors_id": 5, "value": 2.0},
+        ]
+        _, body = self.download(
+            LocationTableDB(rows),
+            "daily_data",
+            LocationDateQueries(locations_id=1),
+            "application/vnd.apache.parquet",
+        )
+        columns = pq.read_table(io.BytesIO(body)).to_pydict()
+        assert columns["datetime_from"] == [date(2024, 1, 1), date(2024, 1, 2)]
+        assert columns["sensor_5"] == [None, 2.0]
+        assert columns["sensor_7"] == [1.0, None]
@@ -1,7 +1,12 @@
 import pytest
 from datetime import date
 
-from openaq_api.v3.models.utils import fix_date
+from openaq_api.v3.models.utils import (
+    fix_date,
+    float4_down,
+    float4_up,
+    geodesic_distance,
+)
 
 
 def test_infinity_date():
@@ -12,3 +17,24 @@ def test_infinity_date():
 def test_string_date():
     d = fix_date("2024-01-01")
     assert isinstance(d, date)
+
+
+def test_geodesic_distance():
+    # Flinders Peak to Buninyong, the example of Vincenty (1975)
+    flinders = (-(37 + 57 / 60 + 3.7203 / 3600), 144 + 25 / 60 + 29.5244 / 3600)
+    buninyong = (-(37 + 39 / 60 + 10.1561 / 3600), 143 + 55 / 60 + 35.3839 / 3600)
+    assert geodesic_distance(*flinders, *buninyong) == pytest.approx(
+        54972.271, abs=1e-3
+    )
+    assert geodesic_distance(0, 0, 0, 1) == pytest.approx(111319.491, abs=1e-3)
+    assert geodesic_distance(0, 179.9995, 0, -179.9995) == pytest.approx(
+        111.319, abs=1e-3
+    )
+    assert geodesic_distance(10, 10, 10, 10) == 0
+
+
+def test_float4_rounding():
+    assert float4_down(0.1) < 0.1 < float4_up(0.1)
+    assert float4_down(-77.037) < -77.037 < float4_up(-77.037)
+    assert float4_down(0.5) == float4_up(0.5) == 0.5
+    assert float4_down(1e-50) == 0 < float4_up(1e-50)
@@ -0,0 +1,300 @@
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+
+import orjson
+import pytest
+from fastapi import FastAPI
+from fastapi.exceptions import ResponseValidationError
+from fastapi.routing import APIRouter, serialize_response
+from fastapi.testclient import TestClient
+
+from openaq_api.settings import settings
+from openaq_api.v3.models.responses import (
+    AnnualDataResponse,
+    DailyDataResponse,
+    HourlyDataResponse,
+    Latest,
+    LocationsResponse,
+    LocationTimeSeriesResponse,
+    MeasurementsResponse,
+    Meta,
+    OpenAQResult,
+    SensorsHourlyDataResponse,
+)
+from openaq_api.v3.models.serializers import (
+    TrustedRoute,
+    json_response,
+    serialize,
+    trusted_response,
+)
+from openaq_api.v3.routers import measurements
+from openaq_api.v3.routers.measurements import (
+    SensorMetadata,
+    assemble_day,
+    assemble_hour,
+)
+
+metadata = SensorMetadata(
+    {
+        "sensors_id": 1,
+        "locations_id": 2,
+        "measurands_id": 2,
+        "measurand": "pm25",
+        "units": "µg/m³",
+        "timezone": "America/Denver",
+        "averaging_seconds": 3600,
+        "logging_seconds": 3600,
+    },
+    0.0,
+)
+
+
+def series_row(assemble, period, first, last, n: int) -> dict:
+    row = assemble(
+        {
+            "datetime": period,
+            "datetime_first": first,
+            "datetime_last": last,
+            "value_count": 1,
+            "value": n + 0.5,
+            "value_avg": n + 0.5,
+            "value_sd": None,
+            "value_min": n,
+            "value_p02": n,
+            "value_p25": n,
+            "value_p50": n,
+            "value_p75": n,
+            "value_p98": n,
+            "value_max": n + 1,
+            "flags_sensors_id": 1,
+            "flags_from": first,
+            "flags_to": last,
+        },
+        metadata,
+    )
+    for key in ("flags_sensors_id", "flags_from", "flags_to"):
+        row.pop(key)
+    row["flag_info"] = {"has_flags": n % 2 == 0}
+    row["parameter"] = metadata.parameter
+    return row
+
+
+def hours(n: int) -> list[dict]:
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for h in range(n):
+        end = start + timedelta(hours=h + 1)
+        rows.append(series_row(assemble_hour, end, end, end, h))
+    return rows
+
+
+def days(n: int) -> list[dict]:
+    start = datetime(2024, 1, 1, 7, tzinfo=timezone.utc)
+    rows = []
+    for d in range(n):
+        first = start + timedelta(days=d, hours=1)
+        last = start + timedelta(days=d + 1)
+        rows.append(series_row(assemble_day, date(2024, 1, d + 1), first, last, d))
+    return rows
+
+
+def years(n: int) -> list[dict]:
+    rows = days(n)
+    for y, row in enumerate(rows):
+        row["period"].update(
+            label="1year",
+            datetime_from={
+                "utc": f"{2020 + y}-01-01T07:00:00Z",
+                "local": f"{2020 + y}-01-01T00:00:00-07:00",
+            },
+            datetime_to={
+                "utc": f"{2021 + y}-01-01T07:00:00Z",
+                "local": f"{2021 + y}-01-01T00:00:00-07:00",
+            },
+            interval="8760:00:00",
+        )
+    return rows
+
+
+def location() -> dict:
+    return {
+        "id": 1,
+        "name": "Downtown",
+        "locality": None,
+        "timezone": "America/Denver",
+        "country": {"id": 1, "code": "US", "name": "United States"},
+        "owner": {"id": 1, "name": "Owner"},
+        "provider": {"id": 1, "name": "Provider"},
+        "is_mobile": False,
+        "is_monitor": True,
+        "instruments": [{"id": 1, "name": "Instrument"}],
+        "sensors": [
+            {
+                "id": 1,
+                "name": "pm25 µg/m³",
+                "parameter": {"id": 2, "name": "pm25", "units": "µg/m³"},
+            }
+        ],
+        "coordinates": {"latitude": 39.7, "longitude": -105},
+        "licenses": [
+            {
+                "id": 1,
+                "name": "CC BY 4.0",
+                "attribution": {"name": "Provider", "url": None},
+                "date_from": "2020-01-01",
+                "date_to": "infinity",
+            }
+        ],
+        "bounds": [-105, 39.7, -105, 39.7],
+        "datetime_first": {
+            "utc": "2020-01-01T07:00:00+00:00",
+            "local": "2020-01-01T00:00:00-07:00",
+        },
+        "datetime_last": None,
+    }
+
+
+def series() -> dict:
+    utc = [datetime(2024, 1, 1, h, tzinfo=timezone.utc) for h in (1, 2)]
+    return {
+        "label": "1 hour",
+        "interval": "01:00:00",
+        "datetime_from": {
+            "utc": utc,
+            "local": [dt.astimezone(timezone(timedelta(hours=-7))) for dt in utc],
+        },
+        "sensors": [
+            {
+                "sensors_id": 1,
+                "parameter": {"id": 2, "name": "pm25", "units": "µg/m³"},
+                "values": [1, None],
+            }
+        ],
+    }
+
+
+def latest() -> dict:
+    return {
+        "sensors_id": 1,
+        "locations_id": 2,
+        "datetime": {
+            "utc": "2024-01-01T07:00:00+00:00",
+            "local": "2024-01-01T00:00:00-07:00",
+        },
+        "value": 3,
+        "coordinates": {"latitude": 39.7, "longitude": -105},
+    }
+
+
+# the content of every model encoded with `serialize`, the responses of
+# the `trusted_response` endpoints and the latest values of the stream
+fixtures = {
+    MeasurementsResponse: [
+        OpenAQResult(meta=Meta(found=3), results=hours(3)),
+        {"meta": {"found": ">100"}, "results": hours(2)},
+    ],
+    HourlyDataResponse: [
+        OpenAQResult(meta=Meta(found=24), results=hours(24)),
+        {"meta": {"found": ">100"}, "results": hours(3)},
+    ],
+    DailyDataResponse: [
+        OpenAQResult(meta=Meta(found=2), results=days(2)),
+        {"meta": {"found": ">100"}, "results": days(3)},
+    ],
+    AnnualDataResponse: [OpenAQResult(meta=Meta(found=2), results=years(2))],
+    SensorsHourlyDataResponse: [
+        OpenAQResult(
+            results=[
+                {"sensors_id": 1, "found": 3, "results": hours(3)},
+                {"sensors_id": 2, "found": 0, "results": []},
+            ]
+        )
+    ],
+    LocationTimeSeriesResponse: [OpenAQResult(results=[series()])],
+    LocationsResponse: [OpenAQResult(results=[location()])],
+    Latest: [latest()],
+}
+
+
+def validated(model, content) -> bytes:
+    router = APIRouter()
+
+    @router.get("/", response_model=model)
+    async def endpoint(): ...
+
+    field = router.routes[0].response_field
+    return orjson.dumps(
+        asyncio.run(
+            serialize_response(field=field, response_content=content, is_coroutine=True)
+        )
+    )
+
+
+@pytest.mark.parametrize(
+    "model,content",
+    [(model, content) for model, contents in fixtures.items() for content in contents],
+)
+def test_same_json_as_validated(model, content):
+    assert orjson.loads(serialize(model, content)) == orjson.loads(
+        validated(model, content)
+    )
+    response = json_response(model, content)
+    assert orjson.loads(response.body) == orjson.loads(validated(model, content))
+
+
+def test_trusted_models_have_fixtures():
+    trusted = {
+        route.response_model
+        for route in measurements.router.routes
+        if getattr(route.endpoint, "trusted_response", False)
+    }
+    assert trusted
+    assert trusted <= set(fixtures)
+
+
+def test_datetimes_as_validated():
+    content = OpenAQResult(results=hours(1))
+    trusted = orjson.loads(serialize(HourlyDataResponse, content))
+    period = trusted["results"][0]["period"]
+    assert period["datetimeFrom"]["utc"] == "2024-01-01T00:00:00Z"
+    assert period["datetimeFrom"]["local"] == "2023-12-31T17:00:00-07:00"
+    assert trusted["results"][0]["flagInfo"] == {"hasFlags": True}
+
+
+class TestTrustedRoute:
+    def client(self, results):
+        router = APIRouter(route_class=TrustedRoute)
+
+        @router.get("/hours", response_model=HourlyDataResponse)
+        @trusted_response
+        async def hours_get(limit: int = 100):
+            return OpenAQResult(meta=Meta(limit=limit), results=results)
+
+        @router.get("/validated", response_model=HourlyDataResponse)
+        async def validated_get():
+            return OpenAQResult(results=results)
+
+        app = FastAPI()
+        app.include_router(router)
+        return TestClient(app)
+
+    def test_trusted(self):
+        response = self.client(hours(2)).get("/hours?limit=2")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/json"
+        assert response.json()["meta"]["limit"] == 2
+        assert "summary" in response.json()["results"][0]
+
+    def test_validate_responses(self, monkeypatch):
+        rows = hours(1)
+        del rows[0]["flag_info"]
+        assert "flagInfo" in self.client(rows).get("/hours").json()["results"][0]
+        monkeypatch.setattr(settings, "VALIDATE_RESPONSES", True)
+        with pytest.raises(ResponseValidationError):
+            self.client(rows).get("/hours")
+
+    def test_validated_unless_trusted(self):
+        rows = hours(1)
+        del rows[0]["flag_info"]
+        with pytest.raises(ResponseValidationError):
+            self.client(rows).get("/validated")
@@ -33,9 +33,19 @@ from openaq_api.v3.models.queries import (
     QueryBuilder,
     RadiusQuery,
     SortingBase,
+    sql_template,
     truncate_float,
 )
-from openaq_api.v3.routers.locations import LocationPathQuery, LocationsQueries
+from openaq_api.v3.routers.measurements import (
+    PagedSensorsDatetimeQueries,
+    SensorsQuery,
+    max_batch_sensors,
+)
+from openaq_api.v3.routers.locations import (
+    LocationPathQuery,
+    LocationsQueries,
+    LocationsSorting,
+)
 
 
 class TestTruncateFloat:
@@ -570,6 +580,56 @@ class TestQueryBuilder:
         assert query_builder.order_by() == ""
 
 
+class TestSqlTemplate:
+    @pytest.fixture(autouse=True)
+    def set_template(self):
+        self.calls = 0
+
+        @sql_template
+        def template(query: QueryBuilder, suffix: str = "") -> str:
+            self.calls += 1
+            return f"SELECT 1 {query.where()}{suffix}"
+
+        self.template = template
+
+    def test_same_shape_is_built_once(self):
+        first = self.template(QueryBuilder(QueryContainer(iso="us")))
+        second = self.template(QueryBuilder(QueryContainer(iso="ca")))
+        assert first is second
+        assert self.calls == 1
+
+    def test_present_parameters_change_shape(self):
+        self.template(QueryBuilder(QueryContainer(iso="us")))
+        sql = self.template(QueryBuilder(QueryContainer(iso="us", monitor=True)))
+        assert sql == "SELECT 1 WHERE country->>'code' = :iso\nAND ismonitor = :monitor"
+        assert self.calls == 2
+
+    def test_extra_arguments_change_shape(self):
+        query = QueryBuilder(QueryContainer(iso="us"))
+        assert self.template(query) != self.template(query, " LIMIT 1")
+        assert self.calls == 2
+
+    def test_timezone_awareness_changes_shape(self):
+        naive = self.template(
+            QueryBuilder(DatetimeFromQuery(datetime_from="2022-10-01T14:47:27"))
+        )
+        aware = self.template(
+            QueryBuilder(DatetimeFromQuery(datetime_from="2022-10-01T14:47:27-00:00"))
+        )
+        assert (
+            naive
+            == "SELECT 1 WHERE datetime > (:datetime_from::timestamp AT TIME ZONE timezone)"
+        )
+        assert aware == "SELECT 1 WHERE datetime > :datetime_from"
+
+    def test_enum_values_change_shape(self):
+        class Sorted(CountryIsoQuery, LocationsSorting): ...
+
+        asc = QueryBuilder(Sorted(iso="us", sort_order="asc"))
+        desc = QueryBuilder(Sorted(iso="us", sort_order="desc"))
+        assert asc.shape() != desc.shape()
+
+
 class TestLocationPathQuery:
     def test_location_path_query(self):
         location_queries = LocationPathQuery(locations_id=42)
@@ -611,6 +671,32 @@ class TestManufacturersQueries:
         assert params == {"manufacturers_id": None}
 
 
+class TestSensorsQuery:
+    def test_has_value(self):
+        sensors_query = SensorsQuery(sensors_id="1,2,3")
+        assert sensors_query.where() == "h.sensors_id = ANY(:sensors_id)"
+        assert sensors_query.model_dump() == {"sensors_id": [1, 2, 3]}
+
+    def test_no_value(self):
+        with pytest.raises(fastapi.exceptions.HTTPException):
+            SensorsQuery()
+
+    def test_too_many_sensors(self):
+        sensors_id = ",".join(str(i) for i in range(max_batch_sensors + 1))
+        with pytest.raises(fastapi.exceptions.RequestValidationError):
+            SensorsQuery(sensors_id=sensors_id)
+
+    def test_paged_where(self):
+        query = QueryBuilder(
+            PagedSensorsDatetimeQueries(
+                sensors_id="1,2", datetime_from="2024-01-01T00:00:00Z"
+            )
+        )
+        assert query.where() == (
+            "WHERE datetime > :datetime_from\nAND h.sensors_id = ANY(:sensors_id)"
+        )
+
+
 class TestParameterLatestPathQuery:
     def test_has_value(self):
         parameter_latest_path_query = ParameterLatestPathQuery(parameters_id=42)